@@ -1,4 +1,12 @@
+import asyncio
 import heapq
+import itertools
+import math
+import statistics
+import time
+import datetime
+from collections import deque
+from typing import Union
 import requests
 from fastapi import FastAPI, Request
 from fastapi.responses import RedirectResponse
@@ -6,149 +14,717 @@ import os
 import socket
 from fastapi import FastAPI, HTTPException
 from fastapi.templating import Jinja2Templates
-from rhnode.common import QueueRequest, NodeMetaData
+from rhnode.common import QueueRequest, NodeMetaData, JobUsage, CacheKeyFilter
 from dotenv import load_dotenv
 from rhnode.version import __version__
 
 # load env variables from .env file if it exists
 load_dotenv()
 
+# Shares are floats, so e.g. 1 - 0.3 - 0.3 leaves slightly less than 0.4
+GPU_SHARE_TOLERANCE = 1e-9
+
+
+class JobHistory:
+    """Run durations and resource use of recently completed jobs, per node name.
+    The ResourceQueue uses it to order jobs and to predict when queued jobs start."""
+
+    def __init__(self, max_records=50):
+        self.max_records = max_records
+        self.records = {}
+        # Expected duration by node name, as the queue is sorted by it often
+        self._expected_durations = {}
+
+    def record(self, node_name, duration, job_request, usage):
+        self._expected_durations.pop(node_name, None)
+        records = self.records.setdefault(node_name, deque(maxlen=self.max_records))
+        records.append(
+            {
+                "duration": duration,
+                "time_finished": time.time(),
+                "required_gpu_mem": job_request.required_gpu_mem,
+                "required_memory": job_request.required_memory,
+                "peak_gpu_mem": usage.peak_gpu_mem,
+                "peak_memory": usage.peak_memory,
+            }
+        )
+
+    def _values(self, node_name, key):
+        return [
+            record[key]
+            for record in self.records.get(node_name, [])
+            if record[key] is not None
+        ]
+
+    def expected_duration(self, node_name):
+        """Median duration of the recent jobs of a node, or None if it has no history"""
+        if node_name not in self._expected_durations:
+            durations = self._values(node_name, "duration")
+            self._expected_durations[node_name] = (
+                statistics.median(durations) if durations else None
+            )
+        return self._expected_durations[node_name]
+
+    def max_duration(self, node_name):
+        """Longest recent duration of a node. Used where overestimating is the safe choice"""
+        durations = self._values(node_name, "duration")
+        if not durations:
+            return None
+        return max(durations)
+
+    def get_info(self):
+        info = {}
+        for node_name in self.records.keys():
+            peak_gpu_mem = self._values(node_name, "peak_gpu_mem")
+            peak_memory = self._values(node_name, "peak_memory")
+            info[node_name] = {
+                "num_jobs": len(self.records[node_name]),
+                "expected_duration": self.expected_duration(node_name),
+                "max_duration": self.max_duration(node_name),
+                "max_peak_gpu_mem": max(peak_gpu_mem) if peak_gpu_mem else None,
+                "max_peak_memory": max(peak_memory) if peak_memory else None,
+            }
+        return info
+
+
+class FairShare:
+    """Resource use per submitter, decaying with a half-life so that only recent use
+    counts. Use is measured in dominant-resource-seconds (see ResourceQueue)."""
+
+    def __init__(self, half_life=3600):
+        self.half_life = half_life
+        self.usage = {}  # submitter -> (usage, time of last update)
+
+    def _decayed(self, usage, time_updated, now):
+        return usage * 0.5 ** ((now - time_updated) / self.half_life)
+
+    def add(self, submitter, amount, now):
+        self.usage[submitter] = (self.get_usage(submitter, now) + amount, now)
+
+    def get_usage(self, submitter, now):
+        if submitter not in self.usage:
+            return 0
+        return self._decayed(*self.usage[submitter], now)
+
+    def get_all_usage(self, now):
+        return {submitter: self.get_usage(submitter, now) for submitter in self.usage}
+
+
+class ResourceState:
+    """Free resources of the host. Kept separate from the queue so that the
+    schedule can be simulated on a copy."""
+
+    def __init__(self, gpus_mem, threads, memory):
+        self.gpu_devices_mem = list(gpus_mem)
+        # Fraction of each device's compute handed out to jobs that declare a share
+        self.gpu_devices_share = [1.0] * len(self.gpu_devices_mem)
+        self.threads = threads
+        self.memory = memory
+
+    def copy(self):
+        state = ResourceState(self.gpu_devices_mem, self.threads, self.memory)
+        state.gpu_devices_share = list(self.gpu_devices_share)
+        return state
+
+    @staticmethod
+    def from_reservation(num_gpus, gpu_device_ids, job_request):
+        """The resources reserved by a job, which it can lend to its child jobs.
+        Devices outside the reservation are marked as unusable."""
+        state = ResourceState(
+            [
+                job_request.required_gpu_mem if idx in gpu_device_ids else -1
+                for idx in range(num_gpus)
+            ],
+            job_request.required_threads,
+            job_request.required_memory,
+        )
+        state.gpu_devices_share = [
+            job_request.required_gpu_share if idx in gpu_device_ids else -1
+            for idx in range(num_gpus)
+        ]
+        return state
+
+    def get_available_gpu_devices(
+        self,
+        required_gpu_mem,
+        required_num_gpus=1,
+        required_gpu_share=0,
+        required_devices=None,
+    ):
+        """Find required_num_gpus distinct devices that each have required_gpu_mem
+        memory and required_gpu_share compute left. Returns None if the job does not fit,
+        so that multi-GPU jobs are only ever placed on all of their devices at once.
+        required_devices restricts the search to specific devices."""
+        device_ids = []
+        for idx, available_mem in enumerate(self.gpu_devices_mem):
+            if len(device_ids) == required_num_gpus:
+                break
+            if required_devices is not None and idx not in required_devices:
+                continue
+            if (
+                available_mem >= required_gpu_mem
+                and self.gpu_devices_share[idx]
+                >= required_gpu_share - GPU_SHARE_TOLERANCE
+            ):
+                device_ids.append(idx)
+
+        if len(device_ids) < required_num_gpus:
+            return None
+        return device_ids
+
+    def fit(self, job_request):
+        """Returns the devices to run the job on, or None if it does not fit"""
+        if (
+            self.threads < job_request.required_threads
+            or self.memory < job_request.required_memory
+        ):
+            return None
+        return self.get_available_gpu_devices(
+            job_request.required_gpu_mem,
+            job_request.required_num_gpus,
+            job_request.required_gpu_share,
+            job_request.required_devices,
+        )
+
+    def allocate(self, gpu_device_ids, job_request):
+        for gpu_device_id in gpu_device_ids:
+            self.gpu_devices_mem[gpu_device_id] -= job_request.required_gpu_mem
+            self.gpu_devices_share[gpu_device_id] -= job_request.required_gpu_share
+        self.threads -= job_request.required_threads
+        self.memory -= job_request.required_memory
+
+    def release(self, gpu_device_ids, job_request):
+        for gpu_device_id in gpu_device_ids:
+            self.gpu_devices_mem[gpu_device_id] += job_request.required_gpu_mem
+            self.gpu_devices_share[gpu_device_id] += job_request.required_gpu_share
+        self.threads += job_request.required_threads
+        self.memory += job_request.required_memory
+
 
 class ResourceQueue:
-    def __init__(self, available_gpus_mem, available_threads, available_memory):
+    def __init__(
+        self,
+        available_gpus_mem,
+        available_threads,
+        available_memory,
+        backfill=True,
+        history=None,
+        aging_rate=0,
+        fair_share_weight=0,
+        fair_share_half_life=3600,
+    ):
         self.gpu_devices_mem_max = available_gpus_mem.copy()
-        self.gpu_devices_mem_available = available_gpus_mem.copy()
-        self.num_gpus = len(self.gpu_devices_mem_available)
-        self.threads_available = available_threads
-        self.memory_available = available_memory
+        self.num_gpus = len(self.gpu_devices_mem_max)
         self.threads_max = available_threads
         self.memory_max = available_memory
+        self.available = ResourceState(
+            available_gpus_mem, available_threads, available_memory
+        )
+        self.backfill = backfill
+        self.history = history if history is not None else JobHistory()
+        # Priority levels gained per hour of waiting in the queue
+        self.aging_rate = aging_rate
+        # Priority levels lost by a submitter that used all recent resources
+        self.fair_share_weight = fair_share_weight
+        self.fair_share = FairShare(fair_share_half_life)
+        # Entries are (job_request, seq, time_queued), kept in scheduling order
         self.job_queue = []
+        # job_id -> (gpu_device_ids, job_request, time_started)
         self.active_jobs = {}
+        # job_id -> seconds the job was active before it was last started, as
+        # suspended jobs start again
+        self.time_active = {}
+        # Child job_id -> parent job_id, for children running on lent resources
+        self.borrowers = {}
+        # Parent job_id -> ResourceState of what the parent has left to lend
+        self.lenders = {}
+        # job_id -> (gpu_device_ids, job_request) of jobs that released their resources
+        self.suspended = {}
+        # Suspended jobs that are queued to get their resources back
+        self.resumed = set()
+        # Queued jobs dropped because they passed their deadline
+        self.expired = set()
+        self._job_counter = itertools.count()
 
-    def add_job(
-        self, job_id, priority, required_gpu_mem, required_threads, required_memory
-    ):
-        if priority < 1 or priority > 5:
+    @staticmethod
+    def get_node_name(job_request):
+        if job_request.node_name:
+            return job_request.node_name
+        return "_".join(job_request.job_id.split("_")[:-1])
+
+    def expected_duration(self, job_request):
+        return self.history.expected_duration(self.get_node_name(job_request))
+
+    def _default_duration(self):
+        """Stand-in for nodes without history, so they are neither starved nor favoured"""
+        durations = [
+            x["expected_duration"]
+            for x in self.history.get_info().values()
+            if x["expected_duration"] is not None
+        ]
+        return statistics.mean(durations) if durations else 0
+
+    @staticmethod
+    def get_submitter(job_request):
+        return job_request.submitter or ""
+
+    def _dominant_share(self, job_request):
+        """The largest fraction of any one resource of the host that the job reserves"""
+        return max(
+            job_request.required_gpu_mem
+            * job_request.required_num_gpus
+            / max(sum(self.gpu_devices_mem_max), 1),
+            job_request.required_gpu_share
+            * job_request.required_num_gpus
+            / max(self.num_gpus, 1),
+            job_request.required_threads / max(self.threads_max, 1),
+            job_request.required_memory / max(self.memory_max, 1),
+        )
+
+    def get_usage_shares(self, now=None):
+        """Each submitter's fraction of the recent resource use, including running jobs"""
+        now = now if now is not None else time.time()
+        usage = self.fair_share.get_all_usage(now)
+        for _, job_request, time_started in self.active_jobs.values():
+            submitter = self.get_submitter(job_request)
+            usage[submitter] = usage.get(submitter, 0) + self._dominant_share(
+                job_request
+            ) * (now - time_started)
+
+        total = sum(usage.values())
+        if total <= 0:
+            return {}
+        return {submitter: value / total for submitter, value in usage.items()}
+
+    def _priority_adjustments(self, entry, now, usage_shares):
+        """Levels gained by waiting in the queue and levels lost by submitters that
+        recently used more than their share of the host"""
+        job_request, _, time_queued = entry
+        aging = self.aging_rate * (now - time_queued) / 3600
+        penalty = self.fair_share_weight * usage_shares.get(
+            self.get_submitter(job_request), 0
+        )
+        return aging, penalty
+
+    def effective_priority(self, entry, now, usage_shares):
+        """The priority aged by the time spent in the queue, minus a penalty for
+        submitters that recently used more than their share of the host"""
+        aging, penalty = self._priority_adjustments(entry, now, usage_shares)
+        return entry[0].priority + aging - penalty
+
+    def _queue_key(self, entry, now, usage_shares, default_duration):
+        """Higher priority level first, then shortest expected job first, then higher
+        effective priority, then FIFO"""
+        job_request, seq, _ = entry
+        expected_duration = self.expected_duration(job_request)
+        if expected_duration is None:
+            expected_duration = default_duration
+        if job_request.job_id in self.resumed:
+            # A resumed job has a running process waiting for its resources
+            priority_level = math.inf
+        else:
+            # Aging and the fair-share penalty only move a job to another level once
+            # they add up to a whole level, so that a small usage share does not
+            # put a job behind every other job of the same priority
+            aging, penalty = self._priority_adjustments(entry, now, usage_shares)
+            priority_level = (
+                job_request.priority + math.floor(aging) - math.floor(penalty)
+            )
+        return (
+            -priority_level,
+            expected_duration,
+            -self.effective_priority(entry, now, usage_shares),
+            seq,
+        )
+
+    def _sort_queue(self, queue, now):
+        usage_shares = self.get_usage_shares(now)
+        default_duration = self._default_duration()
+        queue.sort(
+            key=lambda entry: self._queue_key(
+                entry, now, usage_shares, default_duration
+            )
+        )
+
+    def add_job(self, job_request: QueueRequest):
+        if job_request.priority < 1 or job_request.priority > 5:
             raise ValueError("Priority must be between 1 and 5.")
 
+        if job_request.required_num_gpus < 0:
+            raise ValueError("Number of GPUs must be non-negative.")
+
+        if job_request.required_gpu_share < 0 or job_request.required_gpu_share > 1:
+            raise ValueError("GPU share must be between 0 and 1.")
+
         if (
-            required_gpu_mem > max(self.gpu_devices_mem_max)
-            or required_threads > self.threads_max
-            or required_memory > self.memory_max
+            job_request.required_num_gpus > self.num_gpus
+            or (
+                job_request.required_num_gpus > 0
+                and job_request.required_gpu_mem > max(self.gpu_devices_mem_max)
+            )
+            or job_request.required_threads > self.threads_max
+            or job_request.required_memory > self.memory_max
         ):
             raise ValueError("Job requirements exceed available resources.")
 
-        heapq.heappush(
-            self.job_queue,
-            (-priority, job_id, required_gpu_mem, required_threads, required_memory),
-        )
+        if job_request.required_devices is not None and (
+            len(job_request.required_devices) != job_request.required_num_gpus
+            or not all(0 <= x < self.num_gpus for x in job_request.required_devices)
+        ):
+            raise ValueError("Invalid required devices.")
+
+        self.job_queue.append((job_request, next(self._job_counter), time.time()))
         self.process_queue()
 
     def process_queue(self):
-        while self.job_queue:
-            (
-                _,
-                job_id,
-                required_gpu_mem,
-                required_threads,
-                required_memory,
-            ) = self.job_queue[0]
-
-            gpu_device_id = self.get_available_gpu_device(required_gpu_mem)
-            if (
-                gpu_device_id is not None
-                and self.threads_available >= required_threads
-                and self.memory_available >= required_memory
-            ):
-                heapq.heappop(self.job_queue)
+        """Start queued jobs in order until one does not fit. If backfilling is enabled,
+        later jobs may still start if history says they end before the blocked job
+        is expected to start, so they never delay it."""
+        now = time.time()
+        self._drop_expired_jobs(now)
+        self._sort_queue(self.job_queue, now)
+
+        # Children running on resources lent by their parent do not compete with
+        # the rest of the queue
+        for entry in list(self.job_queue):
+            self._maybe_start_on_lent_resources(entry, now)
+
+        reserved_start = None
+        for entry in list(self.job_queue):
+            job_request = entry[0]
+            gpu_device_ids = self.available.fit(job_request)
 
-                self.gpu_devices_mem_available[gpu_device_id] -= required_gpu_mem
-                self.threads_available -= required_threads
-                self.memory_available -= required_memory
+            if gpu_device_ids is None:
+                if reserved_start is not None:
+                    continue
+                if not self.backfill:
+                    break
+                reserved_start = self.get_reservations(
+                    now, until_job_id=job_request.job_id
+                ).get(job_request.job_id)
+                if reserved_start is None:
+                    break
+                continue
 
-                self.active_jobs[job_id] = (
-                    gpu_device_id,
-                    required_gpu_mem,
-                    required_threads,
-                    required_memory,
+            if reserved_start is not None:
+                max_duration = self.history.max_duration(
+                    self.get_node_name(job_request)
                 )
-            else:
+                if max_duration is None or now + max_duration > reserved_start:
+                    continue
+
+            self.available.allocate(gpu_device_ids, job_request)
+            self._start(entry, gpu_device_ids, now)
+
+    def _drop_expired_jobs(self, now):
+        """Expired jobs are never started. The node notices via is_job_active.
+        Resumed jobs already started once, so their deadline has been met."""
+        for entry in list(self.job_queue):
+            job_request = entry[0]
+            if job_request.job_id in self.resumed:
+                continue
+            if job_request.deadline is not None and now > job_request.deadline:
+                self.job_queue.remove(entry)
+                self.expired.add(job_request.job_id)
+
+    def _start(self, entry, gpu_device_ids, now):
+        job_request = entry[0]
+        self.job_queue.remove(entry)
+        self.active_jobs[job_request.job_id] = (gpu_device_ids, job_request, now)
+        self.time_active.setdefault(job_request.job_id, 0)
+        self.resumed.discard(job_request.job_id)
+
+    def _maybe_start_on_lent_resources(self, entry, now):
+        job_request = entry[0]
+        if not job_request.borrow or job_request.parent_id not in self.active_jobs:
+            return False
+
+        parent_id = job_request.parent_id
+        if parent_id not in self.lenders:
+            self.lenders[parent_id] = ResourceState.from_reservation(
+                self.num_gpus, *self.active_jobs[parent_id][:2]
+            )
+        gpu_device_ids = self.lenders[parent_id].fit(job_request)
+        if gpu_device_ids is None:
+            return False
+
+        self.lenders[parent_id].allocate(gpu_device_ids, job_request)
+        self.borrowers[job_request.job_id] = parent_id
+        self._start(entry, gpu_device_ids, now)
+        return True
+
+    def _release(self, job_id, now):
+        """Give the resources of an active job back to where they came from"""
+        gpu_device_ids, job_request, time_started = self.active_jobs.pop(job_id)
+        parent_id = self.borrowers.pop(job_id, None)
+        if parent_id is not None:
+            self.lenders[parent_id].release(gpu_device_ids, job_request)
+        else:
+            self.available.release(gpu_device_ids, job_request)
+
+        # Children still running on what this job lent them now count against the host
+        for child_id, lender_id in list(self.borrowers.items()):
+            if lender_id == job_id:
+                child_device_ids, child_request, _ = self.active_jobs[child_id]
+                self.available.allocate(child_device_ids, child_request)
+                del self.borrowers[child_id]
+        self.lenders.pop(job_id, None)
+
+        self.fair_share.add(
+            self.get_submitter(job_request),
+            self._dominant_share(job_request) * (now - time_started),
+            now,
+        )
+
+    def suspend_job(self, job_id):
+        """Release the resources of an active job, e.g. while it waits for child jobs.
+        The job keeps its place in the host and gets the same devices back on resume."""
+        if job_id not in self.active_jobs:
+            raise ValueError("Job is not active.")
+        if job_id in self.borrowers:
+            raise ValueError("Jobs running on lent resources cannot be suspended.")
+
+        gpu_device_ids, job_request, time_started = self.active_jobs[job_id]
+        now = time.time()
+        self._release(job_id, now)
+        self.time_active[job_id] += now - time_started
+        self.suspended[job_id] = (gpu_device_ids, job_request)
+        self.process_queue()
+
+    def resume_job(self, job_id):
+        """Queue a suspended job for its resources again, ahead of all other jobs"""
+        if job_id not in self.suspended:
+            raise ValueError("Job is not suspended.")
+
+        gpu_device_ids, job_request = self.suspended.pop(job_id)
+        resumed_request = job_request.copy(
+            update={
+                "required_devices": gpu_device_ids,
+                "required_num_gpus": len(gpu_device_ids),
+            }
+        )
+        self.resumed.add(job_id)
+        self.job_queue.append((resumed_request, next(self._job_counter), time.time()))
+        self.process_queue()
+
+    def get_reservations(self, now=None, extra_request=None, until_job_id=None):
+        """Simulate the queue in its current order using the expected durations of
+        the jobs. Returns the expected start time of each queued job, or None where
+        it cannot be estimated. extra_request is a hypothetical job that is placed
+        in the queue for the simulation only."""
+        now = now if now is not None else time.time()
+        state = self.available.copy()
+        counter = itertools.count()
+
+        # Expected end times of running jobs. Unknown durations never end.
+        ends = []
+        for job_id, (
+            gpu_device_ids,
+            job_request,
+            time_started,
+        ) in self.active_jobs.items():
+            if job_id in self.borrowers:
+                continue
+            expected_duration = self.expected_duration(job_request)
+            end = (
+                max(time_started + expected_duration, now)
+                if expected_duration is not None
+                else math.inf
+            )
+            heapq.heappush(ends, (end, next(counter), gpu_device_ids, job_request))
+
+        queue = list(self.job_queue)
+        if extra_request is not None:
+            queue.append((extra_request, math.inf, now))
+        self._sort_queue(queue, now)
+
+        reservations = {}
+        t = now
+        for job_request, _, _ in queue:
+            gpu_device_ids = state.fit(job_request)
+            while gpu_device_ids is None and ends and ends[0][0] != math.inf:
+                end, _, released_ids, released_request = heapq.heappop(ends)
+                state.release(released_ids, released_request)
+                t = max(t, end)
+                gpu_device_ids = state.fit(job_request)
+
+            if gpu_device_ids is None:
+                # Everything behind a job with unknown start is unknown as well
+                for remaining_request, _, _ in queue:
+                    reservations.setdefault(remaining_request.job_id, None)
                 break
 
-    def get_available_gpu_device(self, required_gpu_mem):
-        for idx, available_mem in enumerate(self.gpu_devices_mem_available):
-            if available_mem >= required_gpu_mem:
-                return idx
-        return None
+            reservations[job_request.job_id] = t
+            if job_request.job_id == until_job_id:
+                break
+            state.allocate(gpu_device_ids, job_request)
+            expected_duration = self.expected_duration(job_request)
+            end = t + expected_duration if expected_duration is not None else math.inf
+            heapq.heappush(ends, (end, next(counter), gpu_device_ids, job_request))
+
+        return reservations
 
-    def end_job(self, job_id):
+    def predict_wait(self, job_id=None, job_request=None):
+        """Expected start and wait (seconds) of a queued or hypothetical job"""
+        now = time.time()
+        if job_id is not None and job_id in self.active_jobs:
+            _, job_request, time_started = self.active_jobs[job_id]
+            expected_start = time_started
+        else:
+            if job_id is None:
+                job_id = job_request.job_id
+                reservations = self.get_reservations(now, extra_request=job_request)
+            else:
+                job_request = self._get_queued_request(job_id)
+                reservations = self.get_reservations(now, until_job_id=job_id)
+            expected_start = reservations.get(job_id)
+
+        expected_duration = self.expected_duration(job_request)
+        return {
+            "job_id": job_id,
+            "expected_start": expected_start,
+            "expected_wait": (
+                None if expected_start is None else max(expected_start - now, 0)
+            ),
+            "expected_duration": expected_duration,
+            "expected_end": (
+                None
+                if expected_start is None or expected_duration is None
+                else expected_start + expected_duration
+            ),
+        }
+
+    def _get_queued_request(self, job_id):
+        for job_request, _, _ in self.job_queue:
+            if job_request.job_id == job_id:
+                return job_request
+        raise ValueError("Job not found in queue.")
+
+    def end_job(self, job_id, usage=None):
         if job_id in self.active_jobs:
-            (
-                gpu_device_id,
-                required_gpu_mem,
-                required_threads,
-                required_memory,
-            ) = self.active_jobs[job_id]
+            _, job_request, time_started = self.active_jobs[job_id]
+            now = time.time()
+            self._release(job_id, now)
+            # Time spent suspended, e.g. waiting for child jobs, is not counted
+            duration = self.time_active.pop(job_id) + now - time_started
 
-            self.gpu_devices_mem_available[gpu_device_id] += required_gpu_mem
-            self.threads_available += required_threads
-            self.memory_available += required_memory
+            # Only completed jobs say anything about how long a node takes
+            if usage is not None and usage.completed:
+                self.history.record(
+                    self.get_node_name(job_request),
+                    duration,
+                    job_request,
+                    usage,
+                )
+
+        elif job_id in self.suspended:
+            del self.suspended[job_id]
+            self.time_active.pop(job_id, None)
 
-            del self.active_jobs[job_id]
+        elif job_id in self.expired:
+            self.expired.discard(job_id)
+            self.time_active.pop(job_id, None)
 
         else:
             self.remove_job_from_queue(job_id)
+            self.resumed.discard(job_id)
+            self.time_active.pop(job_id, None)
 
         self.process_queue()
 
     def is_job_active(self, job_id):
         if job_id in self.active_jobs:
-            gpu_device_id = self.active_jobs[job_id][0]
-            return True, gpu_device_id
+            gpu_device_ids = self.active_jobs[job_id][0]
+            return True, gpu_device_ids
         else:
             return False, None
 
     def remove_job_from_queue(self, job_id):
         for index, job in enumerate(self.job_queue):
-            if job[1] == job_id:
+            if job[0].job_id == job_id:
                 self.job_queue.pop(index)
-                heapq.heapify(self.job_queue)
                 return True
         raise ValueError("Job not found in queue.")
 
+    def get_queue_depth(self):
+        queued_by_node = {}
+        for job_request, _, _ in self.job_queue:
+            node_name = self.get_node_name(job_request)
+            queued_by_node[node_name] = queued_by_node.get(node_name, 0) + 1
+        return {
+            "queued": len(self.job_queue),
+            "active": len(self.active_jobs),
+            "queued_by_node": queued_by_node,
+        }
+
     def get_resource_info(self):
         return {
             "gpu_devices_mem_available": [
                 x - y
                 for x, y in zip(
-                    self.gpu_devices_mem_max, self.gpu_devices_mem_available
+                    self.gpu_devices_mem_max, self.available.gpu_devices_mem
                 )
             ],
             "gpu_devices_mem_max": self.gpu_devices_mem_max,
-            "threads_available": self.threads_max - self.threads_available,
+            "gpu_devices_share_used": [
+                round(1.0 - x, 3) for x in self.available.gpu_devices_share
+            ],
+            "threads_available": self.threads_max - self.available.threads,
             "threads_max": self.threads_max,
-            "memory_available": self.memory_max - self.memory_available,
+            "memory_available": self.memory_max - self.available.memory,
             "memory_max": self.memory_max,
         }
 
     def get_queued_priorities(self):
-        return [job[0] * -1 for job in self.job_queue]
+        return [job[0].priority for job in self.job_queue]
+
+    def get_queued_jobs_info(self):
+        now = time.time()
+        reservations = self.get_reservations(now)
+        usage_shares = self.get_usage_shares(now)
+        return [
+            {
+                "priority": job_request.priority,
+                "effective_priority": round(
+                    self.effective_priority(
+                        (job_request, seq, time_queued), now, usage_shares
+                    ),
+                    2,
+                ),
+                "submitter": job_request.submitter,
+                "job_id": job_request.job_id,
+                "required_gpu_mem": job_request.required_gpu_mem,
+                "required_num_gpus": job_request.required_num_gpus,
+                "required_gpu_share": job_request.required_gpu_share,
+                "required_threads": job_request.required_threads,
+                "required_memory": job_request.required_memory,
+                "time_queued": time_queued,
+                "expected_duration": self.expected_duration(job_request),
+                "expected_start": reservations.get(job_request.job_id),
+            }
+            for job_request, seq, time_queued in self.job_queue
+        ]
 
     def get_active_jobs_info(self):
         active_jobs_info = []
         for job_id, (
-            gpu_device_id,
-            required_gpu_mem,
-            required_threads,
-            required_memory,
+            gpu_device_ids,
+            job_request,
+            time_started,
         ) in self.active_jobs.items():
             active_jobs_info.append(
                 {
-                    "gpu_device_id": gpu_device_id,
-                    "required_gpu_mem": required_gpu_mem,
-                    "required_threads": required_threads,
-                    "required_memory": required_memory,
+                    "gpu_device_id": gpu_device_ids[0] if gpu_device_ids else None,
+                    "gpu_device_ids": gpu_device_ids,
+                    "required_gpu_mem": job_request.required_gpu_mem,
+                    "required_num_gpus": job_request.required_num_gpus,
+                    "required_gpu_share": job_request.required_gpu_share,
+                    "required_threads": job_request.required_threads,
+                    "required_memory": job_request.required_memory,
+                    "time_started": time_started,
+                    "expected_duration": self.expected_duration(job_request),
+                    "submitter": job_request.submitter,
+                    "lent_by": self.borrowers.get(job_id),
                     "job_id": job_id,
                 }
             )
@@ -166,6 +742,10 @@ class RHManager(FastAPI):
             docs_url="/manager/docs", openapi_url="/manager/api/openapi.json"
         )
         self.nodes = {}
+        # Keys of the results cached by the nodes on this host by node name, and
+        # on the other hosts by address and node name
+        self.cache_indexes = {}
+        self.peer_cache_indexes = {}
         self.other_addrs = self._get_other_hosts()
         self.host_addr = self._get_own_host()
 
@@ -173,6 +753,13 @@ class RHManager(FastAPI):
             available_gpus_mem=[int(x) for x in os.environ["RH_GPU_MEM"].split(",")],
             available_threads=int(os.environ["RH_NUM_THREADS"]),
             available_memory=int(os.environ["RH_MEMORY"]),
+            backfill=os.environ.get("RH_BACKFILL", "1") != "0",
+            aging_rate=float(os.environ.get("RH_PRIORITY_AGING", 0)),
+            fair_share_weight=float(os.environ.get("RH_FAIR_SHARE_WEIGHT", 0)),
+            fair_share_half_life=float(
+                os.environ.get("RH_FAIR_SHARE_HALF_LIFE_HOURS", 1.0)
+            )
+            * 3600,
         )
         self.setup_routes()
 
@@ -188,8 +775,13 @@ class RHManager(FastAPI):
         return node_name in self.nodes.keys()
 
     ## Called by NodeRunner
-    def get_addr_to_run_node(self, node_name):
-        # return node_name
+    def get_addr_to_run_node(self, node_name, cache_key=None):
+        """The address of a host with the node. If the client knows the cache key
+        of the job, a host that likely has the result in its cache is preferred."""
+        if cache_key is not None:
+            addr = self._get_addr_with_cached_result(node_name, cache_key)
+            if addr is not None:
+                return addr
 
         if node_name in self.nodes.keys():
             return "localhost:8000"
@@ -204,6 +796,60 @@ class RHManager(FastAPI):
                 return addr
         raise Exception("No servers were found with the node")
 
+    def _get_addr_with_cached_result(self, node_name, cache_key):
+        """The first host whose node has likely cached the result, or None"""
+        for addr, index in self.get_cache_indexes(node_name).items():
+            if cache_key in index:
+                return addr
+        return None
+
+    def get_cache_indexes(self, node_name):
+        """The cache indexes of the node by the address of its host, this host
+        first. Those of the other hosts are refreshed in the background."""
+        indexes = {}
+        index = self.cache_indexes.get(node_name)
+        if node_name in self.nodes and index is not None:
+            indexes["localhost:8000"] = index
+        for addr in self.other_addrs:
+            index = self.peer_cache_indexes.get(addr, {}).get(node_name)
+            if index is not None:
+                indexes[addr] = index
+        return indexes
+
+    def _fetch_peer_cache_indexes(self, addr):
+        """The cache indexes of the nodes on another host by node name, or {} if
+        the host is down or does not collect them"""
+        try:
+            url = f"http://{addr}/manager/dispatcher/cache_indexes"
+            response = requests.get(url, timeout=5)
+            response.raise_for_status()
+            return {
+                name: CacheKeyFilter(**index) for name, index in response.json().items()
+            }
+        except (requests.RequestException, ValueError):
+            return {}
+
+    async def _refresh_peer_cache_indexes_loop(self, interval=60):
+        """Fetch the cache indexes of the other hosts, so that dispatching a job
+        does not wait for them"""
+        loop = asyncio.get_running_loop()
+        while True:
+            for addr in self.other_addrs:
+                try:
+                    self.peer_cache_indexes[addr] = await loop.run_in_executor(
+                        None, self._fetch_peer_cache_indexes, addr
+                    )
+                except Exception as e:
+                    print("Could not refresh the cache index of", addr, ":", e)
+            await asyncio.sleep(interval)
+
+    async def _process_queue_loop(self, interval=5):
+        """Effective priorities and deadlines change with time, not only when jobs
+        are added or ended"""
+        while True:
+            await asyncio.sleep(interval)
+            self.queue.process_queue()
+
     def setup_routes(self):
         @self.post("/manager/register_node")
         def _register_node(node: NodeMetaData):
@@ -215,35 +861,71 @@ class RHManager(FastAPI):
             return self.has_node(node_name)
 
         @self.get("/manager/dispatcher/get_host/{node_name}")
-        def _get_host_to_run_node(node_name):
-            return self.get_addr_to_run_node(node_name)
+        def _get_host_to_run_node(node_name, cache_key: Union[None, str] = None):
+            return self.get_addr_to_run_node(node_name, cache_key)
+
+        @self.post("/manager/cache_index/{node_name}")
+        def _set_cache_index(node_name: str, index: CacheKeyFilter):
+            """Sent by the nodes on this host with the keys of their cached results"""
+            self.cache_indexes[node_name] = index
+            return "ok"
+
+        @self.get("/manager/dispatcher/cache_indexes")
+        def _get_local_cache_indexes():
+            """Used by the managers on other hosts"""
+            return {
+                name: index
+                for name, index in self.cache_indexes.items()
+                if name in self.nodes
+            }
+
+        @self.get("/manager/dispatcher/cache_indexes/{node_name}")
+        def _get_cache_indexes(node_name: str):
+            """Used by the clients to send jobs to the host that has likely
+            cached their result"""
+            return self.get_cache_indexes(node_name)
 
         @self.post("/manager/add_job")
         async def add_job(job_request: QueueRequest):
             try:
-                self.queue.add_job(
-                    job_request.job_id,
-                    job_request.priority,
-                    job_request.required_gpu_mem,
-                    job_request.required_threads,
-                    job_request.required_memory,
-                )
+                self.queue.add_job(job_request)
             except ValueError as e:
                 raise HTTPException(status_code=400, detail=str(e))
             return {"message": "Job added successfully"}
 
         @self.post("/manager/end_job/{job_id}")
-        async def end_job(job_id: str):
+        async def end_job(job_id: str, usage: JobUsage = None):
             # try:
-            self.queue.end_job(job_id)
+            self.queue.end_job(job_id, usage)
             # except ValueError as e:
             # raise HTTPException(status_code=400, detail=str(e))
             return {"message": "Job ended successfully"}
 
+        @self.post("/manager/suspend_job/{job_id}")
+        async def suspend_job(job_id: str):
+            try:
+                self.queue.suspend_job(job_id)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return {"message": "Job suspended successfully"}
+
+        @self.post("/manager/resume_job/{job_id}")
+        async def resume_job(job_id: str):
+            try:
+                self.queue.resume_job(job_id)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return {"message": "Job resumed successfully"}
+
         @self.get("/manager/is_job_active/{job_id}")
         async def is_job_active(job_id: str):
-            is_active, gpu_device_id = self.queue.is_job_active(job_id)
-            return {"is_active": is_active, "gpu_device_id": gpu_device_id}
+            is_active, gpu_device_ids = self.queue.is_job_active(job_id)
+            return {
+                "is_active": is_active,
+                "gpu_device_id": gpu_device_ids[0] if gpu_device_ids else None,
+                "gpu_device_ids": gpu_device_ids,
+                "expired": job_id in self.queue.expired,
+            }
 
         @self.get("/manager/get_active_jobs")
         async def get_active_jobs():
@@ -251,18 +933,30 @@ class RHManager(FastAPI):
 
         @self.get("/manager/get_queued_jobs")
         async def get_queued_jobs():
-            return {
-                "queued_jobs": [
-                    {
-                        "priority": job[0] * -1,
-                        "job_id": job[1],
-                        "required_gpu_mem": job[2],
-                        "required_threads": job[3],
-                        "required_memory": job[4],
-                    }
-                    for job in self.queue.job_queue
-                ]
-            }
+            return {"queued_jobs": self.queue.get_queued_jobs_info()}
+
+        @self.get("/manager/get_queue_depth")
+        async def get_queue_depth():
+            return self.queue.get_queue_depth()
+
+        @self.get("/manager/get_job_history")
+        async def get_job_history():
+            return self.queue.history.get_info()
+
+        @self.get("/manager/get_fair_share")
+        async def get_fair_share():
+            return self.queue.get_usage_shares()
+
+        @self.get("/manager/predict_wait/{job_id}")
+        async def predict_wait(job_id: str):
+            try:
+                return self.queue.predict_wait(job_id=job_id)
+            except ValueError as e:
+                raise HTTPException(status_code=404, detail=str(e))
+
+        @self.post("/manager/predict_wait")
+        async def predict_wait_for_request(job_request: QueueRequest):
+            return self.queue.predict_wait(job_request=job_request)
 
         @self.get("/manager/get_resource_info")
         async def get_resource_info():
@@ -276,6 +970,12 @@ class RHManager(FastAPI):
         async def host_name():
             return self.host_addr.split(":")[0]
 
+        @self.on_event("startup")
+        async def start_queue_loop():
+            asyncio.create_task(self._process_queue_loop())
+            if self.other_addrs:
+                asyncio.create_task(self._refresh_peer_cache_indexes_loop())
+
         @self.get("/")
         async def redirect_to_manager(request: Request):
             return RedirectResponse(url="/manager")
@@ -283,16 +983,7 @@ class RHManager(FastAPI):
         @self.get("/manager")
         async def resource_queue(request: Request):
             active_jobs = self.queue.get_active_jobs_info()
-            queued_jobs = [
-                {
-                    "priority": job[0] * -1,
-                    "job_id": job[1],
-                    "required_gpu_mem": job[2],
-                    "required_threads": job[3],
-                    "required_memory": job[4],
-                }
-                for job in self.queue.job_queue
-            ]
+            queued_jobs = self.queue.get_queued_jobs_info()
             available_resources = self.queue.get_resource_info()
 
             for active_job in active_jobs:
@@ -302,6 +993,19 @@ class RHManager(FastAPI):
             for queued_job in queued_jobs:
                 splits = queued_job["job_id"].split("_")
                 queued_job["href"] = "/" + "_".join(splits[:-1]) + "/jobs/" + splits[-1]
+                queued_job["expected_wait"] = _format_seconds(
+                    None
+                    if queued_job["expected_start"] is None
+                    else max(queued_job["expected_start"] - time.time(), 0)
+                )
+
+            job_history = [
+                {"name": name, **info}
+                for name, info in self.queue.history.get_info().items()
+            ]
+            for info in job_history:
+                info["expected_duration"] = _format_seconds(info["expected_duration"])
+                info["max_duration"] = _format_seconds(info["max_duration"])
 
             host_name = self.host_addr.split(":")[0]
             other_managers = [
@@ -309,14 +1013,20 @@ class RHManager(FastAPI):
                 for addr in self.other_addrs
             ]
             gpu_info = []
-            for i, (gpu_available, gpu_max) in enumerate(
+            for i, (gpu_available, gpu_max, gpu_share) in enumerate(
                 zip(
                     available_resources["gpu_devices_mem_available"],
                     available_resources["gpu_devices_mem_max"],
+                    available_resources["gpu_devices_share_used"],
                 )
             ):
                 gpu_info.append(
-                    {"id": i, "mem_available": gpu_available, "mem_max": gpu_max}
+                    {
+                        "id": i,
+                        "mem_available": gpu_available,
+                        "mem_max": gpu_max,
+                        "share_used": gpu_share,
+                    }
                 )
             nodes = self.nodes.values()
             return templates.TemplateResponse(
@@ -333,10 +1043,17 @@ class RHManager(FastAPI):
                     "memory_max": available_resources["memory_max"],
                     "memory_available": available_resources["memory_available"],
                     "nodes": nodes,
+                    "job_history": job_history,
                     "rhnode_version": __version__,
                     "rhnode_mode": os.environ.get("RH_MODE", ""),
                 },
             )
 
 
+def _format_seconds(seconds):
+    if seconds is None:
+        return "unknown"
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
 app = RHManager()
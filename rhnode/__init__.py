@@ -1,8 +1,10 @@
 try:
     from .rhnode import RHNode
     from .rhjob import RHJob
+    from .async_rhjob import AsyncRHJob
+    from .pipeline import Pipeline
 
 except ImportError:
     pass
 
-__all__ = ["RHNode", "RHJob"]
+__all__ = ["RHNode", "RHJob", "AsyncRHJob", "Pipeline"]
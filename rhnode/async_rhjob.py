@@ -0,0 +1,515 @@
+"""Asyncio client for RHNode.
+
+AsyncRHJob takes the same arguments as RHJob and behaves the same, but start,
+wait_for_finish and stop are coroutines. One event loop can therefore drive many
+jobs, e.g. with asyncio.gather, and a node with an `async def process` function
+can start child jobs without blocking:
+
+    job = AsyncRHJob("add", {"scalar": 1, "in_file": "mr.nii.gz"})
+    await job.start()
+    output = await job.wait_for_finish()
+"""
+
+import asyncio
+import hashlib
+import io
+import queue
+import weakref
+from contextlib import ExitStack
+import httpx
+from .rhjob import (
+    RHJob,
+    MANAGER_ENDPOINTS,
+    DOWNLOAD_CHUNK_SIZE,
+    _started_jobs,
+    _job_error,
+    _is_download_link,
+    _check_download,
+    _suspend_parent_resources,
+)
+from .client import client_context
+from .common import *
+
+# Event loop -> httpx.AsyncClient. A client can only be used from its own loop.
+_clients = weakref.WeakKeyDictionary()
+
+# (event loop, host, port, node name) -> _StatusBatcher
+_batchers = weakref.WeakValueDictionary()
+
+
+def _get_client():
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(timeout=None)
+        _clients[loop] = client
+    return client
+
+
+class _StatusBatcher:
+    """Combines the status requests of all jobs of a node that wait in the same
+    event loop into one request to the bulk status endpoint"""
+
+    def __init__(self, host, port, node_name):
+        self.url = f"http://{host}:{port}/{node_name}/jobs/status"
+        self.waiting = {}  # job ID -> futures
+        self.task = None
+
+    async def get_status(self, job_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(job_id, []).append(future)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._request())
+        return await future
+
+    async def _request(self):
+        # Give the other waiting jobs a moment to ask as well
+        await asyncio.sleep(0.05)
+        waiting, self.waiting = self.waiting, {}
+        try:
+            response = await _get_client().post(self.url, json=list(waiting))
+            response.raise_for_status()
+            statuses = response.json()["jobs"]
+        except Exception as e:
+            for futures in waiting.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for job_id, futures in waiting.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(statuses.get(job_id))
+
+
+class _ChunkReader(io.RawIOBase):
+    """File object that reads the chunks the event loop puts in its queue, so
+    that a blocking reader in another thread can consume an async stream. None
+    marks the end of the stream. Waiting longer than timeout seconds for a chunk
+    raises an error, so the reader never blocks forever if the loop stops feeding."""
+
+    def __init__(self, timeout=300):
+        self.queue = queue.Queue(maxsize=16)
+        self.buffer = b""
+        self.timeout = timeout
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            try:
+                chunk = self.queue.get(timeout=self.timeout)
+            except queue.Empty:
+                raise IOError("Timed out waiting for the download stream")
+            if chunk is None:
+                return 0
+            self.buffer = chunk
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+class AsyncRHJob(RHJob):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        assert not self._cli_mode, "AsyncRHJob does not support _cli_mode"
+
+    def _set_manager(self, manager_address):
+        # The manager is looked up in start, without blocking the event loop
+        self._manager_address = manager_address
+        self.manager_host = None
+        self.manager_port = None
+
+    async def _resolve_manager(self):
+        if self.manager_host is not None:
+            return
+        if self._manager_address is not None:
+            self.manager_host, self.manager_port = self._manager_address.split(":")
+        else:
+            self.manager_host, self.manager_port = await client_context.aget_manager(
+                MANAGER_ENDPOINTS, self._find_manager_endpoint
+            )
+
+    async def _find_manager_endpoint(self):
+        for host, port in MANAGER_ENDPOINTS:
+            print("Looking for manager at", ":".join([host, port]), "...")
+            try:
+                url = f"http://{host}:{port}/manager/ping"
+                response = await _get_client().get(url, timeout=1)
+                if response.status_code == 200:
+                    print("Manager found at", ":".join([host, port]), "...")
+                    return host, port
+            except (httpx.HTTPError, ValueError):
+                pass
+        raise Exception("No responsive manager endpoint found in the provided options.")
+
+    async def _get_addr_for_job(self, node):
+        await self._resolve_manager()
+        self._address_from_manager = True
+        return await client_context.aget_node_address(
+            self.manager_host,
+            self.manager_port,
+            node,
+            lambda: self._fetch_addr_for_job(node),
+        )
+
+    async def _fetch_addr_for_job(self, node):
+        url = f"http://{self.manager_host}:{self.manager_port}/manager/dispatcher/get_host/{node}"
+        response = await _get_client().get(url)
+        response.raise_for_status()
+        return tuple(self._parse_endpoint(response.json()).split(":"))
+
+    async def _get_addr_with_cached_result(self, schema):
+        indexes = await client_context.aget_cache_indexes(
+            self.manager_host,
+            self.manager_port,
+            self.node_identifier,
+            self._fetch_cache_indexes,
+        )
+        if not indexes:
+            return None
+        # Hashing the input files blocks
+        loop = asyncio.get_running_loop()
+        cache_key = await loop.run_in_executor(None, self._get_cache_key, schema)
+        return self._find_cached_result(indexes, cache_key)
+
+    async def _fetch_cache_indexes(self):
+        url = f"http://{self.manager_host}:{self.manager_port}/manager/dispatcher/cache_indexes/{self.node_identifier}"
+        try:
+            response = await _get_client().get(url)
+            response.raise_for_status()
+            return {
+                addr: CacheKeyFilter(**index) for addr, index in response.json().items()
+            }
+        except (httpx.HTTPError, ValueError):
+            return {}
+
+    async def _get_schema(self):
+        return await client_context.aget_schema(
+            self.host, self.port, self.node_identifier, self._fetch_schema
+        )
+
+    async def _fetch_schema(self):
+        client = _get_client()
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/schema"
+        response = await client.get(url)
+        if response.status_code == 404:
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/keys"
+            response = await client.get(url)
+            response.raise_for_status()
+            schema = response.json()
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/filename_keys"
+            response = await client.get(url)
+            response.raise_for_status()
+            schema["file_keys"] = response.json()
+            schema["legacy"] = True
+        else:
+            response.raise_for_status()
+            schema = response.json()
+            schema["legacy"] = False
+        return schema
+
+    def _forget_node(self, error):
+        if isinstance(error, httpx.ConnectError):
+            if not self._address_from_manager:
+                return False
+        elif isinstance(error, httpx.HTTPStatusError):
+            version = error.response.headers.get(SCHEMA_VERSION_HEADER)
+            if not client_context.schema_is_stale(
+                self.host, self.port, self.node_identifier, version
+            ):
+                return False
+        elif not isinstance(error, InputKeyError):
+            return False
+        client_context.invalidate_node(self.host, self.port, self.node_identifier)
+        return True
+
+    async def start(self):
+        try:
+            await self._start()
+        except Exception as e:
+            if self.ID is not None:
+                raise
+            if self._upload_required(e):
+                print(
+                    "The node cannot use the files without upload, uploading instead..."
+                )
+                self._upload_inputs = True
+            # The node may have moved or changed since it was cached
+            elif self._forget_node(e):
+                print("Cached node information is outdated, retrying...")
+                if self._address_from_manager:
+                    self.host, self.port = None, None
+            else:
+                raise
+            await self._start()
+
+    async def _start(self):
+        assert self.ID is None, "Already started"
+
+        if not self.host:
+            self.host, self.port = await self._get_addr_for_job(self.node_identifier)
+
+        schema = await self._get_schema()
+        input_data_not_files, input_data_files = self._split_inputs(schema)
+        if self._address_from_manager and self.job.check_cache:
+            addr = await self._get_addr_with_cached_result(schema)
+            if addr is not None and addr != (self.host, self.port):
+                self.host, self.port = addr
+                schema = await self._get_schema()
+                input_data_not_files, input_data_files = self._split_inputs(schema)
+
+        client = _get_client()
+        if schema["legacy"]:
+            await self._create_upload_and_start(
+                client, input_data_not_files, input_data_files
+            )
+        else:
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/submit"
+            print(f"Submitting new job to {self.host}:{self.port}")
+            # Hashing the input files blocks
+            loop = asyncio.get_running_loop()
+            digests = await loop.run_in_executor(
+                None, self._upload_digests, input_data_files
+            )
+            known_blobs = await self._known_blobs(set(digests.values()))
+            with ExitStack() as stack:
+                files = await loop.run_in_executor(
+                    None,
+                    self._form_fields,
+                    stack,
+                    input_data_not_files,
+                    input_data_files,
+                    "",
+                    known_blobs,
+                )
+                response = await client.post(url, files=files)
+            response.raise_for_status()
+            self.ID = response.json()
+        self._started()
+
+    async def _known_blobs(self, digests):
+        if not digests or self._upload_inputs:
+            return set()
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/blobs/has"
+        try:
+            response = await _get_client().post(url, json=sorted(digests))
+            response.raise_for_status()
+            return set(response.json())
+        except httpx.HTTPError:
+            return set()
+
+    async def _create_upload_and_start(
+        self, client, input_data_not_files, input_data_files
+    ):
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs"
+        print(f"Creating new job on {self.host}:{self.port}")
+        response = await client.post(url, json=input_data_not_files)
+        response.raise_for_status()
+        self.ID = response.json()
+
+        for key, value in input_data_files.items():
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/upload"
+            with open(value, "rb") as f:
+                print(f"Uploading file to {self.host}:{self.port}:", key, ":", value)
+                response = await client.post(url, files={"file": f}, data={"key": key})
+                response.raise_for_status()
+
+        print(f"Starting job on {self.host}:{self.port} with ID:", self.ID)
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/start"
+        response = await client.post(url, content=self.job.json())
+        response.raise_for_status()
+
+    async def _get_status(self):
+        schema = await self._get_schema()
+        if schema["legacy"]:
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/status"
+            response = await _get_client().get(url)
+            response.raise_for_status()
+            return response.json()
+
+        key = (asyncio.get_running_loop(), self.host, self.port, self.node_identifier)
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = _StatusBatcher(self.host, self.port, self.node_identifier)
+            _batchers[key] = batcher
+        status = await batcher.get_status(self.ID)
+        if status is None:
+            raise JobFailedError("The job is unknown to the node")
+        return status
+
+    async def _poll(self, status=None):
+        if status is None:
+            status = JobStatus(await self._get_status())
+        client = _get_client()
+        if status == JobStatus.Finished:
+            _started_jobs.discard(self)
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/data"
+            response = await client.get(url)
+            response.raise_for_status()
+            return status, response.json()
+        elif status in [JobStatus.Error, JobStatus.Cancelled]:
+            _started_jobs.discard(self)
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/error"
+            response = await client.get(url)
+            response.raise_for_status()
+            raise _job_error(status, response.json())
+        return status, None
+
+    async def wait_for_finish(self, download=True):
+        assert self.ID is not None, "Not started"
+        if self.parent_job is None or self.parent_job.queue_id is None:
+            return await self._wait_for_finish(download)
+
+        # Suspending and resuming the parent's resources blocks, so it runs in a thread
+        loop = asyncio.get_running_loop()
+        suspended = _suspend_parent_resources(self.parent_job)
+        await loop.run_in_executor(None, suspended.__enter__)
+        try:
+            output = await self._wait_for_finish(download)
+        except BaseException as e:
+            await loop.run_in_executor(
+                None, suspended.__exit__, type(e), e, e.__traceback__
+            )
+            raise
+        await loop.run_in_executor(None, suspended.__exit__, None, None, None)
+        return output
+
+    async def _wait_for_finish(self, download=True):
+        output = None
+        while output is None:
+            status, output = await self._poll()
+            if status == JobStatus.Queued:
+                await asyncio.sleep(10)
+            elif status == JobStatus.Running:
+                await asyncio.sleep(4)
+            elif output is None:
+                await asyncio.sleep(1)
+
+        if not download:
+            return self._reference_outputs(output)
+        return await self._download_outputs(output)
+
+    async def _get_output_paths(self):
+        if not self.shared_storage or not self._shared_roots:
+            return {}
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/paths"
+        response = await _get_client().get(url)
+        response.raise_for_status()
+        return response.json()
+
+    async def _get_output_digests(self):
+        if not self._send_digests:
+            return {}
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/digests"
+        response = await _get_client().get(url)
+        response.raise_for_status()
+        return response.json()
+
+    async def _download_outputs(self, output):
+        output_path = self._get_output_path()
+        client = _get_client()
+
+        # Linking or copying the files, and checking their digests, blocks
+        loop = asyncio.get_running_loop()
+        paths = await self._get_output_paths()
+        linked = await loop.run_in_executor(
+            None, self._link_outputs, output, paths, output_path
+        )
+        if any(_is_download_link(output[key]) for key in output if key not in linked):
+            digests = await self._get_output_digests()
+            linked = linked | await loop.run_in_executor(
+                None, self._reuse_local_outputs, output, digests, output_path
+            )
+
+        keys = [
+            key
+            for key, value in output.items()
+            if key not in linked and _is_download_link(value)
+        ]
+        if self._archive_download and keys:
+            linked = linked | await self._download_archive(output, keys, output_path)
+
+        for key, value in output.items():
+            if key in linked:
+                continue
+            if _is_download_link(value):
+                print("Downloading", key, "...")
+                url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/download/{key}"
+
+                async with client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    fname = self._get_download_path(key, response.headers, output_path)
+                    hash_object = hashlib.sha256()
+                    with open(fname, "wb") as f:
+                        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            hash_object.update(chunk)
+                            f.write(chunk)
+                _check_download(
+                    fname, response.headers.get(DIGEST_HEADER), hash_object.hexdigest()
+                )
+                output[key] = fname
+
+            else:
+                self._save_non_file(key, value, output_path)
+
+        return output
+
+    async def _download_archive(self, output, keys, output_path):
+        # The archive is extracted in a thread while it is streamed
+        reader = _ChunkReader()
+        extract = asyncio.get_running_loop().run_in_executor(
+            None, self._extract_archive, reader, output, output_path
+        )
+
+        async def feed(chunk):
+            # Stop feeding if the extraction failed, instead of blocking
+            while not extract.done():
+                try:
+                    reader.queue.put_nowait(chunk)
+                    return
+                except queue.Full:
+                    await asyncio.sleep(0.01)
+
+        try:
+            async with _get_client().stream(
+                "GET", self._get_archive_url(keys)
+            ) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await feed(chunk)
+                    if extract.done():
+                        break
+        except BaseException:
+            # The extraction then fails on the truncated stream; raise the cause
+            await feed(None)
+            await asyncio.gather(extract, return_exceptions=True)
+            raise
+        await feed(None)
+        return await extract
+
+    async def stop(self, wait=True):
+        assert self.ID is not None, "Not started"
+        print("Stopping", self.ID, "...")
+        client = _get_client()
+        url = (
+            f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/stop"
+        )
+        response = await client.post(url)
+        response.raise_for_status()
+        _started_jobs.discard(self)
+
+        if not wait:
+            return
+
+        for i in range(10):
+            print("Trying to stop job...")
+            if JobStatus(await self._get_status()) == JobStatus.Cancelled:
+                print("Stopped", self.ID)
+                return
+            await asyncio.sleep(3)
+
+        raise Exception("Could not stop job")
@@ -0,0 +1,156 @@
+"""Content-addressed storage of the files of a node"""
+
+import fcntl
+import os
+import stat
+import time
+import uuid
+import shutil
+from pathlib import Path
+
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, or copy it if they are on different filesystems.
+    Used as copy_function of shutil.copytree."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+# ioctl that makes a file share the data of another until either is written to
+FICLONE = 0x40049409
+
+
+def clone_or_copy(src, dst):
+    """Copy src to dst, as a reflink where the filesystem supports it (e.g. btrfs
+    and XFS), so that the copy takes no time or space. Unlike a hardlink, writing
+    to dst does not change src."""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        shutil.copyfile(src, dst)
+    return dst
+
+
+class BlobStore:
+    """Stores each distinct file content once, as a blob named by its SHA-256.
+    Input, output and cache files of the node are hardlinks to their blob, so
+    a file used by many jobs takes up space and is written only once. Blobs
+    are read-only, as all of their links share the content. Permissions do not
+    stop root, so a blob is checked against its digest before it is reused, and
+    discarded if it was written to in place through one of its links. The check
+    only hashes blobs that changed since they were last hashed.
+
+    The link count of a blob is its reference count. Blobs only linked from
+    the store are removed by collect_garbage once they have been unreferenced
+    for grace_period seconds, which lets a file be reused shortly after the
+    last job using it was deleted. The store must be on the same filesystem as
+    the input, output and cache directories of the node, otherwise files are
+    kept as they are."""
+
+    def __init__(self, directory, digests, grace_period=3600):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.digests = digests  # DigestIndex told about every stored file
+        self.grace_period = grace_period
+
+    def _blob_path(self, digest):
+        return self.directory / digest[:2] / digest
+
+    def _is_intact(self, blob, digest):
+        """False, and the blob is discarded, if its content no longer matches"""
+        if self.digests.digest(blob) == digest:
+            return True
+        print("Discarding blob", digest, "as it was modified in place")
+        os.remove(blob)
+        return False
+
+    def find(self, digest):
+        """The path of the blob with the digest, or None"""
+        path = self._blob_path(digest)
+        try:
+            if path.is_file() and self._is_intact(path, digest):
+                return path
+        except FileNotFoundError:
+            pass
+        return None
+
+    def _make_blob(self, path, blob):
+        os.link(path, blob)
+        mode = stat.S_IMODE(os.stat(blob).st_mode)
+        os.chmod(blob, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def add(self, path, digest):
+        """Store the file at path. If a blob with the digest exists, path is
+        replaced by a link to it, otherwise path becomes the blob."""
+        path = Path(path)
+        blob = self._blob_path(digest)
+        blob.parent.mkdir(exist_ok=True)
+        try:
+            try:
+                self._make_blob(path, blob)
+            except FileExistsError:
+                if os.path.samefile(path, blob):
+                    pass
+                elif self._is_intact(blob, digest):
+                    tmp = path.with_name(f".{uuid.uuid4().hex}.{path.name}")
+                    os.link(blob, tmp)
+                    os.replace(tmp, path)
+                else:
+                    self._make_blob(path, blob)
+        except OSError as e:
+            # E.g. the store is on another filesystem, or the blob was collected
+            print("Could not store", path, "in the blob store:", e)
+            return path
+        self.digests.add(path, digest)
+        return path
+
+    def add_tree(self, directory):
+        """Store all files in directory, hashing those with unknown digest"""
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                path = Path(root, file)
+                self.add(path, self.digests.digest(path))
+
+    def discard(self, path, digest):
+        """Remove the blob with the digest if path is a link to it, e.g. because
+        path turned out to be corrupted"""
+        blob = self._blob_path(digest)
+        try:
+            if os.path.samefile(path, blob):
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+
+    def collect_garbage(self):
+        """Remove unreferenced blobs. Returns the number of blobs and bytes freed."""
+        removed, freed = 0, 0
+        now = time.time()
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                    # ctime changes when a link to the blob is added or removed
+                    if st.st_nlink == 1 and now - st.st_ctime > self.grace_period:
+                        os.remove(path)
+                        removed += 1
+                        freed += st.st_size
+                except FileNotFoundError:
+                    pass
+        return removed, freed
+
+    def usage(self):
+        """Number of blobs and bytes stored"""
+        count, size = 0, 0
+        for root, dirs, files in os.walk(self.directory):
+            for file in files:
+                try:
+                    size += os.stat(os.path.join(root, file)).st_size
+                    count += 1
+                except FileNotFoundError:
+                    pass
+        return count, size
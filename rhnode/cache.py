@@ -1,26 +1,68 @@
 from pydantic import BaseModel, FilePath
+from .common import (
+    is_output_path,
+    hash_cache_key_value,
+    combine_cache_key,
+    is_relative_to,
+    CacheKeyFilter,
+)
+from .blobstore import link_or_copy
 import os
 import hashlib
 import os
 import time
+import uuid
+import errno
+import fcntl
 import shutil
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
+import json
+import re
+import tarfile
 
 CACHE_FILE_FOLDER = "files"
 CACHE_JSON_FNAME = "response.json"
 CACHE_LAST_ACCESSED_FNAME = "last_accessed.txt"
+CACHE_SIZE_FNAME = "size.txt"
+CACHE_MANIFEST_FNAME = "manifest.json"  # Size and SHA-256 of each file
+CACHE_DURATION_FNAME = "duration.txt"  # Seconds it took to compute the result
+CACHE_PINNED_FNAME = "pinned"  # The entry is not evicted while this exists
+CACHE_LOCK_FNAME = "lock"  # Locked shared while the entry is read
+CACHE_STAGING_PREFIX = "."  # Entries being written or removed
+# Files of an entry sent to other nodes, besides the files folder
+CACHE_EXPORTED_FNAMES = [
+    CACHE_JSON_FNAME,
+    CACHE_MANIFEST_FNAME,
+    CACHE_SIZE_FNAME,
+    CACHE_DURATION_FNAME,
+]
 
 
-def _calculate_file_hash(file_path):
+class UnsafeCacheEntryError(Exception):
+    """An imported cache entry refers to files outside of the entry"""
+
+    pass
+
+
+def is_cache_key(name):
+    return re.fullmatch("[0-9a-f]{64}", name) is not None
+
+
+def _calculate_file_hash(file_path, throttle=None):
     # Create a hash object using the SHA-256 algorithm
     hash_object = hashlib.sha256()
 
     # Open the file in binary mode
     with open(file_path, "rb") as f:
         # Read the file in chunks to conserve memory
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
             # Update the hash object with the contents of the chunk
             hash_object.update(chunk)
+            if throttle is not None:
+                throttle.wait(len(chunk))
 
     # Get the hexadecimal representation of the hash
     file_hash = hash_object.hexdigest()
@@ -28,34 +70,337 @@ def _calculate_file_hash(file_path):
     return file_hash
 
 
+class _Throttle:
+    """Limits the rate at which bytes are read, by sleeping as they are counted"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.start = time.monotonic()
+        self.bytes = 0
+
+    def wait(self, num_bytes):
+        if not self.bytes_per_second:
+            return
+        self.bytes += num_bytes
+        delay = self.bytes / self.bytes_per_second - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DigestIndex:
+    """Remembers the SHA-256 of files, and where files with a given digest can be
+    found. Entries are checked against the size, modification time and inode of
+    the file, so changed or deleted files are not trusted."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._by_path = {}  # path -> (stat key, digest)
+        self._by_digest = {}  # digest -> set of paths
+
+    @staticmethod
+    def _stat_key(path):
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def _lookup(self, path):
+        with self._lock:
+            entry = self._by_path.get(path)
+        try:
+            if entry is not None and entry[0] == self._stat_key(path):
+                return entry[1]
+        except OSError:
+            pass
+        return None
+
+    def add(self, path, digest):
+        """Record the digest of a file, e.g. one computed while it was written"""
+        path = str(Path(path).absolute())
+        stat_key = self._stat_key(path)
+        with self._lock:
+            old = self._by_path.pop(path, None)
+            if old is not None:
+                self._by_digest.get(old[1], set()).discard(path)
+            self._by_path[path] = (stat_key, digest)
+            self._by_digest.setdefault(digest, set()).add(path)
+            while len(self._by_path) > self.max_entries:
+                oldest = next(iter(self._by_path))
+                _, oldest_digest = self._by_path.pop(oldest)
+                self._by_digest.get(oldest_digest, set()).discard(oldest)
+        return digest
+
+    def digest(self, path):
+        """The SHA-256 of the file, computed only if it is not known"""
+        path = str(Path(path).absolute())
+        digest = self._lookup(path)
+        if digest is None:
+            digest = self.add(path, _calculate_file_hash(path))
+        return digest
+
+    def find(self, digest):
+        """A path of an unchanged file with the digest, or None"""
+        with self._lock:
+            paths = list(self._by_digest.get(digest, ()))
+        for path in paths:
+            if self._lookup(path) == digest:
+                return Path(path)
+        return None
+
+
+class CacheBackend(ABC):
+    """A second tier of the cache, shared by the nodes of a cluster. Cache looks
+    up entries in it after a local miss and copies them into the local cache,
+    and writes the entries it saves through to it. Entries are exchanged as
+    directories with the files of a local entry listed in CACHE_EXPORTED_FNAMES
+    and its files folder."""
+
+    @abstractmethod
+    def fetch(self, cache_key, directory):
+        """Copy the entry into directory, which does not exist yet. Returns
+        False if there is no such entry."""
+
+    @abstractmethod
+    def store(self, cache_key, entry_dir):
+        """Add the entry in entry_dir, unless the key is stored already"""
+
+    @abstractmethod
+    def remove(self, cache_key):
+        """Remove the entry. Returns False if there is no such entry."""
+
+
+class DirectoryCacheBackend(CacheBackend):
+    """Keeps the shared entries in a directory, e.g. on a network filesystem
+    mounted by all hosts. Entries are written to a staging directory and renamed
+    into place, and are never evicted by the nodes. Only the files folder is
+    linked, as the nodes rewrite the other files of an entry. The modification time of
+    their last_accessed.txt is updated when they are fetched, so that unused
+    entries can be removed by e.g. a cron job."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def fetch(self, cache_key, directory):
+        entry_dir = self.directory / cache_key
+        if not entry_dir.is_dir():
+            return False
+        shutil.copytree(entry_dir, directory, copy_function=_entry_copy_function(entry_dir))
+        try:
+            Path(entry_dir, CACHE_LAST_ACCESSED_FNAME).touch()
+        except OSError:
+            pass
+        return True
+
+    def store(self, cache_key, entry_dir):
+        if os.path.exists(self.directory / cache_key):
+            return
+        staging_dir = self.directory / f"{CACHE_STAGING_PREFIX}{uuid.uuid4().hex}"
+        shared = CACHE_EXPORTED_FNAMES + [CACHE_FILE_FOLDER, CACHE_LAST_ACCESSED_FNAME]
+        try:
+            shutil.copytree(
+                entry_dir,
+                staging_dir,
+                copy_function=_entry_copy_function(entry_dir),
+                ignore=lambda root, names: [
+                    name
+                    for name in names
+                    if Path(root) == Path(entry_dir) and name not in shared
+                ],
+            )
+            os.rename(staging_dir, self.directory / cache_key)
+        except OSError as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+    def remove(self, cache_key):
+        trash = self.directory / f"{CACHE_STAGING_PREFIX}removed-{uuid.uuid4().hex}"
+        try:
+            os.rename(self.directory / cache_key, trash)
+        except FileNotFoundError:
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
+
+
 class Cache:
-    def __init__(self, cache_directory, output_spec, input_spec, cache_size=3):
-        self.cache_directory = cache_directory
-        if not os.path.exists(self.cache_directory):
-            os.mkdir(self.cache_directory)
+    """Stores the outputs of jobs by a hash of their inputs. The cache can be
+    spread over several directories, e.g. one per disk. Each entry is placed in
+    one of them by rendezvous hashing of its key, so entries spread evenly over
+    the directories, a lookup only checks the directories in order of preference,
+    and adding or removing a directory only moves the entries placed in it. Each
+    directory keeps at most cache_size entries (None for no limit), and at most
+    max_gb GB if given (one number for all directories, or a list with one per
+    directory).
+
+    Jobs and nodes may share the cache directories. Entries are written to a
+    staging directory that is renamed into place when complete, so they are
+    seen complete or not at all. Readers hold a shared lock on the entry, and
+    entries are only evicted when no job is reading them.
+
+    The size and SHA-256 of each file are saved with the entry. Loads only check
+    the sizes, while scrub verifies the digests in the background. digests is
+    a DigestIndex used to avoid hashing output files again when they are saved.
+
+    shared is an optional CacheBackend shared with other nodes. Local misses
+    are looked up in it, and found entries are checked and copied to the local
+    cache. Saved entries are written through to it.
+
+    counters holds the number of hits (of which shared_hits were found in the
+    shared cache), misses, saves, evictions, invalidations, corrupted and
+    imported entries, and the compute time saved by hits, since the node
+    started. Pinned entries are never evicted, but count towards the limits."""
+
+    def __init__(
+        self,
+        cache_directory,
+        output_spec,
+        input_spec,
+        cache_size=3,
+        max_gb=None,
+        version=None,
+        digests=None,
+        shared=None,
+    ):
+        if isinstance(cache_directory, (str, Path)):
+            cache_directory = [cache_directory]
+        self.cache_directories = [Path(directory) for directory in cache_directory]
+        for directory in self.cache_directories:
+            os.makedirs(directory, exist_ok=True)
+        if not isinstance(max_gb, (list, tuple)):
+            max_gb = [max_gb]
+        if len(max_gb) == 1:
+            max_gb = max_gb * len(self.cache_directories)
+        assert len(max_gb) == len(
+            self.cache_directories
+        ), "max_gb must be given once, or for each cache directory"
+        self.max_bytes = {
+            root: None if gb is None else int(gb * 1024**3)
+            for root, gb in zip(self.cache_directories, max_gb)
+        }
         self.input_spec = input_spec
         self.output_spec = output_spec
-        self.cache_directory = Path(cache_directory)
         self.cache_size = cache_size
+        self.version = version  # Part of every key, see RHNode.get_cache_version
+        self.digests = digests
+        self.shared = shared
+        self._counters_lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "saves": 0,
+            "evictions": 0,
+            "invalidations": 0,
+            "corrupted": 0,
+            "imports": 0,
+            "seconds_saved": 0.0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._counters_lock:
+            self.counters[name] += amount
 
-    def _get_cache_key(self, inputs):
-        hashes = ""
+    def _get_cache_key(self, inputs, digests=None):
+        """digests holds the already known SHA-256 of input files by key. Inputs
+        declared with Field(..., cache_key=False) do not change the key."""
+        digests = digests or {}
+        hashes = []
         for key, val in inputs.dict(exclude_unset=False).items():
-            if self.input_spec.__fields__[key].type_ == FilePath and val is not None:
-                hashes += _calculate_file_hash(val)
+            field = self.input_spec.__fields__[key]
+            if field.field_info.extra.get("cache_key", True) is False:
+                continue
+            if field.type_ == FilePath and val is not None:
+                hashes.append(digests.get(key) or _calculate_file_hash(val))
             else:
-                hashes += hashlib.sha256(str(val).encode()).hexdigest()
+                hashes.append(hash_cache_key_value(val))
+
+        return combine_cache_key(hashes, self.version)
+
+    def get_key_spec(self):
+        """How the key of a job is made from its inputs, so that clients can
+        compute it before submitting the job: the version, and the name, whether
+        it is a file and the default value of each input in the key"""
+        return {
+            "version": str(self.version) if self.version else None,
+            "inputs": [
+                [key, field.type_ == FilePath, str(field.default)]
+                for key, field in self.input_spec.__fields__.items()
+                if field.field_info.extra.get("cache_key", True) is not False
+            ],
+        }
 
-        return hashlib.sha256(hashes.encode()).hexdigest()
+    def get_key_filter(self):
+        """A CacheKeyFilter of the entries in the cache directories"""
+        return CacheKeyFilter.from_keys(
+            [
+                entry_dir.name
+                for root in self.cache_directories
+                for entry_dir in self._list_entries(root)
+            ]
+        )
+
+    def _get_cache_roots(self, cache_key):
+        """The cache directories in order of preference for the entry"""
+        return sorted(
+            self.cache_directories,
+            key=lambda root: hashlib.sha256(f"{root}/{cache_key}".encode()).digest(),
+            reverse=True,
+        )
+
+    def _get_entry_dir(self, cache_key):
+        """The directory of the entry, or where it is to be saved if it does not
+        exist. Entries placed before a cache directory was added are still found."""
+        roots = self._get_cache_roots(cache_key)
+        for root in roots:
+            if os.path.exists(root / cache_key):
+                return root / cache_key
+        return roots[0] / cache_key
 
     def _result_is_cached(self, cache_key):
-        return os.path.exists(self.cache_directory / cache_key)
+        return os.path.exists(self._get_entry_dir(cache_key))
+
+    def _read_manifest(self, cache_dir):
+        """The size and digest of each file of the entry by its path relative
+        to the files folder, or None for entries saved without them"""
+        try:
+            with open(cache_dir / CACHE_MANIFEST_FNAME) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _create_manifest(self, directory):
+        manifest = {}
+        for root, dirs, files in os.walk(directory):
+            for file in files:
+                path = Path(root, file)
+                if self.digests is not None:
+                    digest = self.digests.digest(path)
+                else:
+                    digest = _calculate_file_hash(path)
+                manifest[str(path.relative_to(directory))] = {
+                    "size": os.path.getsize(path),
+                    "digest": digest,
+                }
+        return manifest
 
     def _check_cache_integrity(self, cache_key):
-        cache_json = os.path.join(self.cache_directory, cache_key, CACHE_JSON_FNAME)
+        """Check that the files of the entry exist and have the size they were
+        saved with. Corrupted content with the same size is found by scrub."""
+        cache_dir = self._get_entry_dir(cache_key)
+        manifest = self._read_manifest(cache_dir)
+        if manifest is not None:
+            for rel_path, info in manifest.items():
+                size = os.path.getsize(cache_dir / CACHE_FILE_FOLDER / rel_path)
+                assert (
+                    size == info["size"]
+                ), f"Broken cache {cache_key}, {rel_path} has size {size}, expected {info['size']}"
+            return
+
+        cache_json = cache_dir / CACHE_JSON_FNAME
         outputs = self.output_spec.parse_file(cache_json)
         for key, val in outputs.dict(exclude_unset=True).items():
-            if self.output_spec.__fields__[key].type_ == FilePath and val is not None: # Added none for support for optional FilePath
+            if is_output_path(self.output_spec.__fields__[key]) and val is not None: # Added none for support for optional FilePath
                 assert os.path.exists(
                     val
                 ), f"Broken cache {cache_key}, missing file: {val}"
@@ -63,72 +408,563 @@ class Cache:
     def _change_root_response(self, response_json, prev_root, new_root):
         _response_dict = {}
         for key, val in response_json.dict(exclude_unset=True).items():
-            if self.output_spec.__fields__[key].type_ == FilePath and val is not None: # Added none for support for optional FilePath
+            if is_output_path(self.output_spec.__fields__[key]) and val is not None: # Added none for support for optional FilePath
                 relative_path = val.relative_to(prev_root)
                 _response_dict[key] = new_root / relative_path
             else:
                 _response_dict[key] = val
 
-        return self.output_spec(**_response_dict)
+        # Not validated again, as the files may not be at new_root yet
+        return self.output_spec.construct(**_response_dict)
 
     def _record_cache_access(self, cache_key):
-        with open(
-            os.path.join(self.cache_directory, cache_key, CACHE_LAST_ACCESSED_FNAME),
-            "w",
-        ) as f:
-            f.write(str(time.time()))
-
-    def _get_cache_last_accessed(self, cache_key):
-        with open(
-            os.path.join(self.cache_directory, cache_key, CACHE_LAST_ACCESSED_FNAME),
-            "r",
-        ) as f:
-            return float(f.read())
+        # The modification time is the access time, so it is updated atomically
+        try:
+            Path(self._get_entry_dir(cache_key), CACHE_LAST_ACCESSED_FNAME).touch()
+        except FileNotFoundError:
+            pass
+
+    def _get_cache_last_accessed(self, entry_dir):
+        try:
+            return os.stat(os.path.join(entry_dir, CACHE_LAST_ACCESSED_FNAME)).st_mtime
+        except OSError:
+            return 0.0
+
+    def _get_entry_duration(self, entry_dir):
+        """Seconds the job took to compute the entry, or None if unknown"""
+        try:
+            with open(os.path.join(entry_dir, CACHE_DURATION_FNAME), "r") as f:
+                return float(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _is_pinned(self, entry_dir):
+        return os.path.exists(os.path.join(entry_dir, CACHE_PINNED_FNAME))
+
+    def _get_entry_size(self, entry_dir):
+        """Bytes used by the files of an entry, recorded when it was saved"""
+        try:
+            with open(os.path.join(entry_dir, CACHE_SIZE_FNAME), "r") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return _get_directory_size(os.path.join(entry_dir, CACHE_FILE_FOLDER))
+
+    @contextmanager
+    def _read_lock(self, cache_key):
+        """Hold a shared lock on the entry while it is read, which keeps it from
+        being evicted (unlike _set_pinned, only until the lock is released).
+        Yields the entry directory, or None if there is no such entry."""
+        cache_dir = self._get_entry_dir(cache_key)
+        try:
+            f = open(cache_dir / CACHE_LOCK_FNAME, "a")
+        except FileNotFoundError:
+            yield None
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            # The entry may have been evicted (and saved again) before it was locked
+            try:
+                current = os.path.samestat(
+                    os.fstat(f.fileno()), os.stat(cache_dir / CACHE_LOCK_FNAME)
+                )
+            except FileNotFoundError:
+                current = False
+            yield cache_dir if current else None
 
     def _load_from_cache(self, cache_key, directory):
-        self._check_cache_integrity(cache_key)
-        cache_dir = os.path.join(self.cache_directory, cache_key)
-        cache_dir_files = os.path.join(cache_dir, CACHE_FILE_FOLDER)
-        cache_json = os.path.join(cache_dir, CACHE_JSON_FNAME)
-        outputs = self.output_spec.parse_file(cache_json)
+        """Copy the cached outputs to directory. Returns None if the entry was
+        evicted or is broken."""
+        with self._read_lock(cache_key) as cache_dir:
+            if cache_dir is None:
+                return None
+            cache_dir_files = cache_dir / CACHE_FILE_FOLDER
+            try:
+                self._check_cache_integrity(cache_key)
+                outputs = self.output_spec.parse_file(cache_dir / CACHE_JSON_FNAME)
+                outputs = self._change_root_response(outputs, cache_dir_files, directory)
+            except (AssertionError, OSError, ValueError) as e:
+                # A broken entry is a miss, so that the job is run instead
+                print("Could not load cache entry", cache_key, "as", e)
+                broken = True
+            else:
+                broken = False
+                try:
+                    # Cached files are links to the node's blobs, so they are linked, not copied
+                    shutil.copytree(
+                        cache_dir_files,
+                        directory,
+                        copy_function=link_or_copy,
+                        dirs_exist_ok=True,
+                    )
+                except OSError as e:
+                    # E.g. the disk of the job is full, which is no fault of the entry
+                    print("Could not copy cache entry", cache_key, "to the job:", e)
+                    return None
+                self._record_cache_access(cache_key)
+                self._count("hits")
+                self._count("seconds_saved", self._get_entry_duration(cache_dir) or 0)
 
-        shutil.copytree(cache_dir_files, directory, dirs_exist_ok=True)
-        outputs = self._change_root_response(outputs, cache_dir_files, directory)
-        self._record_cache_access(cache_key)
-        self._maybe_clean_cache()
+        if broken:
+            self._count("corrupted")
+            self._remove_entry(cache_dir)
+            return None
+        self._maybe_clean_cache(cache_dir.parent)
         return outputs
 
-    def _delete_from_cache(self, cache_key):
-        shutil.rmtree(os.path.join(self.cache_directory, cache_key))
+    def _promote(self, cache_key, on_file=None):
+        """Copy an entry of the shared cache into the local cache. on_file(path,
+        digest) is called for each of its files. Returns False if the shared
+        cache does not have the entry, or it is broken."""
+        if self.shared is None:
+            return False
+        cache_dir = self._get_entry_dir(cache_key)
+        staging_dir = cache_dir.parent / f"{CACHE_STAGING_PREFIX}{uuid.uuid4().hex}"
+        try:
+            found = self.shared.fetch(cache_key, staging_dir)
+            received = {
+                Path(root, file).relative_to(staging_dir).as_posix(): _calculate_file_hash(
+                    Path(root, file)
+                )
+                for root, dirs, files in os.walk(staging_dir / CACHE_FILE_FOLDER)
+                for file in files
+            }
+        except OSError as e:
+            print("Could not fetch", cache_key, "from the shared cache:", e)
+            found = False
+        if not found:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return False
+        if not self._install_entry(cache_key, staging_dir, received, on_file):
+            # Another job may have promoted it first
+            if self._result_is_cached(cache_key):
+                return True
+            # Removed so that the entry is written again once it is computed
+            try:
+                self.shared.remove(cache_key)
+            except OSError as e:
+                print("Could not remove", cache_key, "from the shared cache:", e)
+            self._count("corrupted")
+            return False
+        self._count("shared_hits")
+        self._maybe_clean_cache(cache_dir.parent)
+        return True
+
+    def _delete_from_cache(self, cache_key, shared=True):
+        """Remove an entry, waiting for jobs reading it, and from the shared
+        cache if shared is true. Returns False if there is no such entry."""
+        removed = self._remove_entry(self._get_entry_dir(cache_key), wait=True)
+        if shared and self.shared is not None and is_cache_key(cache_key):
+            removed = self.shared.remove(cache_key) or removed
+        if not removed:
+            return False
+        self._count("invalidations")
+        return True
+
+    def _set_pinned(self, cache_key, pinned=True):
+        """Pin or unpin an entry. Returns False if there is no such entry."""
+        path = self._get_entry_dir(cache_key) / CACHE_PINNED_FNAME
+        try:
+            if pinned:
+                path.touch()
+            elif path.exists():
+                path.unlink()
+        except FileNotFoundError:
+            return False
+        return os.path.exists(path.parent)
+
+    def _remove_entry(self, entry_dir, wait=False):
+        """Remove an entry unless it is being read, or after it has been read if
+        wait is true. Returns True if it was removed."""
+        trash = entry_dir.parent / f"{CACHE_STAGING_PREFIX}removed-{uuid.uuid4().hex}"
+        try:
+            with open(entry_dir / CACHE_LOCK_FNAME, "a") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    return False
+                # Readers that lock it after this see that the entry is gone
+                os.rename(entry_dir, trash)
+        except FileNotFoundError:
+            return False
+        shutil.rmtree(trash, ignore_errors=True)
+        return True
+
+    def _remove_stale_staging(self, root, max_age_hours=24):
+        """Remove what is left of entries whose writing was interrupted"""
+        for name in os.listdir(root):
+            path = root / name
+            if name.startswith(CACHE_STAGING_PREFIX):
+                try:
+                    if (time.time() - os.stat(path).st_mtime) / 3600 > max_age_hours:
+                        shutil.rmtree(path, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+
+    def _maybe_clean_cache(self, root):
+        """Remove the least recently used entries of the cache directory root
+        until it is within its number of entries and bytes"""
+        max_bytes = self.max_bytes.get(root)
+        entries = self._list_entries(root)
+        if max_bytes is None and (
+            self.cache_size is None or len(entries) <= self.cache_size
+        ):
+            return
+
+        # Pinned entries are kept first, then the most recently used ones
+        entries.sort(
+            key=lambda entry_dir: (
+                self._is_pinned(entry_dir),
+                self._get_cache_last_accessed(entry_dir),
+            ),
+            reverse=True,
+        )
+        total_bytes = 0
+        for i, entry_dir in enumerate(entries):
+            total_bytes += self._get_entry_size(entry_dir) if max_bytes else 0
+            too_many = self.cache_size is not None and i >= self.cache_size
+            if too_many or (max_bytes and total_bytes > max_bytes):
+                # Remove oldest, skipping those being read or pinned
+                if not self._is_pinned(entry_dir) and self._remove_entry(entry_dir):
+                    self._count("evictions")
+
+    def scrub(self, max_bytes_per_second=None, on_corrupt=None):
+        """Verify the digests of all cached files, reading at most
+        max_bytes_per_second. Entries with a missing, truncated or corrupted
+        file are removed, after calling on_corrupt(path, digest) with the file
+        that did not match its digest. Returns the number of entries checked
+        and removed."""
+        throttle = _Throttle(max_bytes_per_second)
+        checked, removed = 0, 0
+        for root in self.cache_directories:
+            for cache_key in os.listdir(root):
+                if cache_key.startswith(CACHE_STAGING_PREFIX):
+                    continue
+                with self._read_lock(cache_key) as cache_dir:
+                    if cache_dir is None:
+                        continue
+                    manifest = self._read_manifest(cache_dir)
+                    if manifest is None:
+                        continue
+                    broken = False
+                    for rel_path, info in manifest.items():
+                        path = cache_dir / CACHE_FILE_FOLDER / rel_path
+                        try:
+                            digest = _calculate_file_hash(path, throttle)
+                        except OSError:
+                            broken = True
+                            break
+                        if digest != info["digest"]:
+                            if on_corrupt is not None:
+                                on_corrupt(path, info["digest"])
+                            broken = True
+                            break
+                checked += 1
+                if broken and self._remove_entry(cache_dir):
+                    print("Removed corrupted cache entry", cache_key)
+                    self._count("corrupted")
+                    removed += 1
+        return checked, removed
+
+    def _get_entry_info(self, entry_dir):
+        return {
+            "cache_key": entry_dir.name,
+            "directory": str(entry_dir.parent),
+            "size": self._get_entry_size(entry_dir),
+            "last_accessed": self._get_cache_last_accessed(entry_dir),
+            "duration": self._get_entry_duration(entry_dir),
+            "pinned": self._is_pinned(entry_dir),
+        }
+
+    def _list_entries(self, root):
+        return [
+            root / cache_key
+            for cache_key in os.listdir(root)
+            if not cache_key.startswith(CACHE_STAGING_PREFIX)
+        ]
+
+    def get_entries(self, offset=0, limit=100):
+        """The entries of all cache directories, most recently used first"""
+        entries = [
+            entry_dir
+            for root in self.cache_directories
+            for entry_dir in self._list_entries(root)
+        ]
+        entries.sort(key=self._get_cache_last_accessed, reverse=True)
+        return {
+            "total": len(entries),
+            "entries": [
+                self._get_entry_info(entry_dir)
+                for entry_dir in entries[offset : offset + limit]
+            ],
+        }
+
+    def get_stats(self):
+        """The counters, and the number of entries and bytes in each directory"""
+        with self._counters_lock:
+            counters = dict(self.counters)
+        lookups = counters["hits"] + counters["misses"]
+        directories = []
+        for root in self.cache_directories:
+            entries = self._list_entries(root)
+            directories.append(
+                {
+                    "directory": str(root),
+                    "entries": len(entries),
+                    "bytes": sum(self._get_entry_size(entry) for entry in entries),
+                    "max_bytes": self.max_bytes[root],
+                }
+            )
+        return {
+            **counters,
+            "hit_ratio": counters["hits"] / lookups if lookups else None,
+            "cache_size": self.cache_size,
+            "directories": directories,
+        }
+
+    def _export_members(self, cache_keys=None):
+        """The (cache key, path, name in archive) of the files of the entries
+        (all if cache_keys is None), to be sent with _stream_tar to another node
+        that imports them. Each entry is protected from eviction while its
+        members are sent."""
+        if cache_keys is None:
+            cache_keys = [
+                entry_dir.name
+                for root in self.cache_directories
+                for entry_dir in self._list_entries(root)
+            ]
+        for cache_key in cache_keys:
+            if not is_cache_key(cache_key):
+                continue
+            with self._read_lock(cache_key) as cache_dir:
+                # Entries saved without a manifest cannot be checked by the receiver
+                if cache_dir is None or self._read_manifest(cache_dir) is None:
+                    continue
+                for fname in CACHE_EXPORTED_FNAMES:
+                    if os.path.exists(cache_dir / fname):
+                        yield cache_key, cache_dir / fname, f"{cache_key}/{fname}"
+                files_dir = cache_dir / CACHE_FILE_FOLDER
+                for root, dirs, files in os.walk(files_dir):
+                    for path in [Path(root)] + [Path(root, file) for file in files]:
+                        arcname = Path(cache_key, CACHE_FILE_FOLDER, path.relative_to(files_dir))
+                        yield cache_key, path, arcname.as_posix()
+
+    def import_entries(self, fileobj, on_file=None):
+        """Add the entries of a tar archive of _export_members, read as a stream
+        from fileobj. Entries that are cached already, or whose files do not
+        match their manifest, are skipped. Raises UnsafeCacheEntryError for an
+        entry whose response refers to files outside of the entry.
+        on_file(path, digest) is called for each imported file. Returns the
+        keys of the imported entries."""
+        imported = []
+        cache_key, staging_dir, received = None, None, {}
+        try:
+            with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+                for member in tar:
+                    key, _, rel_path = member.name.partition("/")
+                    if key != cache_key:
+                        if staging_dir is not None and self._install_entry(
+                            cache_key, staging_dir, received, on_file
+                        ):
+                            imported.append(cache_key)
+                        cache_key, staging_dir, received = key, None, {}
+                        if is_cache_key(key) and not self._result_is_cached(key):
+                            staging_dir = self._get_entry_dir(key).parent / (
+                                f"{CACHE_STAGING_PREFIX}{uuid.uuid4().hex}"
+                            )
+                            staging_dir.mkdir()
+                    if staging_dir is None:
+                        continue
 
-    def _maybe_clean_cache(self):
-        # Clean cache
-        if len(os.listdir(self.cache_directory)) > self.cache_size:
-            # Get last accessed
-            cache_keys = os.listdir(self.cache_directory)
-            cache_keys.sort(key=lambda x: self._get_cache_last_accessed(x))
-            # Remove oldest
-            for cache_key in cache_keys[: -self.cache_size]:
-                self._delete_from_cache(cache_key)
+                    parts = Path(rel_path).parts
+                    expected = (member.isfile() and rel_path in CACHE_EXPORTED_FNAMES) or (
+                        (member.isfile() or member.isdir())
+                        and parts[:1] == (CACHE_FILE_FOLDER,)
+                        and ".." not in parts
+                    )
+                    if not expected:
+                        print("Skipped cache entry", key, "with unexpected member", rel_path)
+                        shutil.rmtree(staging_dir, ignore_errors=True)
+                        staging_dir = None
+                        continue
 
-    def _save_to_cache(self, cache_key, outputs: BaseModel, directory):
-        cache_dir = os.path.join(self.cache_directory, cache_key)
-        cache_dir_files = os.path.join(cache_dir, CACHE_FILE_FOLDER)
+                    path = staging_dir / rel_path
+                    if member.isdir():
+                        path.mkdir(parents=True, exist_ok=True)
+                        continue
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    hash_object = hashlib.sha256()
+                    with tar.extractfile(member) as src, open(path, "wb") as f:
+                        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                            hash_object.update(chunk)
+                            f.write(chunk)
+                    received[rel_path] = hash_object.hexdigest()
 
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir, exist_ok=True)
+            staging_dir, last_dir = None, staging_dir
+            if last_dir is not None and self._install_entry(
+                cache_key, last_dir, received, on_file
+            ):
+                imported.append(cache_key)
+        finally:
+            if staging_dir is not None:
+                shutil.rmtree(staging_dir, ignore_errors=True)
 
-            shutil.copytree(directory, cache_dir_files)
+        self._count("imports", len(imported))
+        for root in {self._get_entry_dir(key).parent for key in imported}:
+            self._remove_stale_staging(root)
+            self._maybe_clean_cache(root)
+        return imported
+
+    def _install_entry(self, cache_key, staging_dir, received, on_file=None):
+        """Check an entry from another node against its manifest, point its
+        response to where its files will be, and rename it into place. received
+        holds the SHA-256 of each received file by its path in the entry."""
+        cache_dir = staging_dir.parent / cache_key
+        try:
+            manifest = self._read_manifest(staging_dir)
+            assert manifest is not None, "it has no manifest"
+            files = {
+                str(Path(rel_path).relative_to(CACHE_FILE_FOLDER)): digest
+                for rel_path, digest in received.items()
+                if rel_path.startswith(CACHE_FILE_FOLDER + "/")
+            }
+            assert set(files) == set(manifest), "its files do not match the manifest"
+            for rel_path, info in manifest.items():
+                assert files[rel_path] == info["digest"], f"{rel_path} is corrupted"
+
+            # The response refers to the files in the cache of the exporting node
+            with open(staging_dir / CACHE_JSON_FNAME) as f:
+                response = json.load(f)
+            for key, val in response.items():
+                field = self.output_spec.__fields__.get(key)
+                assert field is not None, f"the node has no output {key}"
+                if is_output_path(field) and val is not None:
+                    parts = Path(val).parts
+                    i = parts.index(cache_key)
+                    assert parts[i + 1] == CACHE_FILE_FOLDER, f"unexpected path {val}"
+                    relative_path = Path(*parts[i + 2 :])
+                    files_dir = (staging_dir / CACHE_FILE_FOLDER).resolve()
+                    path = (files_dir / relative_path).resolve()
+                    if ".." in relative_path.parts or not is_relative_to(path, files_dir):
+                        raise UnsafeCacheEntryError(
+                            f"Cache entry {cache_key} refers to {val} outside of the entry"
+                        )
+                    assert path.is_file(), f"{val} is missing"
+                    response[key] = str(cache_dir / CACHE_FILE_FOLDER / relative_path)
+            # Written to new files, as these may be links to the shared cache
+            _replace_file(staging_dir / CACHE_JSON_FNAME, json.dumps(response))
+            _replace_file(
+                staging_dir / CACHE_SIZE_FNAME,
+                str(_get_directory_size(staging_dir / CACHE_FILE_FOLDER)),
+            )
+            Path(staging_dir, CACHE_LAST_ACCESSED_FNAME).touch()
+            Path(staging_dir, CACHE_LOCK_FNAME).touch()
+
+            os.rename(staging_dir, cache_dir)
+        except UnsafeCacheEntryError:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        except (AssertionError, OSError, ValueError, IndexError) as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not isinstance(e, OSError) or e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                print("Skipped cache entry", cache_key, "as", e)
+            return False
+
+        for rel_path, info in manifest.items():
+            path = cache_dir / CACHE_FILE_FOLDER / rel_path
+            if self.digests is not None:
+                self.digests.add(path, info["digest"])
+            if on_file is not None:
+                on_file(path, info["digest"])
+        return True
+
+    def _save_to_cache(self, cache_key, outputs: BaseModel, directory, duration=None):
+        """duration is the number of seconds it took to compute outputs"""
+        cache_dir = self._get_entry_dir(cache_key)
+        if os.path.exists(cache_dir):
+            print("Cache already exists, skipping")
+            self._record_cache_access(cache_key)
+            return
+
+        staging_dir = cache_dir.parent / f"{CACHE_STAGING_PREFIX}{uuid.uuid4().hex}"
+        try:
+            shutil.copytree(
+                directory,
+                staging_dir / CACHE_FILE_FOLDER,
+                copy_function=link_or_copy,
+            )
+            # The response refers to the files where they will be after the rename
             outputs_cache = self._change_root_response(
-                outputs, directory, cache_dir_files
+                outputs, directory, cache_dir / CACHE_FILE_FOLDER
             )
 
             # Save response as json
-            with open(os.path.join(cache_dir, CACHE_JSON_FNAME), "w") as f:
+            with open(staging_dir / CACHE_JSON_FNAME, "w") as f:
                 f.write(outputs_cache.json())
-        else:
-            print("Cache already exists, skipping")
+            manifest = self._create_manifest(directory)
+            with open(staging_dir / CACHE_MANIFEST_FNAME, "w") as f:
+                json.dump(manifest, f)
+            with open(staging_dir / CACHE_SIZE_FNAME, "w") as f:
+                f.write(str(_get_directory_size(staging_dir / CACHE_FILE_FOLDER)))
+            if duration is not None:
+                with open(staging_dir / CACHE_DURATION_FNAME, "w") as f:
+                    f.write(str(duration))
+            Path(staging_dir, CACHE_LAST_ACCESSED_FNAME).touch()
+            Path(staging_dir, CACHE_LOCK_FNAME).touch()
+
+            # Fails if another job saved the entry first
+            os.rename(staging_dir, cache_dir)
+        except OSError as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if e.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                print("Cache already exists, skipping")
+            else:
+                # The job is not failed for it, e.g. when the disk is full
+                print("Could not save the result to the cache:", e)
+            return
+
+        self._count("saves")
+        if self.digests is not None:
+            # So that exporting the entry does not hash the files again
+            for rel_path, info in manifest.items():
+                try:
+                    self.digests.add(cache_dir / CACHE_FILE_FOLDER / rel_path, info["digest"])
+                except FileNotFoundError:
+                    break
+        if self.shared is not None:
+            with self._read_lock(cache_key) as locked_dir:
+                try:
+                    if locked_dir is not None:
+                        self.shared.store(cache_key, locked_dir)
+                except OSError as e:
+                    print("Could not write the result to the shared cache:", e)
+        self._remove_stale_staging(cache_dir.parent)
+        self._maybe_clean_cache(cache_dir.parent)
+
+
+def _entry_copy_function(entry_dir):
+    """A copy_function for copytree of an entry, which links the files of its
+    files folder and copies the others"""
+    files_dir = Path(entry_dir) / CACHE_FILE_FOLDER
+
+    def copy(src, dst):
+        if is_relative_to(Path(src), files_dir):
+            return link_or_copy(src, dst)
+        return shutil.copy2(src, dst)
+
+    return copy
+
+
+def _replace_file(path, text):
+    """Write text to a new file that replaces path"""
+    tmp = path.with_name(f".{uuid.uuid4().hex}.{path.name}")
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
 
-        self._record_cache_access(cache_key)
-        self._check_cache_integrity(cache_key)
-        self._maybe_clean_cache()
+def _get_directory_size(directory):
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
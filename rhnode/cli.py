@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 from rhnode import RHJob
 import argparse
+import csv
+import json
+import os
+import sys
+import time
 
 
 def main():
@@ -24,7 +29,11 @@ def main():
         help="Node address in the form host:port [mutually exclusive with --manager_address]",
     )
     parser.add_argument(
-        "-p", "--priority", type=int, default=3, help="Priority of the job [1-5]"
+        "-p",
+        "--priority",
+        type=int,
+        default=None,
+        help="Priority of the job [1-5] [default: 3, or 1 with --prefetch]",
     )
     parser.add_argument(
         "-nc",
@@ -41,7 +50,45 @@ def main():
     parser.add_argument(
         "-r", "--resources_included", action="store_true", help="help for arg1"
     )
-    parser.add_argument("-g", "--gpu", type=int, default=None, help="help for arg1")
+    parser.add_argument(
+        "-g",
+        "--gpu",
+        type=int,
+        nargs="+",
+        default=None,
+        help="CUDA device(s) to use with --resources_included",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=str,
+        default=None,
+        help="Run a job for each row of a .jsonl or .csv manifest of node inputs",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of jobs in flight at a time with --batch",
+    )
+    parser.add_argument(
+        "--ledger",
+        type=str,
+        default=None,
+        help="Results ledger of --batch. Rows already finished in the ledger are skipped [default: MANIFEST.ledger.jsonl]",
+    )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="CSV file with the status and timings of each row of --batch [default: MANIFEST.report.csv]",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="With --batch, compute the results into the cache at low priority without downloading them, so that a later run loads them from the cache",
+    )
     parser.add_argument("node_name", help="The identifier for the task")
     parser.add_argument(
         "node_args",
@@ -50,6 +97,12 @@ def main():
     )
 
     args = parser.parse_args()
+    if args.priority is None:
+        args.priority = 1 if args.prefetch else 3
+
+    if args.batch is not None:
+        run_batch(args)
+        return
 
     print(args.node_args)
 
@@ -76,5 +129,123 @@ def main():
         job.wait_for_finish()
 
 
+def _read_manifest(path):
+    """Returns {row id: inputs}. The row id is the "id" field if present,
+    otherwise the row number."""
+    if path.endswith(".csv"):
+        with open(path, newline="") as f:
+            # Empty cells leave the input at its default value
+            rows = [
+                {key: val for key, val in row.items() if val != ""}
+                for row in csv.DictReader(f)
+            ]
+    else:
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    manifest = {}
+    for i, row in enumerate(rows):
+        row_id = str(row.pop("id", i))
+        if row_id in manifest:
+            raise ValueError(f"Duplicate row id in manifest: {row_id}")
+        manifest[row_id] = row
+    return manifest
+
+
+def _read_ledger(path):
+    """Returns the last ledger entry of each row"""
+    entries = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["id"]] = entry
+    return entries
+
+
+def _write_report(path, entries):
+    fields = ["id", "status", "submitted", "finished", "duration", "attempts", "error"]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        for entry in entries.values():
+            writer.writerow(entry)
+
+
+def run_batch(args):
+    base = os.path.splitext(args.batch)[0]
+    ledger_path = args.ledger or base + ".ledger.jsonl"
+    report_path = args.report or base + ".report.csv"
+
+    manifest = _read_manifest(args.batch)
+    entries = _read_ledger(ledger_path)
+    todo = {
+        row_id: inputs
+        for row_id, inputs in manifest.items()
+        if entries.get(row_id, {}).get("status") != "finished"
+    }
+    print(
+        f"{len(manifest)} rows in manifest, {len(manifest) - len(todo)} already finished"
+    )
+
+    submitted = {}
+    attempts = {}
+
+    def on_submit(row_id, job):
+        submitted.setdefault(row_id, time.time())
+        attempts[row_id] = attempts.get(row_id, 0) + 1
+
+    results = RHJob.map(
+        args.node_name,
+        todo,
+        output_directory=args.output_directory or ".",
+        max_in_flight=args.concurrency,
+        return_exceptions=True,
+        on_submit=on_submit,
+        download=not args.prefetch,
+        manager_address=args.manager_address,
+        node_address=args.node_address,
+        check_cache=not args.no_cache,
+        save_to_cache=not args.no_save_cache,
+        resources_included=args.resources_included,
+        priority=args.priority,
+        included_cuda_device=args.gpu,
+    )
+
+    done = 0
+    failed = 0
+    with open(ledger_path, "a") as ledger:
+        for row_id, output in results:
+            finished = time.time()
+            entry = {
+                "id": row_id,
+                "submitted": round(submitted[row_id], 3),
+                "finished": round(finished, 3),
+                "duration": round(finished - submitted[row_id], 3),
+                "attempts": attempts[row_id],
+            }
+            if isinstance(output, Exception):
+                failed += 1
+                entry.update(status="failed", error=str(output))
+            else:
+                entry.update(status="finished", outputs=output)
+            ledger.write(json.dumps(entry, default=str) + "\n")
+            ledger.flush()
+            entries[row_id] = entry
+
+            done += 1
+            print(
+                f"[{done}/{len(todo)}] {row_id} {entry['status']} in {entry['duration']:.1f}s"
+                f" ({failed} failed, {len(submitted) - done} in flight)",
+                file=sys.stderr,
+            )
+
+    _write_report(report_path, entries)
+    print(f"Report written to {report_path}")
+    if failed:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,114 @@
+"""Process-wide state shared by all RHJob instances"""
+
+import threading
+import time
+import requests
+from .cache import DigestIndex
+
+
+class ClientContext:
+    """Holds the requests session used for all calls to nodes and managers, and
+    caches the manager endpoint, the addresses of nodes, the cache indexes of
+    nodes (see RHManager.get_cache_indexes) and the schemas of nodes.
+    Cached entries expire after their TTL (seconds), and are invalidated when a
+    node stops responding or reports a different schema version. The digests of
+    files uploaded and downloaded are remembered in digests."""
+
+    def __init__(self, manager_ttl=600, address_ttl=60, schema_ttl=600):
+        self.session = requests.Session()
+        self.digests = DigestIndex()
+        self.manager_ttl = manager_ttl
+        self.address_ttl = address_ttl
+        self.schema_ttl = schema_ttl
+        self._lock = threading.Lock()
+        self._managers = {}  # tuple of candidate endpoints -> (host, port)
+        self._addresses = {}  # (manager host, manager port, node name) -> (host, port)
+        self._cache_indexes = {}  # (manager host, manager port, node name) -> indexes
+        self._schemas = {}  # (host, port, node name) -> schema
+
+    def _lookup(self, cache, key, ttl):
+        with self._lock:
+            entry = cache.get(key)
+        if entry is not None and time.time() - entry[0] < ttl:
+            return entry[1]
+        return None
+
+    def _store(self, cache, key, value):
+        with self._lock:
+            cache[key] = (time.time(), value)
+        return value
+
+    def _get(self, cache, key, ttl, fetch):
+        value = self._lookup(cache, key, ttl)
+        if value is None:
+            value = self._store(cache, key, fetch())
+        return value
+
+    async def _aget(self, cache, key, ttl, fetch):
+        value = self._lookup(cache, key, ttl)
+        if value is None:
+            value = self._store(cache, key, await fetch())
+        return value
+
+    ## The fetch functions are called on a cache miss. They are coroutine
+    ## functions for the async variants used by AsyncRHJob.
+    def get_manager(self, options, fetch):
+        return self._get(self._managers, tuple(options), self.manager_ttl, fetch)
+
+    def get_node_address(self, manager_host, manager_port, node_name, fetch):
+        key = (manager_host, manager_port, node_name)
+        return self._get(self._addresses, key, self.address_ttl, fetch)
+
+    def get_cache_indexes(self, manager_host, manager_port, node_name, fetch):
+        key = (manager_host, manager_port, node_name)
+        return self._get(self._cache_indexes, key, self.address_ttl, fetch)
+
+    def get_schema(self, host, port, node_name, fetch):
+        key = (host, port, node_name)
+        return self._get(self._schemas, key, self.schema_ttl, fetch)
+
+    async def aget_manager(self, options, fetch):
+        return await self._aget(self._managers, tuple(options), self.manager_ttl, fetch)
+
+    async def aget_node_address(self, manager_host, manager_port, node_name, fetch):
+        key = (manager_host, manager_port, node_name)
+        return await self._aget(self._addresses, key, self.address_ttl, fetch)
+
+    async def aget_cache_indexes(self, manager_host, manager_port, node_name, fetch):
+        key = (manager_host, manager_port, node_name)
+        return await self._aget(self._cache_indexes, key, self.address_ttl, fetch)
+
+    async def aget_schema(self, host, port, node_name, fetch):
+        key = (host, port, node_name)
+        return await self._aget(self._schemas, key, self.schema_ttl, fetch)
+
+    def schema_is_stale(self, host, port, node_name, schema_version):
+        """True if the cached schema of the node has a different version"""
+        with self._lock:
+            entry = self._schemas.get((host, port, node_name))
+        if entry is None or schema_version is None:
+            return False
+        return entry[1].get("schema_version") != schema_version
+
+    def invalidate_node(self, host, port, node_name):
+        """Forget the schema of the node and any address resolving to it"""
+        with self._lock:
+            self._schemas.pop((host, port, node_name), None)
+            for key, (_, address) in list(self._addresses.items()):
+                if key[2] == node_name and tuple(address) == (host, port):
+                    del self._addresses[key]
+
+    def invalidate_managers(self):
+        with self._lock:
+            self._managers.clear()
+
+    def clear(self):
+        with self._lock:
+            self._managers.clear()
+            self._addresses.clear()
+            self._cache_indexes.clear()
+            self._schemas.clear()
+
+
+# Shared by all RHJob instances unless they are given their own context
+client_context = ClientContext()
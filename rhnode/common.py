@@ -1,9 +1,12 @@
 """Common definitions used by RHNode, RHJob, RHProcess and RHManager"""
 from pydantic import BaseModel, FilePath, DirectoryPath, create_model
 from pathlib import Path
-from typing import Type, Union
+from typing import List, Type, Union
 from enum import Enum
 import os
+import math
+import base64
+import hashlib
 
 
 class JobCancelledError(Exception):
@@ -12,21 +15,61 @@ class JobCancelledError(Exception):
     pass
 
 
+class JobDeadlineExceededError(JobCancelledError):
+    """Raised when a job is cancelled because it did not finish before its deadline"""
+
+    pass
+
+
 class JobFailedError(Exception):
     """Raised when an error occurs within the Process function of a node"""
 
     pass
 
 
+class JobSubmissionError(Exception):
+    """Raised when a node rejects one of the jobs submitted with RHJob.start_many"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class InputKeyError(Exception):
+    """Raised when an input of a job is neither an input nor an output of the node"""
+
+    pass
+
+
 class JobMetaData(BaseModel):
     """The 'job' object passed to the process function of a node"""
 
     device: Union[None, int]
+    devices: Union[None, List[int]] = None  # All devices reserved for the job
     check_cache: bool = True
     save_to_cache: bool = True
     priority: int = 2
     directory: Union[None, DirectoryPath] = None
     resources_included: bool = False
+    deadline: Union[None, float] = None  # Unix time after which the job is cancelled
+    submitter: Union[None, str] = None  # Who started the job (or its top-level parent)
+    # Set by the node when the job got its resources from the manager
+    queue_id: Union[None, str] = None
+    manager_endpoint: Union[None, str] = None
+    # Set by RHJob.from_parent_job
+    parent_queue_id: Union[None, str] = None
+    borrow_parent_resources: bool = False
+
+
+class OutputReference(BaseModel):
+    """An output file of a finished job, given as the input of another job. The
+    node running that job fetches the file directly from the node that made it."""
+
+    node: str
+    job_id: str
+    key: str
+    host: str
+    port: str
 
 
 class NodeMetaData(BaseModel):
@@ -35,6 +78,7 @@ class NodeMetaData(BaseModel):
     name: str
     last_heard_from: float
     gpu_gb_required: float
+    gpus_required: int = 1
     threads_required: int
     memory_required: int
 
@@ -44,9 +88,68 @@ class QueueRequest(BaseModel):
 
     job_id: str
     priority: int
-    required_gpu_mem: int
+    required_gpu_mem: int  # Per device
+    required_num_gpus: int = 1
+    required_gpu_share: float = 0  # Fraction of each device's compute, 0 = unaccounted
     required_threads: int
     required_memory: int
+    node_name: Union[None, str] = None  # Used to look up the run time history
+    submitter: Union[None, str] = None  # Used for fair-share between users
+    parent_id: Union[None, str] = None  # Queue ID of the job that started this job
+    borrow: bool = False  # Run on the parent's resources if they fit
+    required_devices: Union[None, List[int]] = None  # Set when a job is resumed
+    deadline: Union[None, float] = None  # Unix time after which the job is dropped
+
+
+class JobUsage(BaseModel):
+    """Sent by the node to the manager when a job releases its resources"""
+
+    completed: bool = True  # False if the job failed or was cancelled
+    peak_memory: Union[None, float] = None  # GB
+    peak_gpu_mem: Union[None, float] = None  # GB, largest over the job's devices
+
+
+class CacheKeyFilter(BaseModel):
+    """A Bloom filter of the keys of the results a node has cached. Nodes send
+    it to their manager, and managers to each other, so that jobs can be sent to
+    the host most likely to have their result. Cache keys are SHA-256 digests,
+    so the bit positions are taken from the key itself."""
+
+    num_bits: int
+    num_hashes: int
+    bits: str  # base64
+
+    @classmethod
+    def from_keys(cls, keys, false_positive_rate=0.01):
+        n = max(len(keys), 1)
+        num_bits = max(64, int(-n * math.log(false_positive_rate) / math.log(2) ** 2))
+        # A key has 32 bytes, enough for 8 positions
+        num_hashes = min(8, max(1, round(num_bits / n * math.log(2))))
+        bits = bytearray((num_bits + 7) // 8)
+        for key in keys:
+            for i in _filter_positions(key, num_bits, num_hashes):
+                bits[i // 8] |= 1 << (i % 8)
+        return cls(
+            num_bits=num_bits,
+            num_hashes=num_hashes,
+            bits=base64.b64encode(bits).decode(),
+        )
+
+    def __contains__(self, key):
+        bits = base64.b64decode(self.bits)
+        try:
+            positions = list(_filter_positions(key, self.num_bits, self.num_hashes))
+        except ValueError:
+            return False
+        return all(bits[i // 8] & (1 << (i % 8)) for i in positions)
+
+
+def _filter_positions(key, num_bits, num_hashes):
+    digest = bytes.fromhex(key)
+    if len(digest) != 32:
+        raise ValueError("Not a cache key")
+    for i in range(num_hashes):
+        yield int.from_bytes(digest[4 * i : 4 * i + 4], "big") % num_bits
 
 
 class JobStatus(Enum):
@@ -66,6 +169,42 @@ class Error(BaseModel):
     traceback: str
 
 
+# Error.error of jobs that were cancelled because they passed their deadline
+DEADLINE_EXCEEDED = "DeadlineExceeded"
+
+# Response header with the version of the node's inputs and outputs, which lets
+# clients notice that a schema they cached is outdated
+SCHEMA_VERSION_HEADER = "RHNode-Schema-Version"
+
+
+# PAX header of each member of a job's output archive, naming the output key it
+# belongs to
+ARCHIVE_KEY_HEADER = "RHNODE.key"
+
+# Header with the SHA-256 of a downloaded file, and the PAX header with the
+# SHA-256 of each file in an output archive
+DIGEST_HEADER = "RHNode-Digest"
+ARCHIVE_DIGEST_HEADER = "RHNODE.sha256"
+
+
+def hash_cache_key_value(value):
+    """The SHA-256 of an input that is not a file, as part of a cache key"""
+    return hashlib.sha256(str(value).encode()).hexdigest()
+
+
+def combine_cache_key(hashes, version=None):
+    """The key of a cached result, from the SHA-256 of each input in the key (of
+    the content of files) in the order of the input spec, and the version of
+    the node. Used by the node, and by clients to find a host with the result."""
+    prefix = hash_cache_key_value(version) if version else ""
+    return hashlib.sha256((prefix + "".join(hashes)).encode()).hexdigest()
+
+
+def is_output_path(field):
+    """True for FilePath and DirectoryPath fields, whose values are downloaded"""
+    return field.type_ in (FilePath, DirectoryPath)
+
+
 def is_relative_to(a, b):
     """Check if path a is relative to path b"""
     assert isinstance(a, Path)
@@ -87,13 +226,13 @@ def create_file_name_from_key(key_name, file_name):
 
 
 def create_filepath_as_string_model(cls: Type[BaseModel]) -> Type[BaseModel]:
-    """Create a model that has all FilePath fields replaced with strings.
+    """Create a model that has all FilePath and DirectoryPath fields replaced with strings.
     This is useful when we want a "download" link to the file instead of the file itself.
     """
 
     fields = {}
     for field_name, field in cls.__fields__.items():
-        if issubclass(field.type_, FilePath):
+        if issubclass(field.type_, (FilePath, DirectoryPath)):
             fields[field_name] = (str, field.field_info)
         else:
             fields[field_name] = (field.type_, field.field_info)
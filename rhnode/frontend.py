@@ -22,7 +22,7 @@ def setup_frontend_routes(rhnode):
             dat["name"] = key
             dat["val"] = val
             if isinstance(val, str):
-                if "/download/" in val:
+                if "/download/" in val or "/download.tar" in val:
                     dat["val"] = "download"
                     dat["href"] = val
             outs.append(dat)
@@ -0,0 +1,295 @@
+"""Declarative multi-node pipelines built on RHJob.
+
+A pipeline is a set of stages. Each stage runs one node, and its inputs may refer
+to the outputs of other stages. The runner starts every stage as soon as the
+stages it depends on have finished, so independent stages run in parallel.
+
+Example:
+
+    pipeline = Pipeline(output_directory="out")
+    add = pipeline.add_stage("add", "add", {"scalar": 1, "in_file": "mr.nii.gz"})
+    pipeline.add_stage("add_again", "add", {"scalar": 2, "in_file": add.output("out_file")})
+    outputs = pipeline.run()
+    print(pipeline.report)
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .rhjob import RHJob
+
+
+class StageOutput:
+    """Reference to an output of a stage, used as an input value of another stage"""
+
+    def __init__(self, stage, key):
+        self.stage = stage
+        self.key = key
+
+    def __repr__(self):
+        return f"StageOutput({self.stage.name}.{self.key})"
+
+
+class Stage:
+    def __init__(
+        self, name, node, inputs, depends_on=None, download=True, **job_kwargs
+    ):
+        self.name = name
+        self.node = node
+        self.inputs = inputs
+        self.explicit_dependencies = list(depends_on or [])
+        self.download = download
+        self.job_kwargs = job_kwargs
+
+    def output(self, key):
+        return StageOutput(self, key)
+
+    @property
+    def dependencies(self):
+        """Names of the stages this stage waits for"""
+        names = [
+            dep.name if isinstance(dep, Stage) else dep
+            for dep in self.explicit_dependencies
+        ]
+        for val in self.inputs.values():
+            if isinstance(val, StageOutput) and val.stage.name not in names:
+                names.append(val.stage.name)
+        return names
+
+
+class PipelineError(Exception):
+    """Raised when a stage of a pipeline fails. The other stages are stopped."""
+
+    def __init__(self, stage_name, error):
+        super().__init__(f"Stage '{stage_name}' failed: {error}")
+        self.stage_name = stage_name
+        self.error = error
+
+
+class PipelineReport:
+    """Timings of a finished pipeline run and its critical path, i.e. the chain of
+    dependent stages that determined the total run time."""
+
+    def __init__(self, stages, timings):
+        self.timings = timings
+        if not timings:
+            self.total_time = 0
+            self.critical_path = []
+            self.critical_path_time = 0
+            return
+        self.total_time = max(t["end"] for t in timings.values()) - min(
+            t["start"] for t in timings.values()
+        )
+
+        # Earliest finish of each stage if it had started as soon as its
+        # dependencies were done, processed in the order the stages finished
+        earliest_finish = {}
+        critical_dependency = {}
+        for name in sorted(timings, key=lambda name: timings[name]["end"]):
+            deps = stages[name].dependencies
+            start = max((earliest_finish[dep] for dep in deps), default=0)
+            critical_dependency[name] = max(
+                deps, key=lambda dep: earliest_finish[dep], default=None
+            )
+            earliest_finish[name] = start + timings[name]["duration"]
+
+        path = [max(earliest_finish, key=earliest_finish.get)]
+        while critical_dependency[path[0]] is not None:
+            path.insert(0, critical_dependency[path[0]])
+        self.critical_path = path
+        self.critical_path_time = earliest_finish[path[-1]]
+
+        # How much each stage could have been delayed without delaying the pipeline
+        latest_finish = {}
+        for name in sorted(timings, key=lambda name: -timings[name]["end"]):
+            dependants = [
+                other for other in timings if name in stages[other].dependencies
+            ]
+            latest_finish[name] = min(
+                (
+                    latest_finish[other] - timings[other]["duration"]
+                    for other in dependants
+                ),
+                default=self.critical_path_time,
+            )
+        for name in timings:
+            timings[name]["slack"] = latest_finish[name] - earliest_finish[name]
+
+    def __str__(self):
+        lines = [
+            f"Total time: {self.total_time:.1f}s, critical path: "
+            + " -> ".join(self.critical_path)
+            + f" ({self.critical_path_time:.1f}s)",
+            f"{'stage':<20}{'node':<20}{'duration':>10}{'slack':>10}",
+        ]
+        for name, t in sorted(self.timings.items(), key=lambda kv: kv[1]["start"]):
+            lines.append(
+                f"{name:<20}{t['node']:<20}{t['duration']:>9.1f}s{t['slack']:>9.1f}s"
+            )
+        return "\n".join(lines)
+
+
+class Pipeline:
+    """Runs a DAG of node jobs. Keyword arguments not used by the pipeline are
+    passed on to every RHJob (e.g. priority, check_cache, manager_address), and
+    can be overridden per stage in add_stage.
+
+    With download=False, the output files of a stage are not downloaded. Stages
+    using them get references, and fetch them directly from the node that made
+    them. download can also be set per stage."""
+
+    def __init__(
+        self,
+        output_directory=".",
+        max_parallel=None,
+        parent_job=None,
+        download=True,
+        **job_kwargs,
+    ):
+        self.output_directory = output_directory
+        self.max_parallel = max_parallel
+        self.parent_job = parent_job
+        self.download = download
+        self.job_kwargs = job_kwargs
+        self.stages = {}
+        self.outputs = {}
+        self.report = None
+
+    @staticmethod
+    def from_parent_job(parent_job, max_parallel=None, download=True, **job_kwargs):
+        """Create a pipeline from within the process function of a node. The
+        stages are created with RHJob.from_parent_job."""
+        return Pipeline(
+            output_directory=parent_job.directory,
+            max_parallel=max_parallel,
+            parent_job=parent_job,
+            download=download,
+            **job_kwargs,
+        )
+
+    def add_stage(
+        self, name, node, inputs, depends_on=None, download=None, **job_kwargs
+    ):
+        if name in self.stages:
+            raise ValueError(f"A stage named '{name}' already exists")
+        if download is None:
+            download = self.download
+        stage = Stage(name, node, inputs, depends_on, download, **job_kwargs)
+        self.stages[name] = stage
+        return stage
+
+    def _validate(self):
+        """Check that all dependencies exist and that there are no cycles"""
+        for stage in self.stages.values():
+            for dep in stage.dependencies:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown '{dep}'")
+
+        visited = set()
+        for name in self.stages:
+            stack = [(name, iter(self.stages[name].dependencies))]
+            on_path = {name}
+            while stack:
+                current, deps = stack[-1]
+                dep = next(deps, None)
+                if dep is None:
+                    stack.pop()
+                    on_path.discard(current)
+                    visited.add(current)
+                elif dep in on_path:
+                    raise ValueError(f"The pipeline has a cycle through '{dep}'")
+                elif dep not in visited:
+                    on_path.add(dep)
+                    stack.append((dep, iter(self.stages[dep].dependencies)))
+
+    def _resolve_inputs(self, stage):
+        inputs = {}
+        for key, val in stage.inputs.items():
+            if isinstance(val, StageOutput):
+                inputs[key] = self.outputs[val.stage.name][val.key]
+            else:
+                inputs[key] = val
+        return inputs
+
+    def _create_job(self, stage, inputs):
+        job_kwargs = {**self.job_kwargs, **stage.job_kwargs}
+        if self.parent_job is not None:
+            parent_kwargs = {
+                key: job_kwargs.pop(key)
+                for key in ["use_same_resources", "parent_resources"]
+                if key in job_kwargs
+            }
+            job = RHJob.from_parent_job(
+                stage.node, inputs, self.parent_job, **parent_kwargs
+            )
+            # Per-stage overrides of what the child inherits from the parent
+            for key, val in job_kwargs.items():
+                if key not in ["check_cache", "save_to_cache", "priority"]:
+                    raise ValueError(f"'{key}' cannot be set for a child job")
+                setattr(job.job, key, val)
+            return job
+        return RHJob(
+            node_name=stage.node,
+            inputs=inputs,
+            output_directory=os.path.join(self.output_directory, stage.name),
+            **job_kwargs,
+        )
+
+    def _run_stage(self, stage, jobs, timing):
+        # Timed here, so that waiting for a free worker does not count
+        timing["start"] = time.time()
+        try:
+            job = self._create_job(stage, self._resolve_inputs(stage))
+            jobs[stage.name] = job
+            job.start()
+            return job.wait_for_finish(download=stage.download)
+        finally:
+            timing["end"] = time.time()
+            timing["duration"] = timing["end"] - timing["start"]
+
+    def run(self):
+        """Run all stages and return their outputs as {stage name: outputs}"""
+        self._validate()
+        self.outputs = {}
+        if not self.stages:
+            self.report = PipelineReport(self.stages, {})
+            return self.outputs
+        timings = {}
+        jobs = {}
+        pending = dict(self.stages)
+        running = {}
+
+        max_workers = self.max_parallel or max(len(self.stages), 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                # Submit every stage whose dependencies are done
+                for name, stage in list(pending.items()):
+                    if all(dep in self.outputs for dep in stage.dependencies):
+                        del pending[name]
+                        timings[name] = {"node": stage.node}
+                        future = executor.submit(
+                            self._run_stage, stage, jobs, timings[name]
+                        )
+                        running[future] = name
+
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.outputs[name] = future.result()
+                    except Exception as e:
+                        self._stop_running(running, jobs)
+                        raise PipelineError(name, e) from e
+
+        self.report = PipelineReport(self.stages, timings)
+        return self.outputs
+
+    def _stop_running(self, running, jobs):
+        for future, name in running.items():
+            future.cancel()
+            job = jobs.get(name)
+            if job is not None and job.ID is not None:
+                try:
+                    job.stop(wait=False)
+                except Exception as e:
+                    print("Could not stop stage", name, ":", e)
@@ -5,8 +5,32 @@ import time
 import os
 from .common import *
 import json
+import getpass
+import socket
+import threading
+import datetime
+import shutil
+import tarfile
+from contextlib import contextmanager, ExitStack
+from collections import deque
 from requests.exceptions import HTTPError
 
+from .client import client_context
+from .blobstore import clone_or_copy
+import hashlib
+
+# Shared by all jobs of the process, so that connections to nodes and managers
+# are reused
+_session = client_context.session
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Where to look for a manager if no address is given
+MANAGER_ENDPOINTS = [
+    ("manager", "8000"),
+    ("localhost", "9050"),
+    ("titan6", "9050"),
+]
 
 
 class RHJob:
@@ -23,6 +47,10 @@ class RHJob:
         save_to_cache=True,
         priority=2,
         save_non_files=False,
+        submitter=None,
+        deadline=None,
+        shared_storage=False,
+        compress_download=False,
         _cli_mode=False,
     ):
         self._cli_mode = _cli_mode
@@ -38,15 +66,43 @@ class RHJob:
         self.save_non_files = save_non_files
         self.node_identifier = node_name
 
+        # Pass files by path to a node on the same host or on a shared filesystem,
+        # instead of uploading and downloading them
+        self.shared_storage = shared_storage
+        self._shared_roots = []
+        self._sent_without_upload = False
+        self._upload_inputs = False
+        self._send_digests = False
+
+        # Download all output files in one tar archive, if the node supports it
+        self.compress_download = compress_download
+        self._archive_download = False
+
         self.input_output_data = inputs.copy()
 
+        if isinstance(included_cuda_device, (list, tuple)):
+            included_cuda_devices = list(included_cuda_device)
+            included_cuda_device = (
+                included_cuda_devices[0] if included_cuda_devices else None
+            )
+        elif included_cuda_device is not None:
+            included_cuda_devices = [included_cuda_device]
+        else:
+            included_cuda_devices = None
+
+        if isinstance(deadline, datetime.datetime):
+            deadline = deadline.timestamp()
+
         self.job = JobMetaData(
             device=included_cuda_device,
+            devices=included_cuda_devices,
             check_cache=check_cache,
             save_to_cache=save_to_cache,
             priority=priority,
             directory=None,
             resources_included=resources_included,
+            submitter=submitter or _get_default_submitter(),
+            deadline=deadline,
         )
         if node_address is not None:
             self.host, self.port = node_address.split(":")
@@ -55,6 +111,8 @@ class RHJob:
             self.port = None
 
         self.ID = None
+        self.parent_job = None
+        self._address_from_manager = False
         self.strict_output_dir = False
         if output_directory is None:
             output_directory = "."
@@ -66,26 +124,43 @@ class RHJob:
             raise Exception("Specify both port and host or neither")
 
         if self.host is None:
-            if manager_address is None:
-                options = [
-                    ("manager", "8000"),
-                    ("localhost", "9050"),
-                    ("titan6", "9050"),
-                ]
-                self.manager_host, self.manager_port = self.select_manager_endpoint(
-                    options
-                )
-            else:
-                self.manager_host, self.manager_port = manager_address.split(":")
+            self._set_manager(manager_address)
 
-    @staticmethod
-    def from_parent_job(node_name, inputs, parent_job, use_same_resources=False):
+    def _set_manager(self, manager_address):
+        if manager_address is None:
+            self.manager_host, self.manager_port = self.select_manager_endpoint(
+                MANAGER_ENDPOINTS
+            )
+        else:
+            self.manager_host, self.manager_port = manager_address.split(":")
+
+    @classmethod
+    def from_parent_job(
+        cls,
+        node_name,
+        inputs,
+        parent_job,
+        use_same_resources=False,
+        parent_resources="hold",
+    ):
+        """Create a child job from within the process function of a node.
+        parent_resources decides what happens to the parent's reservation meanwhile:
+        "hold": the parent keeps it, and the child queues for its own resources.
+        "lend": the child runs on the parent's reservation if it fits in it.
+        "suspend": the parent releases its reservation while it waits for the child
+        in wait_for_finish, and gets it back afterwards. The parent should free its
+        GPU memory before waiting."""
+        assert parent_resources in [
+            "hold",
+            "lend",
+            "suspend",
+        ], "parent_resources must be one of 'hold', 'lend' or 'suspend'"
         included_device = (
-            parent_job.device
+            (parent_job.devices or parent_job.device)
             if use_same_resources or parent_job.resources_included
             else None
         )
-        return RHJob(
+        job = cls(
             node_name=node_name,
             inputs=inputs,
             check_cache=parent_job.check_cache,
@@ -94,7 +169,85 @@ class RHJob:
             resources_included=parent_job.resources_included or use_same_resources,
             included_cuda_device=included_device,
             output_directory=_create_output_directory(parent_job.directory, node_name),
+            submitter=parent_job.submitter,
+            deadline=parent_job.deadline,
         )
+        job.job.parent_queue_id = parent_job.queue_id
+        job.job.borrow_parent_resources = parent_resources == "lend"
+        if parent_resources == "suspend":
+            job.parent_job = parent_job
+        return job
+
+    @staticmethod
+    def map(
+        node_name,
+        inputs,
+        output_directory=".",
+        max_in_flight=4,
+        ordered=False,
+        retries=2,
+        max_queue_depth=None,
+        return_exceptions=False,
+        poll_interval=2,
+        on_submit=None,
+        download=True,
+        **job_kwargs,
+    ):
+        """Run a node on each input dict of an iterable, keeping at most
+        max_in_flight jobs started at a time. Yields (index, outputs) as jobs
+        finish, or in input order if ordered=True. The outputs of item i are
+        saved in output_directory/i. If inputs is a dict, its keys are used in
+        place of the indices.
+        Jobs failing from connection errors or server errors are resubmitted up to
+        `retries` times. Other failures are raised, or yielded in place of the
+        outputs if return_exceptions=True.
+        If max_queue_depth is set, no new jobs are submitted while the manager has
+        that many jobs of the node queued.
+        on_submit is called with (index, job) before each job is started.
+        With download=False, the output files are not downloaded, and their
+        references are yielded instead (see wait_for_finish).
+        Other keyword arguments are passed on to RHJob."""
+        return _map_jobs(
+            node_name,
+            inputs,
+            output_directory,
+            max_in_flight,
+            ordered,
+            retries,
+            max_queue_depth,
+            return_exceptions,
+            poll_interval,
+            on_submit,
+            download,
+            job_kwargs,
+        )
+
+    @staticmethod
+    def prefetch(node_name, inputs, priority=1, **kwargs):
+        """Compute the results of a node for each input dict of an iterable ahead
+        of time, e.g. the night before a large run, so that the jobs of the run
+        load them from the cache. The jobs run at a low priority, behind
+        interactive jobs, and their outputs are not downloaded. Returns the
+        exceptions of the failed items by index. Other keyword arguments are
+        passed on to RHJob.map."""
+        errors = {}
+        for index, output in RHJob.map(
+            node_name,
+            inputs,
+            priority=priority,
+            download=False,
+            return_exceptions=True,
+            **kwargs,
+        ):
+            if isinstance(output, Exception):
+                errors[index] = output
+        return errors
+
+    def _get_queue_depth(self):
+        url = f"http://{self.manager_host}:{self.manager_port}/manager/get_queue_depth"
+        response = _session.get(url)
+        response.raise_for_status()
+        return response.json()["queued_by_node"].get(self.node_identifier, 0)
 
     def _maybe_make_output_directory(self, output_directory):
         if not os.path.exists(output_directory):
@@ -103,7 +256,7 @@ class RHJob:
     def is_manager_endpoint_responsive(self, host, port):
         try:
             url = f"http://{host}:{port}/manager/ping"
-            response = requests.get(url, timeout=1)
+            response = _session.get(url, timeout=1)
             if response.status_code == 200:
                 return True
         except (requests.exceptions.RequestException, ValueError):
@@ -111,6 +264,12 @@ class RHJob:
         return False
 
     def select_manager_endpoint(self, options):
+        """The first responsive manager in options. Cached for all jobs of the process."""
+        return client_context.get_manager(
+            options, lambda: self._find_manager_endpoint(options)
+        )
+
+    def _find_manager_endpoint(self, options):
         for host, port in options:
             print("Looking for manager at", ":".join([host, port]), "...")
             if self.is_manager_endpoint_responsive(host, port):
@@ -129,21 +288,35 @@ class RHJob:
             return adress
 
     def _get_addr_for_job(self, node):
+        """Asks the manager where the node runs. Cached for all jobs of the process."""
+        self._address_from_manager = True
+        return client_context.get_node_address(
+            self.manager_host,
+            self.manager_port,
+            node,
+            lambda: self._fetch_addr_for_job(node),
+        )
+
+    def _fetch_addr_for_job(self, node):
         url = f"http://{self.manager_host}:{self.manager_port}/manager/dispatcher/get_host/{node}"
-        response = requests.get(url)
+        response = _session.get(url)
         response.raise_for_status()
         addr = response.json()
         addr = self._parse_endpoint(addr)
-        return addr.split(":")
+        return tuple(addr.split(":"))
 
-    def stop(self):
+    def stop(self, wait=True):
         assert self.ID is not None, "Not started"
         print("Stopping", self.ID, "...")
         url = (
             f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/stop"
         )
-        response = requests.post(url)
+        response = _session.post(url)
         response.raise_for_status()
+        _started_jobs.discard(self)
+
+        if not wait:
+            return
 
         response = None
         sucess = False
@@ -151,7 +324,7 @@ class RHJob:
             print("Trying to stop job...")
             url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/status"
 
-            response = requests.get(url)
+            response = _session.get(url)
             response.raise_for_status()
             status = response.json()
 
@@ -166,16 +339,12 @@ class RHJob:
 
         print("Stopped", self.ID)
 
-    def _split_input_output_data(self, input_output_data):
+    def _split_input_output_data(self, input_output_data, schema):
         input_data = {}
         output_data = {}
 
-        url = f"http://{self.host}:{self.port}/{self.node_identifier}/keys"
-        response = requests.get(url)
-        response.raise_for_status()
-        keys = response.json()
-        input_keys = keys["input_keys"]
-        output_keys = keys["output_keys"]
+        input_keys = schema["input_keys"]
+        output_keys = schema["output_keys"]
 
         for key, value in input_output_data.items():
             if key in input_keys:
@@ -183,16 +352,62 @@ class RHJob:
             elif key in output_keys:
                 output_data[key] = value
             else:
-                raise Exception(f"Key '{key}' not found in input or output keys")
+                raise InputKeyError(f"Key '{key}' not found in input or output keys")
         return input_data, output_data
 
+    def _get_schema(self):
+        """The input, output and file keys of the node. Cached for all jobs of the
+        process."""
+        return client_context.get_schema(
+            self.host, self.port, self.node_identifier, self._fetch_schema
+        )
+
+    def _fetch_schema(self):
+        """Nodes without the /schema endpoint also lack /jobs/submit, which is
+        recorded as "legacy"."""
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/schema"
+        response = _session.get(url)
+        if response.status_code == 404:
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/keys"
+            response = _session.get(url)
+            response.raise_for_status()
+            schema = response.json()
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/filename_keys"
+            response = _session.get(url)
+            response.raise_for_status()
+            schema["file_keys"] = response.json()
+            schema["legacy"] = True
+        else:
+            response.raise_for_status()
+            schema = response.json()
+            schema["legacy"] = False
+        return schema
+
+    def _forget_node(self, error):
+        """Drops the cached address and schema of the node if the error suggests
+        they are outdated. Returns True if the submission should be retried."""
+        if isinstance(error, requests.exceptions.ConnectionError):
+            if not self._address_from_manager:
+                return False
+        elif isinstance(error, HTTPError) and error.response is not None:
+            version = error.response.headers.get(SCHEMA_VERSION_HEADER)
+            if not client_context.schema_is_stale(
+                self.host, self.port, self.node_identifier, version
+            ):
+                return False
+        elif not isinstance(error, InputKeyError):
+            return False
+        client_context.invalidate_node(self.host, self.port, self.node_identifier)
+        return True
+
     def print_cli_help(self):
         if not self.host:
             self.host, self.port = self._get_addr_for_job(self.node_identifier)
 
         self._print_help_cli()
 
-    def start(self):
+    def _prepare_start(self):
+        """Finds the node and splits the inputs into files and non-files"""
         assert self.ID is None, "Already started"
 
         if not self.host:
@@ -201,35 +416,330 @@ class RHJob:
         if self._cli_mode:
             self.input_output_data = self._parse_cli(self.input_output_data)
 
+        schema = self._get_schema()
+        inputs = self._split_inputs(schema)
+        if self._address_from_manager and self.job.check_cache:
+            addr = self._get_addr_with_cached_result(schema)
+            if addr is not None and addr != (self.host, self.port):
+                self.host, self.port = addr
+                schema = self._get_schema()
+                inputs = self._split_inputs(schema)
+        return (schema, *inputs)
+
+    def _get_cache_key(self, schema):
+        """The key the node will cache the result of the job with, or None if it
+        cannot be known before the job runs"""
+        spec = schema.get("cache_key")
+        if spec is None:
+            return None
+        hashes = []
+        try:
+            for key, is_file, default in spec["inputs"]:
+                if key not in self.input_data:
+                    hashes.append(hash_cache_key_value(default))
+                elif isinstance(self.input_data[key], OutputReference):
+                    return None
+                elif is_file and self.input_data[key] is not None:
+                    path = Path(self.input_data[key]).resolve()
+                    hashes.append(client_context.digests.digest(path))
+                else:
+                    hashes.append(hash_cache_key_value(self.input_data[key]))
+        except OSError:
+            return None
+        return combine_cache_key(hashes, spec["version"])
+
+    def _get_addr_with_cached_result(self, schema):
+        """The host most likely to have the result of the job in its cache,
+        according to the cache indexes of the manager, or None"""
+        indexes = client_context.get_cache_indexes(
+            self.manager_host,
+            self.manager_port,
+            self.node_identifier,
+            self._fetch_cache_indexes,
+        )
+        # The digests of the input files are reused for the upload
+        cache_key = self._get_cache_key(schema) if indexes else None
+        return self._find_cached_result(indexes, cache_key)
+
+    def _fetch_cache_indexes(self):
+        url = f"http://{self.manager_host}:{self.manager_port}/manager/dispatcher/cache_indexes/{self.node_identifier}"
+        try:
+            response = _session.get(url)
+            response.raise_for_status()
+            return {
+                addr: CacheKeyFilter(**index) for addr, index in response.json().items()
+            }
+        except (requests.RequestException, ValueError):
+            # E.g. a manager without cache-aware dispatch
+            return {}
+
+    def _find_cached_result(self, indexes, cache_key):
+        if cache_key is None:
+            return None
+        for addr, index in indexes.items():
+            if cache_key in index:
+                return tuple(self._parse_endpoint(addr).split(":"))
+        return None
+
+    def _split_inputs(self, schema):
+        """Splits the inputs into non-file inputs, file inputs and output paths"""
         self.input_data, self.output_data = self._split_input_output_data(
-            self.input_output_data
+            self.input_output_data, schema
         )
 
         input_data = replace_paths_with_strings(self.input_data)
+        self._archive_download = schema.get("download_archive", False)
+        self._send_digests = schema.get("digests", False)
+        if self.shared_storage:
+            self._shared_roots = [Path(root) for root in schema.get("shared_storage", [])]
 
-        url = f"http://{self.host}:{self.port}/{self.node_identifier}/filename_keys"
-        print(url)
-        response = requests.get(url)
-        response.raise_for_status()
-        file_keys = response.json()
         input_data_files = {}
         input_data_not_files = {}
         for key, value in input_data.items():
-            if key in file_keys:
+            if key in schema["file_keys"]:
                 input_data_files[key] = value
             else:
                 input_data_not_files[key] = value
 
-        ## Setup the thing
-        print(input_data_not_files)
+        if not schema.get("output_references") and any(
+            isinstance(value, OutputReference) for value in input_data_files.values()
+        ):
+            raise ValueError(
+                f"The {self.node_identifier} node does not accept output references"
+            )
+        return input_data_not_files, input_data_files
+
+    def output_reference(self, key):
+        """Refer to an output file of this job, to use it as the input of another
+        job without downloading it. The job must have finished."""
+        assert self.ID is not None, "Not started"
+        return OutputReference(
+            node=self.node_identifier,
+            job_id=self.ID,
+            key=key,
+            host=self.host,
+            port=self.port,
+        )
+
+    def start(self):
+        try:
+            self._start()
+        except Exception as e:
+            if self.ID is not None:
+                raise
+            if self._upload_required(e):
+                print("The node cannot use the files without upload, uploading instead...")
+                self._upload_inputs = True
+            # The node may have moved or changed since it was cached
+            elif self._forget_node(e):
+                print("Cached node information is outdated, retrying...")
+                if self._address_from_manager:
+                    self.host, self.port = None, None
+            else:
+                raise
+            self._start()
+
+    def _upload_required(self, error):
+        """True if the node could not use the input files sent as paths on shared
+        storage or as blobs it stores, so that they must be uploaded"""
+        status_code = getattr(error, "status_code", None)
+        if status_code is None:
+            status_code = getattr(getattr(error, "response", None), "status_code", None)
+        return self._sent_without_upload and not self._upload_inputs and status_code == 409
+
+    def _is_shared_path(self, path):
+        return any(is_relative_to(path, root) for root in self._shared_roots)
+
+    def _start(self):
+        schema, input_data_not_files, input_data_files = self._prepare_start()
+
+        if schema["legacy"]:
+            self._create_upload_and_start(input_data_not_files, input_data_files)
+        else:
+            self._submit(input_data_not_files, input_data_files)
+        self._started()
+
+    def _started(self):
+        print(self.node_identifier, "job submitted with ID:", self.ID, "to", self.host)
+        _started_jobs.add(self)
+
+    def _form_fields(
+        self,
+        stack,
+        input_data_not_files,
+        input_data_files,
+        prefix="",
+        known_blobs=frozenset(),
+    ):
+        """The multipart fields of the job for /jobs/submit and /jobs/submit_many.
+        Files with a digest in known_blobs are not uploaded, see _known_blobs."""
+        fields = [
+            (prefix + "inputs", (None, json.dumps(input_data_not_files), "application/json")),
+            (prefix + "job", (None, self.job.json(), "application/json")),
+        ]
+        self._sent_without_upload = False
+        for key, value in input_data_files.items():
+            if isinstance(value, OutputReference):
+                fields.append((prefix + "ref." + key, (None, value.json(), "application/json")))
+                continue
+            path = Path(value).resolve()
+            if not self._upload_inputs and self._is_shared_path(path):
+                digest = client_context.digests.digest(path)
+                fields.append((prefix + "path." + key, (None, str(path))))
+                fields.append((prefix + "digest." + key, (None, digest)))
+                self._sent_without_upload = True
+                continue
+
+            if self._send_digests:
+                digest = client_context.digests.digest(path)
+                fields.append((prefix + "digest." + key, (None, digest)))
+                if not self._upload_inputs and digest in known_blobs:
+                    fields.append((prefix + "blob." + key, (None, os.path.basename(value))))
+                    self._sent_without_upload = True
+                    continue
+            f = stack.enter_context(open(value, "rb"))
+            fields.append((prefix + "file." + key, (os.path.basename(value), f)))
+        return fields
+
+    def _upload_digests(self, input_data_files):
+        """The SHA-256 of the input files that are to be uploaded, if the node
+        takes digests"""
+        if not self._send_digests:
+            return {}
+        return {
+            key: client_context.digests.digest(value)
+            for key, value in input_data_files.items()
+            if not isinstance(value, OutputReference)
+            and (self._upload_inputs or not self._is_shared_path(Path(value).resolve()))
+        }
+
+    def _known_blobs(self, digests):
+        """Ask the node which of the files it already stores, so that they need
+        not be uploaded"""
+        if not digests or self._upload_inputs:
+            return set()
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/blobs/has"
+        try:
+            response = _session.post(url, json=sorted(digests))
+            response.raise_for_status()
+            return set(response.json())
+        except requests.RequestException:
+            return set()
+
+    def _submit(self, input_data_not_files, input_data_files):
+        """Create, upload and start the job in one request"""
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/submit"
+        print(f"Submitting new job to {self.host}:{self.port}")
+        known_blobs = self._known_blobs(
+            set(self._upload_digests(input_data_files).values())
+        )
+        with ExitStack() as stack:
+            files = self._form_fields(
+                stack, input_data_not_files, input_data_files, known_blobs=known_blobs
+            )
+            response = _session.post(url, files=files)
+        response.raise_for_status()
+        self.ID = response.json()
+
+    @staticmethod
+    def start_many(jobs, return_exceptions=False):
+        """Start several jobs. Jobs for the same node are created and started in a
+        single request. Returns a list with None for each started job, and the
+        exception for each job that could not be started if return_exceptions=True.
+        Otherwise the first such exception is raised."""
+        errors = [None] * len(jobs)
+        groups = {}
+        for i, job in enumerate(jobs):
+            try:
+                schema, input_data_not_files, input_data_files = job._prepare_start()
+                if schema["legacy"]:
+                    job._create_upload_and_start(input_data_not_files, input_data_files)
+                    job._started()
+                else:
+                    node = (job.host, job.port, job.node_identifier)
+                    groups.setdefault(node, []).append(
+                        (i, job, input_data_not_files, input_data_files)
+                    )
+            except Exception as e:
+                job._forget_node(e)
+                errors[i] = e
+
+        for (host, port, node_name), group in groups.items():
+            url = f"http://{host}:{port}/{node_name}/jobs/submit_many"
+            print(f"Submitting {len(group)} new jobs to {host}:{port}")
+            # One handshake for the files of all jobs of the group
+            digests = set()
+            for i, job, input_data_not_files, input_data_files in group:
+                try:
+                    digests.update(job._upload_digests(input_data_files).values())
+                except Exception as e:
+                    errors[i] = e
+            known_blobs = group[0][1]._known_blobs(digests)
+
+            with ExitStack() as stack:
+                files = []
+                submitted = []
+                for i, job, input_data_not_files, input_data_files in group:
+                    if errors[i] is not None:
+                        continue
+                    try:
+                        files += job._form_fields(
+                            stack,
+                            input_data_not_files,
+                            input_data_files,
+                            f"{len(submitted)}.",
+                            known_blobs,
+                        )
+                        submitted.append((i, job))
+                    except Exception as e:
+                        errors[i] = e
+                if not submitted:
+                    continue
+                try:
+                    response = _session.post(url, files=files)
+                    response.raise_for_status()
+                    results = response.json()
+                except Exception as e:
+                    submitted[0][1]._forget_node(e)
+                    for i, _ in submitted:
+                        errors[i] = e
+                    continue
+
+            for (i, job), result in zip(submitted, results):
+                if "job_id" in result:
+                    job.ID = result["job_id"]
+                    job._started()
+                else:
+                    errors[i] = JobSubmissionError(
+                        f"The job could not be submitted: {result['error']}",
+                        result["status_code"],
+                    )
+
+        # Upload the files of jobs whose paths or blobs were rejected
+        for i, job in enumerate(jobs):
+            if errors[i] is not None and job._upload_required(errors[i]):
+                job._upload_inputs = True
+                try:
+                    job.start()
+                    errors[i] = None
+                except Exception as e:
+                    errors[i] = e
+
+        if not return_exceptions:
+            for error in errors:
+                if error is not None:
+                    raise error
+        return errors
+
+    def _create_upload_and_start(self, input_data_not_files, input_data_files):
+        """Submit the job to nodes without the /jobs/submit endpoint"""
         url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs"
         print(f"Creating new job on {self.host}:{self.port}")
-        response = requests.post(url, json=input_data_not_files)
+        response = _session.post(url, json=input_data_not_files)
         response.raise_for_status()
         self.ID = response.json()
 
         ## Upload the files
-        data = {}
         for key, value in input_data_files.items():
             url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/upload"
             with open(value, "rb") as f:
@@ -240,104 +750,268 @@ class RHJob:
                     value,
                 )
                 files = {"file": f}
-                data["key"] = key
-                response = requests.post(url, files=files, data=data)
+                response = _session.post(url, files=files, data={"key": key})
                 response.raise_for_status()
 
-        ## RUN The thing
-
-        # data = {"test": "hejsa"}
-        print(data)
         print(f"Starting job on {self.host}:{self.port} with ID:", self.ID)
         url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/start"
-        response = requests.post(url, json=self.job.dict())
+        response = _session.post(url, json=self.job.dict())
         response.raise_for_status()
 
-        print(self.node_identifier, "job submitted with ID:", self.ID, "to", self.host)
-
     def _get_status(self):
         url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/status"
 
-        response = requests.get(url)
+        response = _session.get(url)
         response.raise_for_status()
         response_json = response.json()
         status = response_json
         return status
 
-    def wait_for_finish(self):
+    def wait_for_finish(self, download=True):
+        """Wait for the job to finish and return its outputs. With download=False,
+        output files are returned as references (see output_reference) instead of
+        being downloaded."""
         assert self.ID is not None, "Not started"
-        if self.strict_output_dir:
-            output_path = self.output_directory
-        else:
-            output_path = _create_output_directory_name(self.output_directory, self.node_identifier)
+        with _suspend_parent_resources(self.parent_job):
+            return self._wait_for_finish(download)
+
+    def _poll(self, status=None):
+        """Returns the status of the job and its output data once it has finished.
+        Raises if the job failed or was cancelled. The status is fetched unless
+        given."""
+        if status is None:
+            status = JobStatus(self._get_status())
+        if status == JobStatus.Finished:
+            _started_jobs.discard(self)
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/data"
+            response = _session.get(url)
+            response.raise_for_status()
+            return status, response.json()
+        elif status in [JobStatus.Error, JobStatus.Cancelled]:
+            _started_jobs.discard(self)
+            url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/error"
+            response = _session.get(url)
+            response.raise_for_status()
+            raise _job_error(status, response.json())
+        return status, None
 
+    def _wait_for_finish(self, download=True):
         output = None
         while output is None:
-            status = self._get_status()
-            if JobStatus(status) == JobStatus.Finished:
-                url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/data"
-                response = requests.get(url)
-                response.raise_for_status()
-                output = response.json()
-            elif JobStatus(status) == JobStatus.Error:
-                url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/error"
-                response = requests.get(url)
-                response.raise_for_status()
-                response_json = response.json()
-                raise JobFailedError(
-                    "The job exited with an error: "
-                    + response_json["error"]
-                    + response_json["traceback"]
-                )
-            elif JobStatus(status) == JobStatus.Cancelled:
-                raise JobCancelledError("The job was cancelled")
-            elif JobStatus(status) == JobStatus.Queued:
+            status, output = self._poll()
+            if status == JobStatus.Queued:
                 time.sleep(10)
-            elif JobStatus(status) == JobStatus.Running:
+            elif status == JobStatus.Running:
                 time.sleep(4)
 
+        if not download:
+            return self._reference_outputs(output)
+        return self._download_outputs(output)
+
+    def _get_output_path(self):
+        if self.strict_output_dir:
+            return self.output_directory
+        return _create_output_directory_name(self.output_directory, self.node_identifier)
+
+    def _get_download_path(self, key, headers, output_path):
+        """Where to save the downloaded file of an output key"""
+        fname = headers["Content-Disposition"].split("=")[1].replace('"', "")
+        return self._get_output_file_path(key, fname, output_path)
+
+    def _get_output_file_path(self, key, fname, output_path):
+        if key in self.output_data.keys():
+            return Path(self.output_data[key]).absolute()
+        self._maybe_make_output_directory(output_path)
+        return Path(os.path.join(output_path, fname)).absolute()
+
+    def _get_output_paths(self):
+        """Paths of the output files on shared storage, or {} if not used"""
+        if not self.shared_storage or not self._shared_roots:
+            return {}
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/paths"
+        response = _session.get(url)
+        response.raise_for_status()
+        return response.json()
+
+    def _link_outputs(self, output, paths, output_path):
+        """Copy the output files on shared storage into the output directory, as
+        reflinks where possible. They are not hardlinked, as the files of the node
+        are shared with its other jobs and its cache. Files that are not visible
+        with the expected content here are left for download. Returns the keys
+        of the copied files."""
+        linked = set()
+        for key, info in paths.items():
+            src = info["path"]
+            if not os.path.isfile(src):
+                continue
+            fname = self._get_output_file_path(key, os.path.basename(src), output_path)
+            if os.path.lexists(fname):
+                os.remove(fname)
+            clone_or_copy(src, fname)
+            if client_context.digests.digest(fname) != info["digest"]:
+                print("The shared file", src, "does not match its digest, downloading...")
+                os.remove(fname)
+                continue
+            print("Copied", key, "from shared storage")
+            output[key] = fname
+            linked.add(key)
+        return linked
+
+    def _save_non_file(self, key, value, output_path):
+        if key in self.output_data.keys():
+            fname = Path(self.output_data[key]).absolute()
+
+            with open(fname, "w") as f:
+                f.write(str(value))
+
+        elif self.save_non_files:
+            self._maybe_make_output_directory(output_path)
+            fname = Path(os.path.join(output_path, key)).absolute()
+
+            with open(fname, "w") as f:
+                f.write(str(value))
+
+    def _reference_outputs(self, output):
+        """Replace the download links of the output files with references"""
+        output_path = self._get_output_path()
         for key, value in output.items():
-            if isinstance(value, str) and "/download/" in value:
-                print("Downloading", key, "...")
-                url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/download/{key}"
+            if _is_download_link(value):
+                output[key] = self.output_reference(key)
+            else:
+                self._save_non_file(key, value, output_path)
+        return output
 
-                response = requests.get(url)
-                response.raise_for_status()
+    def _get_archive_url(self, keys):
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/download.tar"
+        compress = "true" if self.compress_download else "false"
+        return f"{url}?keys={','.join(keys)}&compress={compress}"
 
-                if not key in self.output_data.keys():
-                    fname = (
-                        response.headers["Content-Disposition"]
-                        .split("=")[1]
-                        .replace('"', "")
-                    )
-                    self._maybe_make_output_directory(output_path)
-                    fname = Path(os.path.join(output_path, fname)).absolute()
+    def _extract_archive(self, fileobj, output, output_path):
+        """Extract the output archive of the job as it is read from fileobj, and
+        set the output paths. Returns the extracted keys."""
+        extracted = set()
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                key = member.pax_headers.get(ARCHIVE_KEY_HEADER)
+                name = Path(member.name)
+                if (
+                    key not in output
+                    or name.is_absolute()
+                    or ".." in name.parts
+                    or not (member.isfile() or member.isdir())
+                ):
+                    raise ValueError(f"Unexpected member in output archive: {member.name}")
+
+                # The first member of each key is the output file or directory itself
+                if key in self.output_data.keys():
+                    dest = Path(self.output_data[key]).absolute().joinpath(*name.parts[1:])
                 else:
-                    fname = Path(self.output_data[key]).absolute()
+                    self._maybe_make_output_directory(output_path)
+                    dest = Path(output_path, name).absolute()
+                if key not in extracted:
+                    print("Downloading", key, "...")
+                    output[key] = dest
+                    extracted.add(key)
 
-                with open(fname, "wb") as f:
-                    f.write(response.content)
-                output[key] = fname
+                if member.isdir():
+                    os.makedirs(dest, exist_ok=True)
+                    continue
+                os.makedirs(dest.parent, exist_ok=True)
+                hash_object = hashlib.sha256()
+                with tar.extractfile(member) as src, open(dest, "wb") as f:
+                    while chunk := src.read(DOWNLOAD_CHUNK_SIZE):
+                        hash_object.update(chunk)
+                        f.write(chunk)
+                _check_download(
+                    dest,
+                    member.pax_headers.get(ARCHIVE_DIGEST_HEADER),
+                    hash_object.hexdigest(),
+                )
+        return extracted
 
-            elif key in self.output_data.keys():
-                fname = Path(self.output_data[key]).absolute()
+    def _download_archive(self, output, keys, output_path):
+        with _session.get(self._get_archive_url(keys), stream=True) as response:
+            response.raise_for_status()
+            return self._extract_archive(response.raw, output, output_path)
+
+    def _get_output_digests(self):
+        """File names and digests of the output files, or {} if not supported"""
+        if not self._send_digests:
+            return {}
+        url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/digests"
+        response = _session.get(url)
+        response.raise_for_status()
+        return response.json()
 
-                with open(fname, "w") as f:
-                    f.write(str(value))
+    def _reuse_local_outputs(self, output, digests, output_path):
+        """Use files with the same content as output files, that are already in
+        the output directory or that were uploaded or downloaded before, instead
+        of downloading them. Returns the keys of the reused outputs."""
+        reused = set()
+        for key, info in digests.items():
+            if not _is_download_link(output.get(key)):
+                continue
+            fname = self._get_output_file_path(key, info["name"], output_path)
+            if not (
+                os.path.isfile(fname)
+                and client_context.digests.digest(fname) == info["digest"]
+            ):
+                src = client_context.digests.find(info["digest"])
+                if src is None:
+                    continue
+                # Copied, not linked, as src may be an input of the user
+                shutil.copyfile(src, fname)
+                client_context.digests.add(fname, info["digest"])
+            print("Using local copy of", key)
+            output[key] = fname
+            reused.add(key)
+        return reused
 
-            elif self.save_non_files:
-                self._maybe_make_output_directory(output_path)
-                fname = Path(os.path.join(output_path, key)).absolute()
+    def _download_outputs(self, output):
+        output_path = self._get_output_path()
+        linked = self._link_outputs(output, self._get_output_paths(), output_path)
+        if any(_is_download_link(output[key]) for key in output if key not in linked):
+            linked = linked | self._reuse_local_outputs(
+                output, self._get_output_digests(), output_path
+            )
 
-                with open(fname, "w") as f:
-                    f.write(str(value))
+        keys = [
+            key
+            for key, value in output.items()
+            if key not in linked and _is_download_link(value)
+        ]
+        if self._archive_download and keys:
+            linked = linked | self._download_archive(output, keys, output_path)
+
+        for key, value in output.items():
+            if key in linked:
+                continue
+            if _is_download_link(value):
+                print("Downloading", key, "...")
+                url = f"http://{self.host}:{self.port}/{self.node_identifier}/jobs/{self.ID}/download/{key}"
+
+                with _session.get(url, stream=True) as response:
+                    response.raise_for_status()
+                    fname = self._get_download_path(key, response.headers, output_path)
+                    hash_object = hashlib.sha256()
+                    with open(fname, "wb") as f:
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            hash_object.update(chunk)
+                            f.write(chunk)
+                _check_download(
+                    fname, response.headers.get(DIGEST_HEADER), hash_object.hexdigest()
+                )
+                output[key] = fname
+
+            else:
+                self._save_non_file(key, value, output_path)
 
         return output
 
     def _parse_cli(self, input_output_data):
         try:
             url = f"http://{self.host}:{self.port}/{self.node_identifier}/cli/parse"
-            response = requests.post(url, json=input_output_data)
+            response = _session.post(url, json=input_output_data)
             response.raise_for_status()
 
         except HTTPError as err:
@@ -352,7 +1026,7 @@ class RHJob:
 
     def _print_help_cli(self):
         url = f"http://{self.host}:{self.port}/{self.node_identifier}/cli/help"
-        response = requests.get(url)
+        response = _session.get(url)
         response.raise_for_status()
         print(response.json())
 
@@ -368,6 +1042,364 @@ def replace_paths_with_strings(inp):
     return inp
 
 
+def _is_download_link(value):
+    return isinstance(value, str) and ("/download/" in value or "/download.tar" in value)
+
+
+def _check_download(fname, expected_digest, digest):
+    """Check a downloaded file against the digest sent by the node, and remember
+    its digest"""
+    if expected_digest is not None and expected_digest != digest:
+        os.remove(fname)
+        raise IOError(f"The download of {fname} is corrupt, its digest does not match")
+    client_context.digests.add(fname, digest)
+
+
+def _job_error(status, error):
+    """The exception for a job that ended with status Error or Cancelled, given
+    the response of its /error endpoint"""
+    if status == JobStatus.Error:
+        return JobFailedError(
+            "The job exited with an error: " + error["error"] + error["traceback"]
+        )
+    if error and error["error"] == DEADLINE_EXCEEDED:
+        return JobDeadlineExceededError(error["traceback"])
+    return JobCancelledError("The job was cancelled")
+
+
+def _is_transient_error(error):
+    if isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    ):
+        return True
+    if isinstance(error, HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    if isinstance(error, JobSubmissionError):
+        return error.status_code >= 500
+    return False
+
+
+def _get_statuses(jobs):
+    """Status of each started job, with one request per node. Jobs whose status
+    could not be fetched map to the exception."""
+    statuses = {}
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job.host, job.port, job.node_identifier), []).append(job)
+
+    for node, group in groups.items():
+        try:
+            if group[0]._get_schema()["legacy"]:
+                for job in group:
+                    statuses[job] = JobStatus(job._get_status())
+                continue
+
+            host, port, node_name = node
+            url = f"http://{host}:{port}/{node_name}/jobs/status"
+            response = _session.post(url, json=[job.ID for job in group])
+            response.raise_for_status()
+            result = response.json()["jobs"]
+            for job in group:
+                if result[job.ID] is None:
+                    statuses[job] = JobFailedError("The job is unknown to the node")
+                else:
+                    statuses[job] = JobStatus(result[job.ID])
+        except Exception as e:
+            group[0]._forget_node(e)
+            for job in group:
+                statuses.setdefault(job, e)
+    return statuses
+
+
+def _map_jobs(
+    node_name,
+    inputs,
+    output_directory,
+    max_in_flight,
+    ordered,
+    retries,
+    max_queue_depth,
+    return_exceptions,
+    poll_interval,
+    on_submit,
+    download,
+    job_kwargs,
+):
+    """Generator behind RHJob.map. All jobs are polled from this thread."""
+    job_kwargs = dict(job_kwargs)
+    items = iter(inputs.items()) if isinstance(inputs, dict) else enumerate(inputs)
+    items_left = True
+    in_flight = {}  # index -> (job, inputs, attempt)
+    to_retry = deque()  # (time to retry, index, inputs, attempt)
+    finished = {}  # index -> outputs, only used if ordered
+    order = deque()  # indices not yet yielded, only used if ordered
+    last_job = None
+    throttled_until = 0
+
+    def queue_is_full():
+        nonlocal throttled_until
+        # Jobs sent directly to a node address do not go through a manager
+        if max_queue_depth is None or not hasattr(last_job, "manager_host"):
+            return False
+        if time.time() < throttled_until:
+            return True
+        try:
+            full = last_job._get_queue_depth() >= max_queue_depth
+        except requests.exceptions.RequestException:
+            full = False
+        if full:
+            throttled_until = time.time() + poll_interval
+        return full
+
+    def failed(index, item_inputs, attempt, error):
+        """Returns the exception to report, or None if the item is retried"""
+        if _is_transient_error(error) and attempt < retries:
+            print(f"Item {index} failed with {error!r}, retrying...")
+            delay = poll_interval * 2**attempt
+            to_retry.append((time.time() + delay, index, item_inputs, attempt + 1))
+            return None
+        if not return_exceptions:
+            raise error
+        return error
+
+    try:
+        while True:
+            done = []
+
+            # Submit jobs until max_in_flight is reached
+            new = []  # (index, inputs, attempt, job)
+            while len(in_flight) + len(new) < max_in_flight and not queue_is_full():
+                if to_retry and to_retry[0][0] <= time.time():
+                    _, index, item_inputs, attempt = to_retry.popleft()
+                elif items_left:
+                    try:
+                        index, item_inputs = next(items)
+                        attempt = 0
+                        if ordered:
+                            order.append(index)
+                    except StopIteration:
+                        items_left = False
+                        break
+                else:
+                    break
+
+                job = RHJob(
+                    node_name=node_name,
+                    inputs=item_inputs,
+                    output_directory=os.path.join(output_directory, str(index)),
+                    **job_kwargs,
+                )
+                if last_job is None and job.host is None:
+                    # Look for the manager only once
+                    job_kwargs["manager_address"] = (
+                        f"{job.manager_host}:{job.manager_port}"
+                    )
+                last_job = job
+                if on_submit is not None:
+                    on_submit(index, job)
+                new.append((index, item_inputs, attempt, job))
+
+            errors = RHJob.start_many([job for *_, job in new], return_exceptions=True)
+            for (index, item_inputs, attempt, job), error in zip(new, errors):
+                if error is None:
+                    in_flight[index] = (job, item_inputs, attempt)
+                else:
+                    error = failed(index, item_inputs, attempt, error)
+                    if error is not None:
+                        done.append((index, error))
+
+            if not (in_flight or to_retry or items_left or done):
+                break
+
+            statuses = _get_statuses([job for job, _, _ in in_flight.values()])
+            for index, (job, item_inputs, attempt) in list(in_flight.items()):
+                try:
+                    if isinstance(statuses[job], Exception):
+                        raise statuses[job]
+                    _, output = job._poll(statuses[job])
+                    if output is None:
+                        continue
+                    if download:
+                        output = job._download_outputs(output)
+                    else:
+                        output = job._reference_outputs(output)
+                except Exception as e:
+                    output = failed(index, item_inputs, attempt, e)
+                    if output is None:
+                        del in_flight[index]
+                        continue
+                del in_flight[index]
+                done.append((index, output))
+
+            for index, output in done:
+                if ordered:
+                    finished[index] = output
+                else:
+                    yield index, output
+
+            while order and order[0] in finished:
+                index = order.popleft()
+                yield index, finished.pop(index)
+
+            if not done:
+                time.sleep(poll_interval)
+    finally:
+        # Stop what is still running if the caller stops iterating or an error is raised
+        for job, _, _ in in_flight.values():
+            try:
+                job.stop(wait=False)
+            except Exception as e:
+                print("Could not stop job", job.ID, ":", e)
+
+
+# Jobs started by this process that have not reached a terminal state
+_started_jobs = set()
+
+
+def stop_started_jobs():
+    """Stop all unfinished jobs started by this process without waiting for them.
+    Used when a node job is cancelled, so that the cancellation cascades to its
+    child jobs (and through them to theirs)."""
+    for job in list(_started_jobs):
+        try:
+            # The blocking stop, also for AsyncRHJob
+            RHJob.stop(job, wait=False)
+        except Exception as e:
+            print("Could not stop", job.ID, ":", e)
+
+
+class _ParentSuspension:
+    """Child waits of one parent job that currently hold its resources released"""
+
+    def __init__(self):
+        # Guards the fields below. Not held while waiting for the manager to give
+        # the resources back, so that other waits are not blocked by it.
+        self.lock = threading.Lock()
+        self.num_waiting = 0
+        self.suspended = False
+        # A thread is waiting for the resources to come back. It suspends the
+        # parent again if new waits started in the meantime.
+        self.resuming = False
+        # Threads using this entry, so it is dropped once nobody needs it
+        self.num_users = 0
+
+
+# queue_id -> _ParentSuspension. The lock only guards the dict itself.
+_suspended_parents = {}
+_suspended_parents_lock = threading.Lock()
+
+# Seconds a parent without a deadline waits to get its resources back after its
+# child jobs finish
+RESUME_TIMEOUT = float(os.environ.get("RH_RESUME_TIMEOUT_MINUTES", 60)) * 60
+
+
+@contextmanager
+def _suspend_parent_resources(parent_job):
+    """Release the parent job's reservation while the caller waits for a child job.
+    Concurrent waits for children of the same parent suspend it only once. An
+    error while getting the resources back does not replace an error of the wait,
+    but is printed instead."""
+    if parent_job is None or parent_job.queue_id is None:
+        yield
+        return
+
+    queue_id = parent_job.queue_id
+    with _suspended_parents_lock:
+        suspension = _suspended_parents.setdefault(queue_id, _ParentSuspension())
+        suspension.num_users += 1
+    try:
+        with suspension.lock:
+            suspension.num_waiting += 1
+            if not suspension.suspended and not suspension.resuming:
+                try:
+                    _post_suspend(parent_job)
+                except Exception:
+                    suspension.num_waiting -= 1
+                    raise
+                suspension.suspended = True
+        try:
+            yield
+        except BaseException:
+            try:
+                _end_parent_suspension(parent_job, suspension)
+            except Exception as e:
+                print("Could not get the resources of", queue_id, "back:", e)
+            raise
+        _end_parent_suspension(parent_job, suspension)
+    finally:
+        with _suspended_parents_lock:
+            suspension.num_users -= 1
+            if suspension.num_users == 0:
+                del _suspended_parents[queue_id]
+
+
+def _end_parent_suspension(parent_job, suspension):
+    """Resume the parent once the last of its waits ends"""
+    with suspension.lock:
+        suspension.num_waiting -= 1
+        if suspension.num_waiting > 0 or not suspension.suspended:
+            return
+        _post_resume(parent_job)
+        suspension.suspended = False
+        suspension.resuming = True
+    try:
+        _wait_until_resumed(parent_job)
+    except Exception:
+        with suspension.lock:
+            suspension.resuming = False
+        raise
+    with suspension.lock:
+        suspension.resuming = False
+        # Waits that started in the meantime did not suspend the parent
+        if suspension.num_waiting > 0:
+            try:
+                _post_suspend(parent_job)
+                suspension.suspended = True
+            except Exception as e:
+                print("Could not suspend resources of", parent_job.queue_id, ":", e)
+
+
+def _post_suspend(parent_job):
+    print("Suspending resources of", parent_job.queue_id, "...")
+    url = parent_job.manager_endpoint + f"/suspend_job/{parent_job.queue_id}"
+    response = _session.post(url)
+    response.raise_for_status()
+
+
+def _post_resume(parent_job):
+    """Queue the parent for its resources again"""
+    print("Resuming resources of", parent_job.queue_id, "...")
+    url = parent_job.manager_endpoint + f"/resume_job/{parent_job.queue_id}"
+    response = _session.post(url)
+    response.raise_for_status()
+
+
+def _wait_until_resumed(parent_job):
+    """Wait until the manager has given the parent its resources back, at most
+    until the deadline of the parent or for RESUME_TIMEOUT seconds"""
+    queue_id = parent_job.queue_id
+    deadline = parent_job.deadline or time.time() + RESUME_TIMEOUT
+    url = parent_job.manager_endpoint + f"/is_job_active/{queue_id}"
+    while True:
+        response = _session.get(url)
+        response.raise_for_status()
+        status = response.json()
+        if status["is_active"]:
+            return
+        if status.get("expired") or time.time() > deadline:
+            raise RuntimeError(
+                f"Resources of {queue_id} were not given back by the manager"
+            )
+        time.sleep(3)
+
+
+def _get_default_submitter():
+    """Identifies the user for fair-share scheduling in the manager"""
+    if submitter := os.environ.get("RH_SUBMITTER"):
+        return submitter
+    return getpass.getuser() + "@" + socket.gethostname()
+
+
 def _create_output_directory_name(base_directory, node_name):
     directory = os.path.join(base_directory, node_name)
     i = 1
@@ -1,13 +1,19 @@
 import multiprocessing
 from abc import ABC, abstractmethod
-from pydantic import BaseModel, FilePath
+from pydantic import BaseModel, FilePath, DirectoryPath
 import requests
 import asyncio
 import uuid
-from .cache import Cache
+from .cache import Cache, DigestIndex, DirectoryCacheBackend, UnsafeCacheEntryError
+from .blobstore import BlobStore, link_or_copy
 from .rhjob import *
 from .common import *
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 from fastapi import FastAPI, File, Form, UploadFile, BackgroundTasks
 from .rhprocess import RHProcess
 from .frontend import setup_frontend_routes
@@ -16,10 +22,23 @@ from fastapi import Response
 from fastapi import HTTPException
 from .email import EmailSender
 import datetime
+import resource
+import signal
+import sys
 from fastapi import Request
 from .version import __version__
+from pydantic import ValidationError
+import json
+import hashlib
+import shutil
+import inspect
+import tarfile
+import tempfile
+import zlib
 
 MANAGER_URL = "http://manager:8000/manager"
+# (connect, read) seconds when fetching output references from other nodes
+OUTPUT_REFERENCE_TIMEOUT = (5, 60)
 
 
 class RHNode(ABC, FastAPI):
@@ -28,13 +47,18 @@ class RHNode(ABC, FastAPI):
     input_spec: BaseModel
     output_spec: BaseModel
     name: str
-    cache_size = 3
+    cache_size = 3  # Per cache directory, None for no limit
+    cache_max_gb = None  # Per cache directory, None for no limit
     requires_gpu = True
-    cache_directory = ".cache"
+    cache_directory = ".cache"  # Or a list of directories, e.g. one per disk
+    cache_version = None  # Change to invalidate the cache, see get_cache_version
     output_directory = ".outputs"  # Where the output files are stored for each job
     input_directory = ".inputs"  # Where the input files are stored for each job
+    blob_directory = ".blobs"  # Where each distinct file content is stored once
 
-    required_gb_gpu_memory = None
+    required_gb_gpu_memory = None  # Per device
+    required_num_gpus = 1
+    required_gpu_share = 0  # Fraction of a device's compute, for nodes sharing a GPU
     required_num_threads = None
     required_gb_memory = None
 
@@ -44,10 +68,6 @@ class RHNode(ABC, FastAPI):
             openapi_url="/" + self.name + "/api/openapi.json",
         )
 
-        self.cache = Cache(
-            self.cache_directory, self.output_spec, self.input_spec, self.cache_size
-        )
-
         # Effectively the "database" of the node
         self.jobs = {}
         self.rhnode_version = __version__
@@ -58,6 +78,7 @@ class RHNode(ABC, FastAPI):
         self.input_spec_str = create_filepath_as_string_model(self.input_spec)
         self.input_spec_no_file = create_model_no_files(self.input_spec)
         validate_input_output_spec(self.input_spec, self.output_spec)
+        self.schema_version = self._get_schema_version()
         # A list of the input keys of FilePath type.
         self.input_file_keys = [
             key
@@ -65,6 +86,45 @@ class RHNode(ABC, FastAPI):
             if val.type_ == FilePath
         ]
 
+        # Directories shared with clients (e.g. an NFS mount, or the same host),
+        # where input files can be read and output files linked without uploading
+        # or downloading them. They must be mounted at the same path everywhere.
+        self.shared_storage = [
+            Path(root).resolve()
+            for root in os.environ.get("RH_SHARED_STORAGE", "").split(os.pathsep)
+            if root
+        ]
+
+        # Digests of the input and output files the node stores, used to skip
+        # uploads of files it already has and to hash each file only once
+        self.digests = DigestIndex()
+
+        # Input, output and cache files are hardlinks into the blob store. Nodes
+        # on the same host can share it by setting RH_BLOB_DIRECTORY to the same
+        # directory, on the filesystem of their other directories.
+        self.blobs = BlobStore(
+            os.environ.get("RH_BLOB_DIRECTORY", self.blob_directory), self.digests
+        )
+
+        # RH_CACHE_DIRECTORIES and RH_CACHE_MAX_GB spread the cache over the
+        # disks of the host, e.g. "/nvme0/cache:/nvme1/cache" and "200,100"
+        cache_directories = self.cache_directory
+        if directories := os.environ.get("RH_CACHE_DIRECTORIES"):
+            cache_directories = directories.split(os.pathsep)
+        cache_max_gb = self.cache_max_gb
+        if max_gb := os.environ.get("RH_CACHE_MAX_GB"):
+            cache_max_gb = [float(gb) for gb in max_gb.split(",")]
+        self.cache = Cache(
+            cache_directories,
+            self.output_spec,
+            self.input_spec,
+            self.cache_size,
+            cache_max_gb,
+            self.get_cache_version(),
+            self.digests,
+            self.get_shared_cache(),
+        )
+
         if recipient := os.environ.get("RH_EMAIL_ON_ERROR"):
             self.email_sender = EmailSender(recipient)
         else:
@@ -118,6 +178,74 @@ class RHNode(ABC, FastAPI):
                 print("Deleting job", job_id)
                 self._delete_job(job_id)
 
+    async def _collect_garbage_loop(self, interval=3600):
+        """Remove the blobs no longer used by any job or cache entry"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            removed, freed = await loop.run_in_executor(
+                None, self.blobs.collect_garbage
+            )
+            if removed:
+                print(f"Removed {removed} unused blobs ({freed / 1024**2:.1f} MB)")
+
+    async def _report_cache_keys_loop(self, interval=60):
+        """Send the keys of the cached results to the manager, so that it can send
+        jobs whose result is cached here to this host"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                keys = await loop.run_in_executor(None, self.cache.get_key_filter)
+                url = MANAGER_URL + "/cache_index/" + self.name
+                response = await loop.run_in_executor(
+                    None, lambda: requests.post(url, json=keys.dict(), timeout=5)
+                )
+                response.raise_for_status()
+            except requests.RequestException:
+                # E.g. no manager, or a manager without cache-aware dispatch
+                pass
+            except Exception as e:
+                print("Could not report the cache keys to the manager:", e)
+
+    def get_cache_version(self):
+        """Part of the key of every cache entry, so that cached results are not
+        used after the node changes. Returns cache_version by default. Override it
+        to e.g. include the digest of the model weights:
+        return self.digests.digest("weights/model.pt")"""
+        return self.cache_version
+
+    def get_shared_cache(self):
+        """The second tier of the cache, shared with the same node on other
+        hosts, or None. By default a DirectoryCacheBackend in RH_SHARED_CACHE_DIR
+        if it is set, e.g. a directory on a network filesystem. Override it to
+        return another CacheBackend."""
+        if directory := os.environ.get("RH_SHARED_CACHE_DIR"):
+            return DirectoryCacheBackend(directory)
+        return None
+
+    async def _scrub_cache_loop(self, interval=24 * 3600):
+        """Verify the digests of the cached files once a day, reading at most
+        RH_CACHE_SCRUB_MB_PER_SECOND (default 20, 0 to disable)"""
+        mb_per_second = float(os.environ.get("RH_CACHE_SCRUB_MB_PER_SECOND", 20))
+        if mb_per_second <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            checked, removed = await loop.run_in_executor(
+                None, self.cache.scrub, mb_per_second * 1024**2, self.blobs.discard
+            )
+            print(f"Scrubbed {checked} cache entries, removed {removed} corrupted")
+
+    def _get_schema_version(self):
+        """Changes when the inputs or outputs of the node, or the RHNode version, change"""
+        spec = json.dumps(
+            [self.input_spec.schema(), self.output_spec.schema()], sort_keys=True
+        )
+        digest = hashlib.sha1(spec.encode()).hexdigest()[:12]
+        return f"{self.rhnode_version}-{digest}"
+
     def get_job_by_id(self, job_id: str):
         try:
             return self.jobs[job_id]
@@ -135,6 +263,8 @@ class RHNode(ABC, FastAPI):
         # Standard job arguments
         default_job_args = {
             "required_gb_gpu_memory": self.required_gb_gpu_memory,
+            "required_num_gpus": self.required_num_gpus,
+            "required_gpu_share": self.required_gpu_share,
             "required_num_threads": self.required_num_threads,
             "required_gb_memory": self.required_gb_memory,
             "target_function": self.__class__.process_wrapper,
@@ -142,6 +272,7 @@ class RHNode(ABC, FastAPI):
             "input_spec": self.input_spec,
             "output_spec": self.output_spec,
             "cache": self.cache,
+            "blobs": self.blobs,
             "name": self.name,
         }
 
@@ -170,6 +301,7 @@ class RHNode(ABC, FastAPI):
                     name=self.name,
                     last_heard_from=0,
                     gpu_gb_required=self.required_gb_gpu_memory,
+                    gpus_required=self.required_num_gpus,
                     memory_required=self.required_gb_memory,
                     threads_required=self.required_num_threads,
                 )
@@ -197,20 +329,372 @@ class RHNode(ABC, FastAPI):
         return "/" + self.name + url
 
     def _get_output_with_download_links(self, job_id):
-        """Get the output of a finished job, with download links for any FilePath fields."""
+        """Get the output of a finished job, with download links for any FilePath and DirectoryPath fields."""
         job = self.get_job_by_id(job_id)
         self._ensure_job_status(job.status, JobStatus.Finished)
         return self.output_spec_url(
             **{
-                key: self.url_path_for("_get_file", job_id=job_id, filename=key)
-                if self.output_spec.__fields__[key].type_ == FilePath
+                key: self._get_download_link(job_id, key)
+                if is_output_path(self.output_spec.__fields__[key])
                 else val
                 for key, val in job.output.dict(exclude_unset=True).items()
                 # Only return links for non FilePath and FilePath with values that are not None unless required
-                if not self.output_spec.__fields__[key].type_ == FilePath or val is not None or (val is None and self.output_spec.__fields__[key].required)
+                if not is_output_path(self.output_spec.__fields__[key]) or val is not None or (val is None and self.output_spec.__fields__[key].required)
             }
         )
 
+    def _get_download_link(self, job_id, key):
+        # Directories can only be downloaded as an archive
+        if self.output_spec.__fields__[key].type_ == DirectoryPath:
+            return self.url_path_for("_get_archive", job_id=job_id) + f"?keys={key}"
+        return self.url_path_for("_get_file", job_id=job_id, filename=key)
+
+    def _get_archive_members(self, job, keys=None):
+        """The (output key, path, name in archive) of each file and directory in
+        the archive of the given outputs of a job, or of all its outputs"""
+        outputs = job.output.dict(exclude_unset=True)
+        if keys is None:
+            keys = [
+                key
+                for key, val in outputs.items()
+                if is_output_path(self.output_spec.__fields__[key]) and val is not None
+            ]
+        members = []
+        for key in keys:
+            if not key in self.output_spec.__fields__ or not is_output_path(
+                self.output_spec.__fields__[key]
+            ):
+                raise HTTPException(
+                    status_code=404,
+                    detail="The requested file key {} is invalid.".format(key),
+                )
+            if outputs.get(key) is None:
+                continue
+            path = Path(outputs[key])
+            members.append((key, path, path.name))
+            if path.is_dir():
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in dirs + sorted(files):
+                        member = Path(root, name)
+                        arcname = Path(path.name, member.relative_to(path))
+                        members.append((key, member, arcname.as_posix()))
+        return members
+
+    async def _create_job_from_form(self, form, prefix=""):
+        """Create a job from a multipart form with the JSON fields "inputs" and
+        "job", and a file part "file.{key}" per file input. The field names are
+        prefixed with prefix, and an unprefixed "job" field is used if there is no
+        prefixed one. Returns the job, ready to run, and its metadata."""
+        try:
+            inputs = self.input_spec_no_file(**json.loads(form[prefix + "inputs"]))
+            job_meta_data = form.get(prefix + "job", form.get("job", "{}"))
+            job_meta_data = JobMetaData(**json.loads(job_meta_data))
+        except KeyError as e:
+            raise HTTPException(status_code=400, detail=f"Missing form field {e}")
+        except (ValueError, ValidationError) as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        # Files are either uploaded as "file.{key}", given as a path on shared
+        # storage, "path.{key}", given as a file the node already stores,
+        # "blob.{key}" (see /blobs/has), or given as an output of a job on another
+        # node, "ref.{key}". "digest.{key}" is the SHA-256 of the file, which is
+        # required for paths and checked for uploads.
+        files = {}
+        paths = {}
+        blobs = {}
+        references = {}
+        for name, value in form.multi_items():
+            if name.startswith(prefix + "file."):
+                key = name[len(prefix + "file.") :]
+                files[key] = value
+            elif name.startswith(prefix + "ref."):
+                key = name[len(prefix + "ref.") :]
+                try:
+                    references[key] = OutputReference.parse_raw(value)
+                except ValidationError as e:
+                    raise HTTPException(status_code=422, detail=str(e))
+            elif name.startswith(prefix + "path.") or name.startswith(prefix + "blob."):
+                kind = name[len(prefix) : len(prefix) + 4]
+                key = name[len(prefix) + 5 :]
+                digest = form.get(prefix + "digest." + key)
+                if digest is None:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"Missing form field {prefix}digest.{key}",
+                    )
+                (paths if kind == "path" else blobs)[key] = (value, digest)
+            else:
+                continue
+            if not key in self.input_file_keys:
+                raise HTTPException(
+                    status_code=404,
+                    detail="The requested file key {} is invalid.".format(key),
+                )
+
+        job_id = self.CREATE_JOB(inputs)
+        job = self.jobs[job_id]
+        try:
+            for key, upload in files.items():
+                await self._save_upload(job, key, upload, form.get(prefix + "digest." + key))
+            for key, (path, digest) in paths.items():
+                await self._link_shared_file(job, key, path, digest)
+            loop = asyncio.get_running_loop()
+            for key, (fname, digest) in blobs.items():
+                # Blobs are checked against their digest, which may hash them
+                await loop.run_in_executor(
+                    None, self._link_blob, job, key, fname, digest
+                )
+            for key, reference in references.items():
+                await loop.run_in_executor(
+                    None, self._fetch_output_reference, job, key, reference
+                )
+            if not job.is_ready_to_run():
+                raise HTTPException(
+                    status_code=400,
+                    detail="Job is not ready to run. Some files are likely missing.",
+                )
+        except Exception:
+            self._delete_job(job_id)
+            raise
+
+        return job, job_meta_data
+
+    async def _save_upload(self, job, key, upload, digest=None):
+        """Save an uploaded input file. It is hashed while it is written, and
+        checked against digest if the client sent it."""
+        hash_object = hashlib.sha256()
+        with job.upload_file(key, upload.filename) as fpath:
+            with open(fpath, "wb") as f:
+                while chunk := await upload.read(1024 * 1024):
+                    hash_object.update(chunk)
+                    f.write(chunk)
+        if digest is not None and digest != hash_object.hexdigest():
+            raise HTTPException(
+                status_code=422,
+                detail=f"The uploaded file {upload.filename} does not match its digest",
+            )
+        job.input_digests[key] = hash_object.hexdigest()
+        self.blobs.add(fpath, hash_object.hexdigest())
+
+    def _find_blobs(self, digests):
+        return [
+            digest
+            for digest in digests
+            if self.blobs.find(digest) or self.digests.find(digest)
+        ]
+
+    def _link_blob(self, job, key, fname, digest):
+        """Use a file the node already stores as input"""
+        path = self.blobs.find(digest) or self.digests.find(digest)
+        try:
+            if path is None:
+                raise FileNotFoundError(digest)
+            fpath = _link_or_copy_input(job, key, path, fname)
+        except OSError:
+            # Unknown, or collected since the client asked
+            raise HTTPException(
+                status_code=409, detail=f"The node does not have the file {digest}"
+            )
+        job.input_digests[key] = self.digests.add(fpath, digest)
+
+    def _is_shared_path(self, path):
+        path = Path(path)
+        return path.is_absolute() and any(
+            is_relative_to(path.resolve(), root) for root in self.shared_storage
+        )
+
+    async def _link_shared_file(self, job, key, path, digest):
+        """Use an input file on shared storage, after checking that the node sees
+        the same content as the client"""
+        if not self._is_shared_path(path) or not os.path.isfile(path):
+            raise HTTPException(
+                status_code=409,
+                detail=f"The path {path} is not a file on the node's shared storage",
+            )
+        fpath = job.link_file(key, path)
+        loop = asyncio.get_running_loop()
+        if await loop.run_in_executor(None, self.digests.digest, fpath) != digest:
+            raise HTTPException(
+                status_code=409,
+                detail=f"The file {path} does not match its digest on the node",
+            )
+        job.input_digests[key] = digest
+
+    def _fetch_output_reference(self, job, key, reference):
+        """Get an output file of a job on another node (or this one) as input. It
+        is linked if this node can see the file, and downloaded otherwise. The
+        host and port of the reference are those the client names, so the node
+        trusts its clients not to point it at other services."""
+        if reference.node == self.name and reference.job_id in self.jobs:
+            field = self.output_spec.__fields__.get(reference.key)
+            if field is None or not is_output_path(field) or field.type_ != FilePath:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"{reference.key} is not an output file of {self.name}",
+                )
+            producer = self.jobs[reference.job_id]
+            self._ensure_job_status(producer.status, JobStatus.Finished)
+            path = getattr(producer.output, reference.key, None)
+            if path is None:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Job {reference.job_id} has no output {reference.key}",
+                )
+            fpath = _link_or_copy_input(job, key, Path(path).resolve())
+            job.input_digests[key] = self.digests.digest(fpath)
+            return
+
+        url = f"http://{reference.host}:{reference.port}/{reference.node}/jobs/{reference.job_id}"
+        try:
+            if self.shared_storage:
+                response = requests.get(url + "/paths", timeout=OUTPUT_REFERENCE_TIMEOUT)
+                response.raise_for_status()
+                info = response.json().get(reference.key)
+                if (
+                    info is not None
+                    and self._is_shared_path(info["path"])
+                    and os.path.isfile(info["path"])
+                ):
+                    fpath = _link_or_copy_input(job, key, Path(info["path"]))
+                    if self.digests.digest(fpath) == info["digest"]:
+                        job.input_digests[key] = info["digest"]
+                        return
+                    print("The shared file", info["path"], "does not match its digest")
+                    job.remove_input_file(key)
+
+            with requests.get(
+                f"{url}/download/{reference.key}",
+                stream=True,
+                timeout=OUTPUT_REFERENCE_TIMEOUT,
+            ) as response:
+                response.raise_for_status()
+                fname = response.headers["Content-Disposition"].split("=")[1]
+                hash_object = hashlib.sha256()
+                with job.upload_file(key, fname.replace('"', "")) as fpath:
+                    with open(fpath, "wb") as f:
+                        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            hash_object.update(chunk)
+                            f.write(chunk)
+            digest = response.headers.get(DIGEST_HEADER)
+            if digest is not None and digest != hash_object.hexdigest():
+                raise HTTPException(
+                    status_code=502,
+                    detail=f"The output {reference.key} of job {reference.job_id} was corrupted in transfer",
+                )
+            job.input_digests[key] = hash_object.hexdigest()
+            self.blobs.add(fpath, hash_object.hexdigest())
+        except requests.RequestException as e:
+            raise HTTPException(
+                status_code=502,
+                detail=f"Could not fetch output {reference.key} of job {reference.job_id} on {reference.node}: {e}",
+            )
+
+    def _get_output_files(self, job):
+        """The output key and path of each output file of a job"""
+        return {
+            key: Path(val).resolve()
+            for key, val in job.output.dict(exclude_unset=True).items()
+            if self.output_spec.__fields__[key].type_ == FilePath and val is not None
+        }
+
+    def _get_output_paths(self, job):
+        """Paths and digests of the output files of a job that are on shared storage"""
+        return {
+            key: {"path": str(path), "digest": self.digests.digest(path)}
+            for key, path in self._get_output_files(job).items()
+            if self._is_shared_path(path)
+        }
+
+    def _get_output_digests(self, job):
+        """File names and digests of the output files of a job"""
+        return {
+            key: {"name": path.name, "digest": self.digests.digest(path)}
+            for key, path in self._get_output_files(job).items()
+        }
+
+    def _get_metrics(self):
+        stats = self.cache.get_stats()
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append(f"# HELP rhnode_{name} {help}")
+            lines.append(f"# TYPE rhnode_{name} {kind}")
+            for labels, value in values:
+                labels = ",".join(
+                    f'{key}="{val}"' for key, val in {"node": self.name, **labels}.items()
+                )
+                lines.append(f"rhnode_{name}{{{labels}}} {value}")
+
+        for counter, help in [
+            ("hits", "Jobs whose result was loaded from the cache"),
+            ("shared_hits", "Jobs whose result was found in the shared cache"),
+            ("misses", "Jobs that checked the cache and were computed"),
+            ("saves", "Results saved to the cache"),
+            ("evictions", "Cache entries removed to stay within the limits"),
+            ("invalidations", "Cache entries removed on request"),
+            ("corrupted", "Cache entries removed because a file was corrupted"),
+            ("imports", "Cache entries imported from another node"),
+            ("seconds_saved", "Compute time of the results loaded from the cache"),
+        ]:
+            metric(f"cache_{counter}_total", "counter", help, [({}, stats[counter])])
+        metric(
+            "cache_entries",
+            "gauge",
+            "Entries in each cache directory",
+            [({"directory": d["directory"]}, d["entries"]) for d in stats["directories"]],
+        )
+        metric(
+            "cache_bytes",
+            "gauge",
+            "Bytes of the entries in each cache directory",
+            [({"directory": d["directory"]}, d["bytes"]) for d in stats["directories"]],
+        )
+        statuses = [job.status for job in list(self.jobs.values())]
+        metric(
+            "jobs",
+            "gauge",
+            "Jobs on the node by status",
+            [({"status": status.name}, statuses.count(status)) for status in JobStatus],
+        )
+        return "\n".join(lines) + "\n"
+
+    def _import_cache_from(self, source, cache_keys=None):
+        """Import the cache entries (all, or the given keys) of the same node
+        running at source (host:port)"""
+        url = f"http://{source}/{self.name}"
+        response = requests.get(url + "/schema")
+        response.raise_for_status()
+        if response.json()["schema_version"] != self.schema_version:
+            raise HTTPException(
+                status_code=409,
+                detail=f"The node at {source} has another version of the node",
+            )
+        params = {"keys": ",".join(cache_keys)} if cache_keys else {}
+        with requests.get(url + "/cache/export.tar", params=params, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            return self.cache.import_entries(response.raw, self.blobs.add)
+
+    def _get_job_statuses(self, job_ids=None, since=0):
+        """Status of the given jobs, or of all jobs that changed after since"""
+        if job_ids is not None:
+            jobs = {job_id: self.jobs.get(job_id) for job_id in job_ids}
+        else:
+            jobs = {
+                job_id: job
+                for job_id, job in self.jobs.items()
+                if job.status_seq > since
+            }
+        cursor = max([since] + [job.status_seq for job in self.jobs.values()])
+        return {
+            "cursor": cursor,
+            "jobs": {
+                job_id: job.status if job is not None else None
+                for job_id, job in jobs.items()
+            },
+        }
+
     def _ensure_job_status(self, status, valid_statuses):
         """Ensure that the job status is valid for the requested action."""
         if not isinstance(valid_statuses, list):
@@ -233,6 +717,56 @@ class RHNode(ABC, FastAPI):
             job_id = self.CREATE_JOB(inputs)
             return job_id
 
+        @self.post(self._create_url("/jobs/submit"))
+        async def _submit_job(request: Request, background_tasks: BackgroundTasks) -> str:
+            """Create, upload the files of, and start a job in a single request"""
+            form = await request.form()
+            job, job_meta_data = await self._create_job_from_form(form)
+            background_tasks.add_task(job.run, job_meta_data)
+            return job.ID
+
+        @self.post(self._create_url("/jobs/submit_many"))
+        async def _submit_jobs(request: Request, background_tasks: BackgroundTasks):
+            """Create and start several jobs in a single request. The fields of job
+            i are prefixed with "{i}.", numbered from 0. Returns a list with the job
+            ID, or the error, of each job."""
+            form = await request.form()
+            prefixes = {
+                name[: -len(".inputs")] for name in form.keys() if name.endswith(".inputs")
+            }
+            if not all(prefix.isdecimal() for prefix in prefixes) or sorted(
+                map(int, prefixes)
+            ) != list(range(len(prefixes))):
+                raise HTTPException(
+                    status_code=400,
+                    detail='The jobs must be numbered 0, 1, 2, ... as in "0.inputs"',
+                )
+            results = []
+            runs = []
+            for i in range(len(prefixes)):
+                try:
+                    job, job_meta_data = await self._create_job_from_form(form, f"{i}.")
+                    runs.append(job.run(job_meta_data))
+                    results.append({"job_id": job.ID})
+                except HTTPException as e:
+                    results.append({"error": e.detail, "status_code": e.status_code})
+                except Exception as e:
+                    results.append({"error": str(e), "status_code": 500})
+
+            # Background tasks run one after another, so the jobs are gathered
+            background_tasks.add_task(_gather, runs)
+            return results
+
+        @self.get(self._create_url("/jobs/status"))
+        async def _get_changed_job_statuses(since: int = 0):
+            """Status of all jobs that changed since the cursor of an earlier call"""
+            return self._get_job_statuses(since=since)
+
+        @self.post(self._create_url("/jobs/status"))
+        async def _get_job_statuses(job_ids: List[str]):
+            """Status of several jobs in one request. Unknown jobs have status None."""
+            return self._get_job_statuses(job_ids=job_ids)
+
         @self.post(self._create_url("/jobs/{job_id}/start"))
         async def START_JOB(
             job_id: str, job_meta_data: JobMetaData, background_tasks: BackgroundTasks
@@ -290,6 +824,11 @@ class RHNode(ABC, FastAPI):
                     status_code=404,
                     detail="The requested file key {} is invalid.".format(filename),
                 )
+            if self.output_spec.__fields__[filename].type_ == DirectoryPath:
+                raise HTTPException(
+                    status_code=404,
+                    detail="The output {} is a directory, use download.tar".format(filename),
+                )
             try:
                 fname = job.output.dict()[filename]
             except KeyError:
@@ -300,9 +839,140 @@ class RHNode(ABC, FastAPI):
                     ),
                 )           
             return FileResponse(
-                fname, filename=create_file_name_from_key(filename, fname)
+                fname,
+                filename=create_file_name_from_key(filename, fname),
+                headers={DIGEST_HEADER: self.digests.digest(fname)},
             )
 
+        @self.get(self._create_url("/jobs/{job_id}/paths"))
+        async def _get_output_paths(job_id: str):
+            """Paths and digests of the output files that are on shared storage"""
+            job = self.get_job_by_id(job_id)
+            self._ensure_job_status(job.status, JobStatus.Finished)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._get_output_paths, job)
+
+        @self.get(self._create_url("/jobs/{job_id}/digests"))
+        async def _get_output_digests(job_id: str):
+            """File names and digests of the output files"""
+            job = self.get_job_by_id(job_id)
+            self._ensure_job_status(job.status, JobStatus.Finished)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._get_output_digests, job)
+
+        @self.post(self._create_url("/blobs/has"))
+        async def _has_blobs(digests: List[str]):
+            """The digests of files the node already stores, so that they can be
+            given as "blob.{key}" instead of being uploaded"""
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._find_blobs, digests)
+
+        @self.get(self._create_url("/jobs/{job_id}/download.tar"))
+        def _get_archive(job_id: str, keys: Union[None, str] = None, compress: bool = False):
+            """Stream the output files of a job (all, or the comma separated keys)
+            as a tar archive, gzip compressed if compress is true"""
+            job = self.get_job_by_id(job_id)
+            self._ensure_job_status(job.status, JobStatus.Finished)
+            members = self._get_archive_members(job, keys.split(",") if keys else None)
+            return StreamingResponse(
+                _stream_tar(members, compress, self.digests),
+                media_type="application/gzip" if compress else "application/x-tar",
+            )
+
+        @self.get(self._create_url("/jobs/{job_id}/cache_key"))
+        async def _get_job_cache_key(job_id: str):
+            """The key of the job's result in the cache, once the job has started"""
+            return self.get_job_by_id(job_id).cache_key
+
+        @self.get(self._create_url("/cache/stats"))
+        async def _get_cache_stats():
+            """Hits, misses, evictions and time saved since the node started, and
+            the number of entries and bytes in each cache directory"""
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.cache.get_stats)
+
+        @self.get(self._create_url("/cache/entries"))
+        async def _get_cache_entries(offset: int = 0, limit: int = 100):
+            """The cache entries, most recently used first"""
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, self.cache.get_entries, offset, limit
+            )
+
+        @self.post(self._create_url("/cache/entries/{cache_key}/delete"))
+        async def _delete_cache_entry(cache_key: str, shared: bool = True):
+            """Remove an entry from the cache, e.g. a result known to be wrong.
+            With shared=false, it is only removed from the local cache."""
+            loop = asyncio.get_running_loop()
+            if not await loop.run_in_executor(
+                None, self.cache._delete_from_cache, cache_key, shared
+            ):
+                raise HTTPException(status_code=404, detail="Cache entry not found")
+            return Response(status_code=204)
+
+        @self.post(self._create_url("/cache/entries/{cache_key}/pin"))
+        async def _pin_cache_entry(cache_key: str, pinned: bool = True):
+            """Keep an entry in the cache until it is unpinned (pinned=false)"""
+            if not self.cache._set_pinned(cache_key, pinned):
+                raise HTTPException(status_code=404, detail="Cache entry not found")
+            return Response(status_code=204)
+
+        @self.post(self._create_url("/cache/scrub"))
+        async def _scrub_cache():
+            """Verify the digests of all cached files now, without waiting for the
+            daily scrub. Returns the number of entries checked and removed."""
+            loop = asyncio.get_running_loop()
+            checked, removed = await loop.run_in_executor(
+                None, self.cache.scrub, None, self.blobs.discard
+            )
+            return {"checked": checked, "removed": removed}
+
+        @self.get(self._create_url("/cache/export.tar"))
+        def _export_cache(keys: Union[None, str] = None, compress: bool = False):
+            """Stream the cache entries (all, or the comma separated keys) as a
+            tar archive, which /cache/import of the node on another host accepts"""
+            members = self.cache._export_members(keys.split(",") if keys else None)
+            return StreamingResponse(
+                _stream_tar(members, compress, self.digests),
+                media_type="application/gzip" if compress else "application/x-tar",
+            )
+
+        @self.post(self._create_url("/cache/import"))
+        async def _import_cache(
+            request: Request, source: Union[None, str] = None, keys: Union[None, str] = None
+        ):
+            """Add cache entries exported by the node on another host, e.g. to warm
+            up a new host. Either send the archive of /cache/export.tar as the
+            body, or give the host:port of the other node as source (and
+            optionally the comma separated keys to import)."""
+            loop = asyncio.get_running_loop()
+            try:
+                if source is not None:
+                    imported = await loop.run_in_executor(
+                        None, self._import_cache_from, source, keys.split(",") if keys else None
+                    )
+                else:
+                    with tempfile.SpooledTemporaryFile(64 * 1024**2) as f:
+                        async for chunk in request.stream():
+                            f.write(chunk)
+                        f.seek(0)
+                        imported = await loop.run_in_executor(
+                            None, self.cache.import_entries, f, self.blobs.add
+                        )
+            except (tarfile.TarError, UnsafeCacheEntryError) as e:
+                raise HTTPException(status_code=400, detail=f"Invalid cache archive: {e}")
+            except requests.RequestException as e:
+                raise HTTPException(
+                    status_code=502, detail=f"Could not export the cache of {source}: {e}"
+                )
+            return {"imported": imported}
+
+        @self.get(self._create_url("/metrics"), response_class=PlainTextResponse)
+        async def _get_metrics():
+            """Counters of the node in the Prometheus text format"""
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._get_metrics)
+
         @self.get(self._create_url("/filename_keys"))
         async def _get_file_keys():
             return self.input_file_keys
@@ -314,6 +984,21 @@ class RHNode(ABC, FastAPI):
                 "input_keys": list(self.input_spec.__fields__.keys()),
             }
 
+        @self.get(self._create_url("/schema"))
+        async def _get_schema():
+            return {
+                "input_keys": list(self.input_spec.__fields__.keys()),
+                "output_keys": list(self.output_spec.__fields__.keys()),
+                "file_keys": self.input_file_keys,
+                "rhnode_version": self.rhnode_version,
+                "schema_version": self.schema_version,
+                "shared_storage": [str(root) for root in self.shared_storage],
+                "output_references": True,
+                "download_archive": True,
+                "digests": True,
+                "cache_key": self.cache.get_key_spec(),
+            }
+
         @self.post(self._create_url("/cli/parse"))
         async def _parse_cli_args(cli: list):
             try:
@@ -349,6 +1034,8 @@ class RHNode(ABC, FastAPI):
             return Response(status_code=204)
 
         ### OTHER
+        self.add_middleware(_SchemaVersionMiddleware, schema_version=self.schema_version)
+
         @self.on_event("startup")
         async def register_on_startup():
             # print(multiprocessing.get_start_method())
@@ -371,13 +1058,22 @@ class RHNode(ABC, FastAPI):
         @self.on_event("startup")
         async def start_cleaning_loop():
             asyncio.create_task(self._delete_expired_jobs_loop())
+            asyncio.create_task(self._collect_garbage_loop())
+            asyncio.create_task(self._scrub_cache_loop())
+            asyncio.create_task(self._report_cache_keys_loop())
 
     @classmethod
     def process_wrapper(cls, inputs, job, result_queue):
         """Wrapper for the process function. It has two purposes: catching errors and packing the output of the process function into the "queue" object."""
+        # RHProcess terminates the process when the job is cancelled. Cancel the
+        # child jobs it started as well, so they do not run for nothing.
+        signal.signal(signal.SIGTERM, _stop_child_jobs_and_exit)
         try:
-            response = cls.process(inputs, job)
-            result_queue.put(("success", response))
+            if inspect.iscoroutinefunction(cls.process):
+                response = asyncio.run(cls.process(inputs, job))
+            else:
+                response = cls.process(inputs, job)
+            result_queue.put(("success", response, get_peak_usage(job)))
         except Exception as e:
             tb_str = traceback.format_exception(type(e), value=e, tb=e.__traceback__)
             result_queue.put(("error", tb_str, str(type(e))))
@@ -425,6 +1121,98 @@ class RHNode(ABC, FastAPI):
         return help_string
 
 
+class _SchemaVersionMiddleware:
+    """Adds the schema version header to every response of the node"""
+
+    def __init__(self, app, schema_version):
+        self.app = app
+        self.header = (SCHEMA_VERSION_HEADER.lower().encode(), schema_version.encode())
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [self.header]
+            await send(message)
+
+        await self.app(scope, receive, send_with_header)
+
+
+def _stream_tar(members, compress=False, digests=None):
+    """Yield a tar archive of the members, a list of (output key, path, name in
+    archive), without writing it to disk. Each member has a PAX header with its
+    output key, and each file one with its SHA-256 if digests (a DigestIndex) is
+    given. The archive is gzip compressed if compress is true."""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def out(data):
+        return compressor.compress(data) if compressor is not None else data
+
+    for key, path, arcname in members:
+        stat = os.stat(path)
+        info = tarfile.TarInfo(arcname)
+        info.mtime = stat.st_mtime
+        info.mode = stat.st_mode & 0o777
+        info.pax_headers = {ARCHIVE_KEY_HEADER: key}
+        if os.path.isdir(path):
+            info.type = tarfile.DIRTYPE
+        else:
+            info.size = stat.st_size
+            if digests is not None:
+                info.pax_headers[ARCHIVE_DIGEST_HEADER] = digests.digest(path)
+        yield out(info.tobuf(tarfile.PAX_FORMAT))
+
+        if info.isfile():
+            remaining = info.size
+            with open(path, "rb") as f:
+                while remaining > 0:
+                    chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError(f"{path} was truncated while being sent")
+                    remaining -= len(chunk)
+                    yield out(chunk)
+            yield out(b"\0" * (-info.size % tarfile.BLOCKSIZE))
+
+    # End of archive
+    yield out(b"\0" * (2 * tarfile.BLOCKSIZE))
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def _link_or_copy_input(job, key, path, fname=None):
+    """Hardlink a file into the input directory of the job, or copy it if it is
+    on another filesystem"""
+    with job.upload_file(key, fname or path.name) as fpath:
+        link_or_copy(path, fpath)
+    return fpath
+
+
+async def _gather(coroutines):
+    await asyncio.gather(*coroutines)
+
+
+def _stop_child_jobs_and_exit(signum, frame):
+    stop_started_jobs()
+    sys.exit(1)
+
+
+def get_peak_usage(job):
+    """Peak memory use of the current process. Reported to the manager, which keeps
+    statistics of how much the jobs of each node actually use."""
+    # ru_maxrss is in kilobytes on Linux
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+    peak_gpu_mem = None
+    torch = sys.modules.get("torch")
+    if torch is not None and job.devices and torch.cuda.is_initialized():
+        peak_gpu_mem = (
+            max(torch.cuda.max_memory_reserved(device) for device in job.devices)
+            / 1024**3
+        )
+    return JobUsage(peak_memory=peak_memory, peak_gpu_mem=peak_gpu_mem)
+
+
 def convert_string_to_type(text, type_):
     """Convert a string to a type. This is used to parse the inputs to the process function."""
     if type_ == str or type_ == FilePath:
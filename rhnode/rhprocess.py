@@ -1,6 +1,7 @@
 import multiprocessing
-from pydantic import FilePath
+from pydantic import FilePath, DirectoryPath
 import os
+import shutil
 from pathlib import Path
 import requests
 import asyncio
@@ -12,6 +13,10 @@ from .common import *
 from contextlib import contextmanager
 import time
 from pydantic import ValidationError
+import itertools
+
+# Numbers each status change of the jobs of the node, see RHProcess.status
+_status_sequence = itertools.count(1)
 
 
 class RHProcess:
@@ -34,18 +39,26 @@ class RHProcess:
         target_function,
         name,
         manager_endpoint=None,
+        required_num_gpus=1,
+        required_gpu_share=0,
+        blobs=None,
     ):
         self.target_function = target_function
-        self.status = None
+        self._status = None
+        self.status_seq = 0
         self.error = None
         self.time_created = time.time()
         self.time_last_accessed = None
         self.output = None
         self.input = inputs_no_files
+        self.input_digests = {}  # SHA-256 of input files known on submission
+        self.cache_key = None
 
         self.output_directory = output_directory
         self.input_directory = input_directory
         self.required_gb_gpu_memory = required_gb_gpu_memory
+        self.required_num_gpus = required_num_gpus
+        self.required_gpu_share = required_gpu_share
         self.required_num_threads = required_num_threads
         self.required_gb_memory = required_gb_memory
         self.manager_endpoint = manager_endpoint
@@ -54,29 +67,52 @@ class RHProcess:
         self.output_spec = output_spec
         self.input_spec_optional_file = create_relaxed_filepath_model(self.input_spec)
         self.cache = cache
+        self.blobs = blobs  # BlobStore the output files are moved into
         self.name = name
         self.status = JobStatus.Preparing
         self.priority = None
+        self.usage = None
         self._make_input_directory()
 
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        # Lets clients ask for the jobs that changed since a given sequence number
+        if status != self._status:
+            self.status_seq = next(_status_sequence)
+        self._status = status
+
     ## IO
     def _cleanup_output_directory(self, response):
         out_files = []
+        out_dirs = []
         for key, val in response.dict(exclude_unset=True).items():
             if self.output_spec.__fields__[key].type_ == FilePath:
                 out_files.append(str(Path(val).absolute()))
+            elif self.output_spec.__fields__[key].type_ == DirectoryPath:
+                out_dirs.append(Path(val).absolute())
 
         # Remove all files not in outputs
         for root, dirs, files in os.walk(self.output_directory):
             for file in files:
                 fpath = Path(root, file).absolute()
-                if str(fpath) not in out_files:
+                if str(fpath) not in out_files and not any(
+                    is_relative_to(fpath, out_dir) for out_dir in out_dirs
+                ):
                     os.remove(fpath)
 
-        # Remove all empty directories
+        # Remove all empty directories, except those within output directories
         for root, dirs, files in os.walk(self.output_directory, topdown=False):
             for dir_name in dirs:
                 dir_path = os.path.join(root, dir_name)
+                if any(
+                    is_relative_to(Path(dir_path).absolute(), out_dir)
+                    for out_dir in out_dirs
+                ):
+                    continue
                 if not os.listdir(dir_path):
                     os.rmdir(dir_path)
 
@@ -88,13 +124,9 @@ class RHProcess:
             os.rmdir(self.input_directory)
 
     def _remove_output_directory(self):
+        # Output directories may contain subdirectories (DirectoryPath outputs)
         if os.path.exists(self.output_directory):
-            for root, dirs, files in os.walk(self.output_directory):
-                for file in files:
-                    fpath = Path(root, file).absolute()
-                    os.remove(fpath)
-
-            os.rmdir(self.output_directory)
+            shutil.rmtree(self.output_directory)
 
     def _make_input_directory(self):
         new_dir = os.path.join(self.input_directory)
@@ -120,8 +152,15 @@ class RHProcess:
             job_id=queue_id,
             priority=job_metadata.priority,
             required_gpu_mem=self.required_gb_gpu_memory,
+            required_num_gpus=self.required_num_gpus,
+            required_gpu_share=self.required_gpu_share,
             required_threads=self.required_num_threads,
             required_memory=self.required_gb_memory,
+            node_name=self.name,
+            submitter=job_metadata.submitter,
+            parent_id=job_metadata.parent_queue_id,
+            borrow=job_metadata.borrow_parent_resources,
+            deadline=job_metadata.deadline,
         )
         response = requests.post(url, json=jobreq.dict())
         response.raise_for_status()
@@ -129,7 +168,9 @@ class RHProcess:
 
     def _release_job_resources(self, queue_id):
         url = self.manager_endpoint + f"/end_job/{queue_id}"
-        response = requests.post(url)
+        # The manager only learns run times from jobs that report completion
+        usage = self.usage if self.usage is not None else JobUsage(completed=False)
+        response = requests.post(url, json=usage.dict())
         response.raise_for_status()
         return response.json()
 
@@ -137,27 +178,44 @@ class RHProcess:
     async def _maybe_wait_for_resources(self, job):
         queue_id = None
         if job.resources_included:
-            yield job.device
+            if job.devices is not None:
+                yield job.devices
+            elif job.device is not None:
+                yield [job.device]
+            else:
+                yield []
 
         else:
             print("Entering resource queue...")
             queue_id = self._queue(job)
-            gpu_id = None
+            gpu_ids = None
             while True:
                 status = self._get_queue_status(queue_id)
                 if status["is_active"]:
-                    gpu_id = status["gpu_device_id"]
+                    # Managers older than multi-GPU support only return one device
+                    gpu_ids = status.get("gpu_device_ids")
+                    if gpu_ids is None:
+                        gpu_id = status.get("gpu_device_id")
+                        gpu_ids = [gpu_id] if gpu_id is not None else []
                     break
                 ## If the task is cancelled yield None
                 ## THe run function will check for the status and not spawn the process
                 if self.status == JobStatus.Cancelling:
                     self.status = JobStatus.Cancelled
-                    gpu_id = None
+                    gpu_ids = None
+                    break
+                if status.get("expired") or self._deadline_passed(job):
+                    self._expire()
+                    gpu_ids = None
                     break
 
                 await asyncio.sleep(3)
+
+            # Lets child jobs borrow or suspend this job's reservation
+            job.queue_id = queue_id
+            job.manager_endpoint = self.manager_endpoint
             try:
-                yield gpu_id
+                yield gpu_ids
             finally:
                 if queue_id:
                     self._release_job_resources(queue_id)
@@ -172,7 +230,7 @@ class RHProcess:
         output_dir = Path(self.output_directory)
         existing_base_names = set()
         for key, val in response.dict(exclude_unset=True).items():
-            if self.output_spec.__fields__[key].type_ == FilePath:
+            if is_output_path(self.output_spec.__fields__[key]) and val is not None:
                 val = Path(val)
                 base_name = os.path.basename(val)
                 if base_name in existing_base_names:
@@ -199,6 +257,23 @@ class RHProcess:
 
         return self.output_spec(**new_d)
 
+    async def _load_from_cache(self, job, cache_key):
+        """The cached outputs of the job, or None. Results missing in the local
+        cache are looked up in the shared cache."""
+        if not job.check_cache:
+            return None
+        loop = asyncio.get_running_loop()
+        if not self.cache._result_is_cached(cache_key):
+            on_file = self.blobs.add if self.blobs is not None else None
+            if not await loop.run_in_executor(
+                None, self.cache._promote, cache_key, on_file
+            ):
+                return None
+        # The integrity check may hash the cached files
+        return await loop.run_in_executor(
+            None, self.cache._load_from_cache, cache_key, job.directory
+        )
+
     def is_ready_to_run(self):
         try:
             self.input_spec(**self.input.dict())
@@ -207,21 +282,36 @@ class RHProcess:
             return False
 
     ## JOB RUNNING
+    def _deadline_passed(self, job):
+        return job.deadline is not None and time.time() > job.deadline
+
+    def _expire(self):
+        print("The job did not finish before its deadline")
+        self.status = JobStatus.Cancelled
+        self.error = Error(
+            error=DEADLINE_EXCEEDED,
+            traceback="The job was cancelled as it did not finish before its deadline",
+        )
+
     async def run(self, job):
         assert self.status == JobStatus.Preparing
         self.input = self.input_spec(**self.input.dict())
 
         ## Cancel signal might come before the run function is called executes
         if self.status == JobStatus.Cancelling:
-            self.statis = JobStatus.Cancelled
+            self.status = JobStatus.Cancelled
+            return
+
+        if self._deadline_passed(job):
+            self._expire()
             return
 
         new_dir = self._make_job_directory()
         job.directory = Path(new_dir)
-        cache_key = self.cache._get_cache_key(self.input)
+        cache_key = self.cache._get_cache_key(self.input, self.input_digests)
+        self.cache_key = cache_key
 
-        if job.check_cache and self.cache._result_is_cached(cache_key):
-            response = self.cache._load_from_cache(cache_key, job.directory)
+        if (response := await self._load_from_cache(job, cache_key)) is not None:
             self.status = JobStatus.Finished
             self.output = response
             return
@@ -229,28 +319,34 @@ class RHProcess:
         self.status = JobStatus.Queued
         self.priority = job.priority
 
-        async with self._maybe_wait_for_resources(job) as cuda_device:
+        async with self._maybe_wait_for_resources(job) as cuda_devices:
             ## Cancel signal might come in waiting for cuda queue
             if self.status == JobStatus.Cancelled:
                 return
 
             # Check cache again just for good measures
-            if job.check_cache and self.cache._result_is_cached(cache_key):
-                response = self.cache._load_from_cache(cache_key, job.directory)
+            if (response := await self._load_from_cache(job, cache_key)) is not None:
                 self.status = JobStatus.Finished
                 self.output = response
                 return
 
-            job.device = cuda_device
+            job.devices = cuda_devices
+            job.device = cuda_devices[0] if cuda_devices else None
+            if job.check_cache:
+                self.cache._count("misses")
             self.status = JobStatus.Running
+            time_started = time.time()
             result_queue = multiprocessing.Queue()
             p = Process(
                 target=self.target_function,
                 args=(self.input.copy(), job.copy(), result_queue),
             )
             p.start()
+            expired = False
             while p.is_alive():
-                if self.status == JobStatus.Cancelling:
+                expired = self._deadline_passed(job)
+                if self.status == JobStatus.Cancelling or expired:
+                    # The process stops its own child jobs on SIGTERM, see process_wrapper
                     p.terminate()
                     while p.is_alive():
                         print("Waiting for process to terminate...")
@@ -259,7 +355,12 @@ class RHProcess:
                     break
                 await asyncio.sleep(3)
 
-        response = result_queue.get()
+            # Read the result before the resources are released, so that the
+            # manager can be told how the job went
+            response = result_queue.get()
+            if response[0] == "success":
+                self.usage = response[2]
+
         if response[0] == "error":
             error_message = "".join(response[1])
             error_type = response[2]
@@ -268,6 +369,8 @@ class RHProcess:
             self.status = JobStatus.Error
             self.error = Error(traceback=error_message, error=error_type)
 
+        elif response[0] == "cancelled" and expired:
+            self._expire()
         elif response[0] == "cancelled":
             print(f"The Process was cancelled")
             self.status = JobStatus.Cancelled
@@ -276,8 +379,19 @@ class RHProcess:
             response = self._validate_and_maybe_fix_response(response)
             self._cleanup_output_directory(response)
             self._remove_input_directory()
+            loop = asyncio.get_running_loop()
+            if self.blobs is not None:
+                await loop.run_in_executor(None, self.blobs.add_tree, job.directory)
             if job.save_to_cache:
-                self.cache._save_to_cache(cache_key, response, job.directory)
+                # Also writes the result through to the shared cache
+                await loop.run_in_executor(
+                    None,
+                    self.cache._save_to_cache,
+                    cache_key,
+                    response,
+                    job.directory,
+                    time.time() - time_started,
+                )
             self.status = JobStatus.Finished
             self.output = response
 
@@ -295,6 +409,23 @@ class RHProcess:
         assert os.path.isfile(file_path)
         self.input = self.input.copy(update={file_key: self.input_directory / filename})
 
+    def link_file(self, file_key, path):
+        """Use a file on shared storage as input. It is hardlinked into the input
+        directory if possible, so that it outlives the client's copy, and used in
+        place otherwise."""
+        file_path = self.input_directory / create_file_name_from_key(file_key, path)
+        assert not os.path.isfile(file_path), "File upload error, file already exists"
+        try:
+            os.link(path, file_path)
+        except OSError:
+            file_path = Path(path)
+        self.input = self.input.copy(update={file_key: file_path})
+        return file_path
+
+    def remove_input_file(self, file_key):
+        os.remove(getattr(self.input, file_key))
+        self.input = self.input.copy(update={file_key: None})
+
     def delete_files(self):
         self._remove_input_directory()
         self._remove_output_directory()
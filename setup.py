@@ -25,6 +25,7 @@ setup(
     install_requires=[
         "uvicorn",
         "requests",
+        "httpx",
         "jinja2",
         "pydantic",
         "fastapi",
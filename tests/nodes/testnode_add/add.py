@@ -1,12 +1,12 @@
 from rhnode import RHNode
-from pydantic import BaseModel, FilePath
+from pydantic import BaseModel, FilePath, Field
 import nibabel as nib
 import time
 
 
 class InputsAdd(BaseModel):
     scalar: int
-    sleep_time: int = 5
+    sleep_time: int = Field(5, cache_key=False)
     throw_error: bool = False
     in_file: FilePath
     check_device_allocated: int = -1
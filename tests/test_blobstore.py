@@ -0,0 +1,90 @@
+# Unit tests of the blob store of the node. These do not need docker.
+
+import os
+import stat
+import time
+import pytest
+from rhnode.blobstore import BlobStore, clone_or_copy
+from rhnode.cache import DigestIndex
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(tmp_path / "blobs", DigestIndex(), grace_period=60)
+
+
+def write(path, content):
+    os.makedirs(path.parent, exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+    return path
+
+
+def add(store, path):
+    return store.add(path, store.digests.digest(path))
+
+
+def test_same_content_is_stored_once(store, tmp_path):
+    first = add(store, write(tmp_path / "job1" / "a.txt", "content"))
+    second = add(store, write(tmp_path / "job2" / "b.txt", "content"))
+    other = add(store, write(tmp_path / "job3" / "c.txt", "other"))
+
+    assert os.path.samefile(first, second)
+    assert not os.path.samefile(first, other)
+    assert store.usage() == (2, len("content") + len("other"))
+
+    blob = store.find(store.digests.digest(first))
+    assert os.path.samefile(blob, first)
+    assert not stat.S_IMODE(os.stat(blob).st_mode) & stat.S_IWUSR
+    assert store.find("0" * 64) is None
+
+
+def test_blob_modified_in_place_is_not_reused(store, tmp_path):
+    path = add(store, write(tmp_path / "job1" / "a.txt", "content"))
+    digest = store.digests.digest(path)
+
+    # E.g. a process function running as root writing to its input file
+    os.chmod(path, 0o644)
+    time.sleep(0.01)
+    write(path, "changed")
+
+    assert store.find(digest) is None
+    fresh = add(store, write(tmp_path / "job2" / "a.txt", "content"))
+    assert not os.path.samefile(fresh, path)
+    assert os.path.samefile(store.find(digest), fresh)
+    with open(fresh) as f:
+        assert f.read() == "content"
+
+
+def test_collect_garbage_after_grace_period(store, tmp_path):
+    used = add(store, write(tmp_path / "job1" / "a.txt", "used"))
+    unused = add(store, write(tmp_path / "job2" / "b.txt", "unused"))
+    os.remove(unused)
+
+    # Within the grace period nothing is removed
+    assert store.collect_garbage() == (0, 0)
+
+    store.grace_period = 0
+    time.sleep(0.01)
+    assert store.collect_garbage() == (1, len("unused"))
+    assert store.usage() == (1, len("used"))
+    assert store.find(store.digests.digest(used)) is not None
+
+
+def test_discard(store, tmp_path):
+    path = add(store, write(tmp_path / "job1" / "a.txt", "content"))
+    digest = store.digests.digest(path)
+    store.discard(tmp_path / "elsewhere.txt", digest)
+    assert store.find(digest) is not None
+    store.discard(path, digest)
+    assert store.find(digest) is None
+    assert os.path.isfile(path)
+
+
+def test_clone_or_copy_is_independent(tmp_path):
+    src = write(tmp_path / "src.txt", "content")
+    dst = clone_or_copy(src, tmp_path / "dst.txt")
+    assert not os.path.samefile(src, dst)
+    write(dst, "changed")
+    with open(src) as f:
+        assert f.read() == "content"
@@ -0,0 +1,85 @@
+# Unit tests of the cache of the node. These do not need docker.
+
+import errno
+import json
+import os
+import shutil
+from pydantic import BaseModel, FilePath
+from rhnode.cache import Cache, DigestIndex, DirectoryCacheBackend, CACHE_JSON_FNAME
+
+
+class Inputs(BaseModel):
+    scalar: int
+
+
+class Outputs(BaseModel):
+    out_file: FilePath
+
+
+def make_cache(tmp_path, name):
+    # The local caches are on the same filesystem as the shared cache
+    return Cache(
+        tmp_path / name,
+        Outputs,
+        Inputs,
+        digests=DigestIndex(),
+        shared=DirectoryCacheBackend(tmp_path / "shared"),
+    )
+
+
+def run_job(cache, directory, content="content"):
+    directory.mkdir(parents=True)
+    with open(directory / "out.txt", "w") as f:
+        f.write(content)
+    cache_key = cache._get_cache_key(Inputs(scalar=1))
+    cache._save_to_cache(cache_key, Outputs(out_file=directory / "out.txt"), directory)
+    return cache_key
+
+
+def test_shared_entry_in_two_caches(tmp_path):
+    first, second = make_cache(tmp_path, "first"), make_cache(tmp_path, "second")
+    cache_key = run_job(first, tmp_path / "job")
+    assert second._promote(cache_key)
+
+    # Each cache rewrites the response of its own entry
+    for name in ("first", "second"):
+        entry_json = tmp_path / name / cache_key / CACHE_JSON_FNAME
+        assert not os.path.samefile(
+            entry_json, tmp_path / "shared" / cache_key / CACHE_JSON_FNAME
+        )
+
+    for cache, name in ((second, "second_out"), (first, "first_out")):
+        outputs = cache._load_from_cache(cache_key, tmp_path / name)
+        assert outputs.out_file == tmp_path / name / "out.txt"
+        with open(outputs.out_file) as f:
+            assert f.read() == "content"
+    assert first.counters["hits"] == second.counters["hits"] == 1
+    assert second.counters["shared_hits"] == 1
+
+
+def test_broken_entry_is_a_miss(tmp_path):
+    cache = make_cache(tmp_path, "cache")
+    cache_key = run_job(cache, tmp_path / "job")
+    other = tmp_path / "other.txt"
+    other.touch()
+
+    # A response that refers to a file outside of the entry
+    with open(tmp_path / "cache" / cache_key / CACHE_JSON_FNAME, "w") as f:
+        json.dump({"out_file": str(other)}, f)
+
+    assert cache._load_from_cache(cache_key, tmp_path / "out") is None
+    assert cache.counters["corrupted"] == 1
+    assert not cache._result_is_cached(cache_key)
+
+
+def test_full_job_disk_keeps_entry(tmp_path, monkeypatch):
+    cache = make_cache(tmp_path, "cache")
+    cache_key = run_job(cache, tmp_path / "job")
+
+    def copytree(*args, **kwargs):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(shutil, "copytree", copytree)
+    assert cache._load_from_cache(cache_key, tmp_path / "out") is None
+    assert cache.counters["corrupted"] == 0
+    assert cache._result_is_cached(cache_key)
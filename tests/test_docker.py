@@ -14,17 +14,37 @@
 NII_FILE = "tests/data/mr.nii.gz"
 
 import pytest
-from rhnode import RHJob
+from rhnode import RHJob, AsyncRHJob
 import requests
+import httpx
+import asyncio
 import os
 import shutil
-from rhnode.common import JobStatus, JobCancelledError, JobFailedError
+import csv
+import filecmp
+import hashlib
+import io
+import json
+import subprocess
+import sys
+import tarfile
+from rhnode.common import (
+    JobStatus,
+    JobCancelledError,
+    JobDeadlineExceededError,
+    JobFailedError,
+)
+from rhnode.client import client_context
+from rhnode import rhjob
 import time
+from pathlib import Path
 
 ADDRESS = "localhost:9050"
 ENDPOINT = "http://" + ADDRESS
 ENDPOINT_ADD = ENDPOINT + "/add"
 ENDPOINT_MANAGER = ENDPOINT + "/manager"
+# Entries kept per cache directory by the add node
+CACHE_SIZE = 3
 
 
 def test_read_root_node():
@@ -36,6 +56,111 @@ def test_read_root_manager():
     requests.get(ENDPOINT_MANAGER).raise_for_status()
 
 
+def test_submit_in_one_request():
+    data = {"scalar": 3, "sleep_time": 0}
+    with open(NII_FILE, "rb") as f:
+        files = [
+            ("inputs", (None, json.dumps(data))),
+            ("job", (None, json.dumps({"resources_included": True, "device": 0}))),
+            ("file.in_file", ("mr.nii.gz", f)),
+        ]
+        response = requests.post(ENDPOINT_ADD + "/jobs/submit", files=files)
+    response.raise_for_status()
+    job_id = response.json()
+
+    for _ in range(30):
+        status = requests.get(ENDPOINT_ADD + f"/jobs/{job_id}/status").json()
+        if JobStatus(status) == JobStatus.Finished:
+            break
+        time.sleep(1)
+    assert JobStatus(status) == JobStatus.Finished
+
+
+def test_submit_missing_file():
+    files = [("inputs", (None, json.dumps({"scalar": 3})))]
+    response = requests.post(ENDPOINT_ADD + "/jobs/submit", files=files)
+    assert response.status_code == 400
+
+
+def test_bulk_submit_and_status(tmp_path):
+    data = {"scalar": 3, "in_file": NII_FILE, "sleep_time": 1}
+    jobs = [
+        RHJob(node_name="add", inputs=data, node_address=ADDRESS, check_cache=False)
+        for _ in range(3)
+    ]
+    jobs.append(RHJob(node_name="add", inputs={"scalar": 3}, node_address=ADDRESS))
+    errors = RHJob.start_many(jobs, return_exceptions=True)
+    assert errors[:3] == [None, None, None]
+    assert errors[3] is not None
+
+    cursor = requests.get(ENDPOINT_ADD + "/jobs/status").json()["cursor"]
+    job_ids = [job.ID for job in jobs[:3]]
+    for _ in range(30):
+        response = requests.post(ENDPOINT_ADD + "/jobs/status", json=job_ids)
+        statuses = response.json()["jobs"]
+        if all(JobStatus(statuses[job_id]) == JobStatus.Finished for job_id in job_ids):
+            break
+        time.sleep(1)
+    assert all(JobStatus(statuses[job_id]) == JobStatus.Finished for job_id in job_ids)
+
+    changed = requests.get(ENDPOINT_ADD + f"/jobs/status?since={cursor}").json()
+    assert set(job_ids) <= set(changed["jobs"])
+    assert changed["cursor"] > cursor
+
+
+@pytest.mark.parametrize("name", ["x.inputs", "1000000.inputs"])
+def test_bulk_submit_rejects_bad_numbering(name):
+    fields = {name: (None, json.dumps({"scalar": 3}), "application/json")}
+    response = requests.post(ENDPOINT_ADD + "/jobs/submit_many", files=fields)
+    assert response.status_code == 400
+
+
+def test_output_reference(tmp_path):
+    data = {"scalar": 3, "in_file": NII_FILE, "sleep_time": 0}
+    first = RHJob(node_name="add", inputs=data, node_address=ADDRESS, check_cache=False)
+    first.start()
+    output = first.wait_for_finish(download=False)
+    assert output["out_file"].job_id == first.ID
+
+    data = {"scalar": 3, "in_file": output["out_file"], "sleep_time": 0}
+    second = RHJob(
+        node_name="add",
+        inputs=data,
+        node_address=ADDRESS,
+        output_directory=tmp_path,
+        check_cache=False,
+    )
+    second.start()
+    output = second.wait_for_finish()
+    assert os.path.isfile(output["out_file"])
+
+    # Only output files can be referenced
+    data = {
+        "scalar": 3,
+        "in_file": first.output_reference("out_message"),
+        "sleep_time": 0,
+    }
+    third = RHJob(node_name="add", inputs=data, node_address=ADDRESS, check_cache=False)
+    with pytest.raises(requests.HTTPError) as error:
+        third.start()
+    assert error.value.response.status_code == 400
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_download_archive(tmp_path, compress):
+    data = {"scalar": 3, "in_file": NII_FILE, "sleep_time": 0}
+    job = RHJob(node_name="add", inputs=data, node_address=ADDRESS, check_cache=False)
+    job.start()
+    job.wait_for_finish(download=False)
+
+    url = ENDPOINT_ADD + f"/jobs/{job.ID}/download.tar?compress={str(compress).lower()}"
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with tarfile.open(fileobj=response.raw, mode="r|*") as tar:
+            keys = [member.pax_headers["RHNODE.key"] for member in tar]
+    assert keys == ["out_file"]
+
+
 # test output
 @pytest.mark.parametrize("param", [True, False])
 def test_output(tmp_path, param):
@@ -145,6 +270,23 @@ def test_queue_and_cancel(tmp_path):
     jobs[2].stop()
 
 
+def test_deadline(tmp_path):
+    data = {"scalar": 3, "in_file": NII_FILE, "sleep_time": 60}
+    job = RHJob(
+        node_name="add",
+        inputs=data,
+        check_cache=False,
+        deadline=time.time() + 5,
+        output_directory=tmp_path,
+    )
+    job.start()
+    start = time.time()
+    with pytest.raises(JobDeadlineExceededError):
+        job.wait_for_finish()
+    assert time.time() - start < 30
+    assert JobStatus(job._get_status()) == JobStatus.Cancelled
+
+
 def test_finish_and_caching(tmp_path):
     data = {"scalar": 3, "in_file": NII_FILE, "sleep_time": 5, "throw_error": False}
 
@@ -180,6 +322,167 @@ def test_finish_and_caching(tmp_path):
     assert end - start < 5
 
 
+def test_cache_ignores_field(tmp_path):
+    # sleep_time is declared with cache_key=False in the add node
+    data = {"scalar": 4, "in_file": NII_FILE, "sleep_time": 5}
+    node = RHJob(
+        node_name="add",
+        inputs=data,
+        node_address=ADDRESS,
+        check_cache=False,
+        output_directory=tmp_path / "first",
+        resources_included=True,
+    )
+    node.start()
+    node.wait_for_finish()
+
+    node = RHJob(
+        node_name="add",
+        inputs={**data, "sleep_time": 10},
+        node_address=ADDRESS,
+        check_cache=True,
+        output_directory=tmp_path / "second",
+        resources_included=True,
+    )
+    start = time.time()
+    node.start()
+    node.wait_for_finish()
+    assert time.time() - start < 5
+
+
+def test_client_cache_key(tmp_path):
+    # The key the client computes for dispatch is the one the node caches with
+    data = {"scalar": 8, "in_file": NII_FILE}
+    node = RHJob(
+        node_name="add",
+        inputs=data,
+        node_address=ADDRESS,
+        output_directory=tmp_path,
+        resources_included=True,
+    )
+    node.start()
+    node.wait_for_finish()
+
+    cache_key = requests.get(f"{ENDPOINT_ADD}/jobs/{node.ID}/cache_key").json()
+    assert node._get_cache_key(node._get_schema()) == cache_key
+
+    url = ENDPOINT_MANAGER + "/dispatcher/get_host/add"
+    assert requests.get(url, params={"cache_key": cache_key}).status_code == 200
+    url = ENDPOINT_MANAGER + "/dispatcher/cache_indexes/add"
+    assert requests.get(url).status_code == 200
+
+
+def test_cache_endpoints(tmp_path):
+    data = {"scalar": 5, "in_file": NII_FILE, "sleep_time": 0}
+    node = RHJob(
+        node_name="add",
+        inputs=data,
+        node_address=ADDRESS,
+        output_directory=tmp_path,
+        resources_included=True,
+    )
+    node.start()
+    node.wait_for_finish()
+
+    cache_key = requests.get(f"{ENDPOINT_ADD}/jobs/{node.ID}/cache_key").json()
+    entries = requests.get(ENDPOINT_ADD + "/cache/entries").json()
+    assert cache_key in [entry["cache_key"] for entry in entries["entries"]]
+    stats = requests.get(ENDPOINT_ADD + "/cache/stats").json()
+    assert stats["hits"] + stats["misses"] > 0
+    assert "rhnode_cache_hits_total" in requests.get(ENDPOINT_ADD + "/metrics").text
+
+    url = f"{ENDPOINT_ADD}/cache/entries/{cache_key}"
+    assert requests.post(url + "/pin").status_code == 204
+    assert requests.post(url + "/delete").status_code == 204
+    assert requests.post(url + "/delete").status_code == 404
+
+
+def test_cache_export_import(tmp_path):
+    data = {"scalar": 6, "in_file": NII_FILE, "sleep_time": 0}
+    errors = RHJob.prefetch(
+        "add",
+        [data],
+        node_address=ADDRESS,
+        output_directory=tmp_path,
+        resources_included=True,
+    )
+    assert errors == {}
+    assert not os.listdir(tmp_path)
+
+    entries = requests.get(ENDPOINT_ADD + "/cache/entries").json()["entries"]
+    cache_key = entries[0]["cache_key"]
+    archive = requests.get(
+        ENDPOINT_ADD + "/cache/export.tar", params={"keys": cache_key}
+    )
+    assert archive.status_code == 200
+
+    url = ENDPOINT_ADD + "/cache/import"
+    assert requests.post(url, data=archive.content).json()["imported"] == []
+    requests.post(f"{ENDPOINT_ADD}/cache/entries/{cache_key}/delete")
+    assert requests.post(url, data=archive.content).json()["imported"] == [cache_key]
+    assert requests.post(url, data=b"not an archive").status_code == 400
+
+
+def test_cache_import_rejects_paths_outside_entry(tmp_path):
+    cache_key = run_add(8, tmp_path)
+    archive = requests.get(
+        ENDPOINT_ADD + "/cache/export.tar", params={"keys": cache_key}
+    )
+    requests.post(f"{ENDPOINT_ADD}/cache/entries/{cache_key}/delete")
+
+    # Point the output of the entry at a file outside of it
+    crafted = io.BytesIO()
+    with tarfile.open(fileobj=io.BytesIO(archive.content)) as src, tarfile.open(
+        fileobj=crafted, mode="w"
+    ) as dst:
+        for member in src:
+            content = src.extractfile(member) if member.isfile() else None
+            if member.name == f"{cache_key}/response.json":
+                response = json.load(content)
+                for key, val in response.items():
+                    if isinstance(val, str) and "/files/" in val:
+                        response[key] = (
+                            f".cache/{cache_key}/files/../../../../etc/passwd"
+                        )
+                content = io.BytesIO(json.dumps(response).encode())
+                member.size = len(content.getvalue())
+            dst.addfile(member, content)
+
+    url = ENDPOINT_ADD + "/cache/import"
+    assert requests.post(url, data=crafted.getvalue()).status_code == 400
+    assert cache_key not in [entry["cache_key"] for entry in get_cache_entries()]
+
+
+def test_shared_cache(tmp_path):
+    # The add node writes through to a shared cache directory in its container
+    data = {"scalar": 7, "in_file": NII_FILE, "sleep_time": 0}
+
+    def run(output_directory):
+        job = RHJob(
+            node_name="add",
+            inputs=data,
+            node_address=ADDRESS,
+            output_directory=output_directory,
+            resources_included=True,
+        )
+        job.start()
+        job.wait_for_finish()
+        return requests.get(f"{ENDPOINT_ADD}/jobs/{job.ID}/cache_key").json()
+
+    cache_key = run(tmp_path / "first")
+    url = f"{ENDPOINT_ADD}/cache/entries/{cache_key}/delete"
+    assert requests.post(url, params={"shared": "false"}).status_code == 204
+
+    shared_hits = requests.get(ENDPOINT_ADD + "/cache/stats").json()["shared_hits"]
+    run(tmp_path / "second")
+    assert os.path.exists(tmp_path / "second" / "added1.nii.gz")
+    stats = requests.get(ENDPOINT_ADD + "/cache/stats").json()
+    assert stats["shared_hits"] == shared_hits + 1
+
+    assert requests.post(url).status_code == 204
+    assert requests.post(url).status_code == 404
+
+
 def test_dependent(tmp_path):
     data = {"multiplier": 3, "in_file": NII_FILE}
     output_directory = tmp_path / "output"
@@ -192,3 +495,302 @@ def test_dependent(tmp_path):
     assert len(os.listdir(output_directory)) == 2
     assert os.path.exists(os.path.join(output_directory, "img1.nii.gz"))
     assert os.path.exists(os.path.join(output_directory, "added1.nii.gz"))
+
+
+def test_map(tmp_path):
+    items = [
+        {"scalar": i, "in_file": NII_FILE, "sleep_time": 1, "throw_error": i == 2}
+        for i in range(4)
+    ]
+    results = list(
+        RHJob.map(
+            "add",
+            items,
+            output_directory=tmp_path,
+            max_in_flight=2,
+            ordered=True,
+            return_exceptions=True,
+            node_address=ADDRESS,
+            check_cache=False,
+        )
+    )
+
+    assert [index for index, _ in results] == [0, 1, 2, 3]
+    assert isinstance(results[2][1], JobFailedError)
+    for index in [0, 1, 3]:
+        assert os.path.exists(tmp_path / str(index) / "added1.nii.gz")
+
+
+def test_cli_batch(tmp_path):
+    manifest = tmp_path / "manifest.csv"
+
+    def write_manifest(throw_error):
+        with open(manifest, "w") as f:
+            f.write("id,scalar,in_file,sleep_time,throw_error\n")
+            f.write(f"a,1,{NII_FILE},0,false\n")
+            f.write(f"b,2,{NII_FILE},0,{str(throw_error).lower()}\n")
+
+    def run_batch():
+        command = [sys.executable, "-m", "rhnode.cli", "-na", ADDRESS, "-nc"]
+        command += ["-o", str(tmp_path / "output"), "--batch", str(manifest), "add"]
+        return subprocess.run(command).returncode
+
+    write_manifest(throw_error=True)
+    assert run_batch() == 1
+    assert os.path.exists(tmp_path / "output" / "a" / "added1.nii.gz")
+    with open(tmp_path / "manifest.report.csv") as f:
+        statuses = {row["id"]: row["status"] for row in csv.DictReader(f)}
+    assert statuses == {"a": "finished", "b": "failed"}
+
+    # A second run only runs the rows that did not finish
+    write_manifest(throw_error=False)
+    assert run_batch() == 0
+    with open(tmp_path / "manifest.ledger.jsonl") as f:
+        ledger = [json.loads(line) for line in f]
+    assert [entry["id"] for entry in ledger] == ["a", "b", "b"]
+    assert ledger[-1]["status"] == "finished"
+    assert os.path.exists(tmp_path / "output" / "b" / "added1.nii.gz")
+
+
+def test_client_context(tmp_path, monkeypatch):
+    # Jobs after the first reuse the manager, address and schema of the node
+    data = {"scalar": 3, "in_file": NII_FILE, "sleep_time": 0}
+    client_context.clear()
+    job = RHJob(node_name="add", inputs=data, output_directory=tmp_path)
+    job.start()
+    job.wait_for_finish()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Fetched what should have been cached")
+
+    monkeypatch.setattr(RHJob, "_find_manager_endpoint", fail)
+    monkeypatch.setattr(RHJob, "_fetch_addr_for_job", fail)
+    monkeypatch.setattr(RHJob, "_fetch_cache_indexes", fail)
+    monkeypatch.setattr(RHJob, "_fetch_schema", fail)
+    job = RHJob(node_name="add", inputs=data, output_directory=tmp_path)
+    job.start()
+    job.wait_for_finish()
+
+    # A node with another schema version is fetched again
+    assert client_context.schema_is_stale(job.host, job.port, "add", "other")
+    client_context.invalidate_node(job.host, job.port, "add")
+    with pytest.raises(AssertionError):
+        job._get_schema()
+
+
+def test_async_jobs(tmp_path, monkeypatch):
+    # Record the bulk status requests the waiting jobs are combined into
+    status_requests = []
+    post = httpx.AsyncClient.post
+
+    async def record_post(self, url, *args, **kwargs):
+        if url.endswith("/jobs/status"):
+            status_requests.append(kwargs["json"])
+        return await post(self, url, *args, **kwargs)
+
+    monkeypatch.setattr(httpx.AsyncClient, "post", record_post)
+
+    async def run(scalar):
+        job = AsyncRHJob(
+            node_name="add",
+            inputs={"scalar": scalar, "in_file": NII_FILE, "sleep_time": 2},
+            node_address=ADDRESS,
+            check_cache=False,
+            output_directory=tmp_path / str(scalar),
+            compress_download=True,
+        )
+        await job.start()
+        return job, await job.wait_for_finish()
+
+    async def run_all():
+        return await asyncio.gather(*[run(scalar) for scalar in range(3)])
+
+    for scalar, (job, output) in enumerate(asyncio.run(run_all())):
+        assert job._archive_download
+        assert str(output["out_file"]) == str(tmp_path / str(scalar) / "added1.nii.gz")
+        assert os.path.isfile(output["out_file"])
+    assert max(len(job_ids) for job_ids in status_requests) == 3
+
+
+def test_shared_storage(tmp_path):
+    # tests/shared is mounted at the same path in the add node, see docker-compose.yaml
+    shared_dir = os.path.abspath("tests/shared")
+    os.makedirs(shared_dir, exist_ok=True)
+    in_file = os.path.join(shared_dir, "mr.nii.gz")
+    shutil.copyfile(NII_FILE, in_file)
+
+    data = {"scalar": 9, "in_file": in_file, "sleep_time": 0}
+    job = RHJob(
+        node_name="add",
+        inputs=data,
+        node_address=ADDRESS,
+        check_cache=False,
+        output_directory=tmp_path,
+        shared_storage=True,
+    )
+    job.start()
+    output = job.wait_for_finish()
+    # The input was passed by path instead of uploaded
+    assert job._shared_roots == [Path(shared_dir)]
+    assert job._sent_without_upload
+    assert os.path.isfile(output["out_file"])
+
+
+def test_skip_download_with_matching_digest(tmp_path, monkeypatch):
+    data = {"scalar": 10, "in_file": NII_FILE, "sleep_time": 0}
+
+    def run(output_directory):
+        job = RHJob(
+            node_name="add",
+            inputs=data,
+            node_address=ADDRESS,
+            output_directory=output_directory,
+        )
+        job.start()
+        return job.wait_for_finish()
+
+    first = run(tmp_path / "first")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Downloaded a file that was already here")
+
+    monkeypatch.setattr(rhjob, "_check_download", fail)
+    # The file is already in the output directory
+    output = run(tmp_path / "first")
+    assert output["out_file"] == first["out_file"]
+    # The file was downloaded before, to another directory
+    output = run(tmp_path / "second")
+    assert filecmp.cmp(output["out_file"], first["out_file"], shallow=False)
+
+
+def test_cache_directories(tmp_path):
+    # The add node spreads its cache over two directories, see docker-compose.yaml
+    for scalar in range(20, 24):
+        job = RHJob(
+            node_name="add",
+            inputs={"scalar": scalar, "in_file": NII_FILE, "sleep_time": 0},
+            node_address=ADDRESS,
+            output_directory=tmp_path / str(scalar),
+        )
+        job.start()
+        job.wait_for_finish()
+
+    directories = [
+        directory["directory"]
+        for directory in requests.get(ENDPOINT_ADD + "/cache/stats").json()[
+            "directories"
+        ]
+    ]
+    assert len(directories) == 2
+
+    # Each entry is in the directory its key hashes to
+    entries = requests.get(ENDPOINT_ADD + "/cache/entries").json()["entries"]
+    assert entries
+    for entry in entries:
+        expected = max(
+            directories,
+            key=lambda root: hashlib.sha256(
+                f"{root}/{entry['cache_key']}".encode()
+            ).digest(),
+        )
+        assert entry["directory"] == expected
+
+
+def exec_in_add_node(code, **kwargs):
+    """Start python code in the container of the add node, in its working directory"""
+    command = ["docker", "compose", "exec", "-T", "add", "python", "-c", code]
+    return subprocess.Popen(
+        command, cwd=os.path.dirname(os.path.abspath(__file__)), **kwargs
+    )
+
+
+def run_add(scalar, output_directory):
+    job = RHJob(
+        node_name="add",
+        inputs={"scalar": scalar, "in_file": NII_FILE, "sleep_time": 0},
+        node_address=ADDRESS,
+        output_directory=output_directory,
+    )
+    job.start()
+    job.wait_for_finish()
+    return requests.get(f"{ENDPOINT_ADD}/jobs/{job.ID}/cache_key").json()
+
+
+def get_cache_entries():
+    return requests.get(ENDPOINT_ADD + "/cache/entries").json()["entries"]
+
+
+def test_cache_read_during_eviction(tmp_path):
+    cache_key = run_add(40, tmp_path / "40")
+    directory = next(
+        entry["directory"]
+        for entry in get_cache_entries()
+        if entry["cache_key"] == cache_key
+    )
+
+    # Hold the lock a job takes while it reads the entry
+    reader = exec_in_add_node(
+        "import fcntl, sys\n"
+        f"f = open('{directory}/{cache_key}/lock', 'a')\n"
+        "fcntl.flock(f, fcntl.LOCK_SH)\n"
+        "print('locked', flush=True)\n"
+        "sys.stdin.read()\n",
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert reader.stdout.readline().strip() == "locked"
+
+        # Save newer entries in the same directory until the entry is the least
+        # recently used one of a full directory
+        newer = set()
+        scalar = 41
+        while len(newer) <= CACHE_SIZE:
+            run_add(scalar, tmp_path / str(scalar))
+            newer |= {
+                entry["cache_key"]
+                for entry in get_cache_entries()
+                if entry["directory"] == directory and entry["cache_key"] != cache_key
+            }
+            scalar += 1
+        assert cache_key in [entry["cache_key"] for entry in get_cache_entries()]
+    finally:
+        reader.stdin.close()
+        reader.wait()
+
+    # Once read, the entry is evicted by the next save in its directory
+    while cache_key in [entry["cache_key"] for entry in get_cache_entries()]:
+        assert scalar < 100
+        run_add(scalar, tmp_path / str(scalar))
+        scalar += 1
+
+
+def test_scrub_removes_corrupted_entry(tmp_path):
+    cache_key = run_add(60, tmp_path)
+    directory = next(
+        entry["directory"]
+        for entry in get_cache_entries()
+        if entry["cache_key"] == cache_key
+    )
+
+    # Flip the first byte of the cached files, keeping their size
+    corrupt = exec_in_add_node(
+        "import os\n"
+        f"for root, dirs, files in os.walk('{directory}/{cache_key}/files'):\n"
+        "    for file in files:\n"
+        "        with open(os.path.join(root, file), 'r+b') as f:\n"
+        "            first = f.read(1)\n"
+        "            f.seek(0)\n"
+        "            f.write(bytes([first[0] ^ 0xFF]))\n"
+    )
+    assert corrupt.wait() == 0
+
+    corrupted = requests.get(ENDPOINT_ADD + "/cache/stats").json()["corrupted"]
+    result = requests.post(ENDPOINT_ADD + "/cache/scrub").json()
+    assert result["checked"] > 0
+    assert result["removed"] == 1
+    assert cache_key not in [entry["cache_key"] for entry in get_cache_entries()]
+    assert (
+        requests.get(ENDPOINT_ADD + "/cache/stats").json()["corrupted"] == corrupted + 1
+    )
@@ -0,0 +1,260 @@
+# Unit tests of the scheduling in the manager. These do not need docker.
+
+import os
+import time
+
+# Importing the manager module creates the app, which reads the host resources
+os.environ.setdefault("RH_GPU_MEM", "8,8")
+os.environ.setdefault("RH_NUM_THREADS", "8")
+os.environ.setdefault("RH_MEMORY", "32")
+
+import pytest
+import requests
+from rhnode.common import QueueRequest, JobUsage, CacheKeyFilter
+from nodes.manager.manager import ResourceQueue, RHManager
+
+
+def make_request(job_id, priority=3, gpu_mem=4, threads=2, memory=8, **kwargs):
+    return QueueRequest(
+        job_id=job_id,
+        priority=priority,
+        required_gpu_mem=gpu_mem,
+        required_threads=threads,
+        required_memory=memory,
+        **kwargs,
+    )
+
+
+def make_queue(**kwargs):
+    return ResourceQueue(
+        available_gpus_mem=[8, 8],
+        available_threads=8,
+        available_memory=32,
+        **kwargs,
+    )
+
+
+def queued_ids(queue):
+    return [entry[0].job_id for entry in queue.job_queue]
+
+
+def test_jobs_are_placed_on_free_devices():
+    queue = make_queue()
+    queue.add_job(make_request("a_1", gpu_mem=6))
+    queue.add_job(make_request("a_2", gpu_mem=6))
+    queue.add_job(make_request("a_3", gpu_mem=6))
+
+    assert queue.is_job_active("a_1") == (True, [0])
+    assert queue.is_job_active("a_2") == (True, [1])
+    assert queue.is_job_active("a_3") == (False, None)
+    assert queued_ids(queue) == ["a_3"]
+
+    queue.end_job("a_1")
+    assert queue.is_job_active("a_3") == (True, [0])
+
+
+def test_gpu_shares_adding_up_to_one_fit():
+    queue = make_queue()
+    queue.add_job(make_request("a_1", gpu_mem=2, required_gpu_share=0.3))
+    queue.add_job(make_request("a_2", gpu_mem=2, required_gpu_share=0.3))
+    queue.add_job(make_request("a_3", gpu_mem=2, required_gpu_share=0.4))
+    for job_id in ("a_1", "a_2", "a_3"):
+        assert queue.is_job_active(job_id) == (True, [0])
+
+    queue.add_job(make_request("a_4", gpu_mem=2, required_gpu_share=0.1))
+    assert queue.is_job_active("a_4") == (True, [1])
+
+
+def test_multi_gpu_job_waits_for_all_devices():
+    queue = make_queue(backfill=False)
+    queue.add_job(make_request("a_1", gpu_mem=6))
+    queue.add_job(make_request("b_1", gpu_mem=6, required_num_gpus=2))
+    assert not queue.is_job_active("b_1")[0]
+
+    queue.end_job("a_1")
+    assert queue.is_job_active("b_1") == (True, [0, 1])
+
+
+def test_job_exceeding_host_is_rejected():
+    queue = make_queue()
+    with pytest.raises(ValueError):
+        queue.add_job(make_request("a_1", gpu_mem=16))
+    with pytest.raises(ValueError):
+        queue.add_job(make_request("a_1", priority=6))
+
+
+def test_higher_priority_first():
+    queue = make_queue(backfill=False)
+    queue.add_job(make_request("a_1", threads=8))
+    queue.add_job(make_request("a_2", threads=8, priority=2))
+    queue.add_job(make_request("a_3", threads=8, priority=4))
+    assert queued_ids(queue) == ["a_3", "a_2"]
+
+
+def test_aging_moves_waiting_jobs_up():
+    queue = make_queue(backfill=False, aging_rate=1)
+    queue.add_job(make_request("a_1", threads=8))
+    queue.add_job(make_request("a_2", threads=8, priority=3))
+    queue.add_job(make_request("a_3", threads=8, priority=4))
+    assert queued_ids(queue) == ["a_3", "a_2"]
+
+    # a_2 has waited two hours, which is worth two levels
+    job_request, seq, time_queued = queue.job_queue[1]
+    queue.job_queue[1] = (job_request, seq, time_queued - 7200)
+    queue.process_queue()
+    assert queued_ids(queue) == ["a_2", "a_3"]
+
+
+def test_aging_is_disabled_by_default():
+    queue = make_queue(backfill=False)
+    queue.add_job(make_request("a_1", threads=8))
+    queue.add_job(make_request("a_2", threads=8, priority=3))
+    queue.add_job(make_request("a_3", threads=8, priority=4))
+    job_request, seq, time_queued = queue.job_queue[1]
+    queue.job_queue[1] = (job_request, seq, time_queued - 7200)
+    queue.process_queue()
+    assert queued_ids(queue) == ["a_3", "a_2"]
+
+
+def test_fair_share_orders_submitters_within_a_level():
+    queue = make_queue(backfill=False, fair_share_weight=1)
+    queue.fair_share.add("heavy", 100, time.time())
+    queue.fair_share.add("light", 10, time.time())
+    queue.add_job(make_request("a_1", threads=8, submitter="heavy"))
+    queue.add_job(make_request("a_2", threads=8, submitter="heavy"))
+    queue.add_job(make_request("a_3", threads=8, submitter="light"))
+
+    # Both have a share below one, so neither drops a level, but the submitter
+    # with less recent use goes first among jobs that are otherwise equal
+    assert queued_ids(queue) == ["a_3", "a_2"]
+
+
+def test_small_usage_share_does_not_drop_a_level():
+    queue = make_queue(backfill=False, fair_share_weight=1)
+    queue.fair_share.add("heavy", 100, time.time())
+    queue.fair_share.add("light", 10, time.time())
+    queue.add_job(make_request("a_1", threads=8, submitter="heavy"))
+    queue.add_job(make_request("a_2", threads=8, priority=2, submitter="new"))
+    queue.add_job(make_request("a_3", threads=8, priority=3, submitter="light"))
+    assert queued_ids(queue) == ["a_3", "a_2"]
+
+
+def test_sole_user_of_host_drops_a_level():
+    queue = make_queue(backfill=False, fair_share_weight=1)
+    queue.fair_share.add("heavy", 100, time.time())
+    queue.add_job(make_request("a_1", threads=8, submitter="heavy"))
+    queue.add_job(make_request("a_2", threads=8, priority=3, submitter="heavy"))
+    queue.add_job(make_request("a_3", threads=8, priority=3, submitter="light"))
+    queue.add_job(make_request("a_4", threads=8, priority=2, submitter="light"))
+    # Only "heavy" has used the host, and only "light" has nothing running
+    assert queue.get_usage_shares() == {"heavy": 1}
+    assert queued_ids(queue) == ["a_3", "a_2", "a_4"]
+
+
+def test_shortest_expected_job_first_within_level():
+    queue = make_queue(backfill=False)
+    usage = JobUsage(completed=True)
+    queue.history.record("slow", 100, make_request("slow_0"), usage)
+    queue.history.record("fast", 10, make_request("fast_0"), usage)
+    queue.add_job(make_request("a_1", threads=8))
+    queue.add_job(make_request("slow_1", threads=8))
+    queue.add_job(make_request("fast_1", threads=8))
+    assert queued_ids(queue) == ["fast_1", "slow_1"]
+
+
+def test_queued_job_past_deadline_is_dropped():
+    queue = make_queue(backfill=False)
+    queue.add_job(make_request("a_1", threads=8))
+    queue.add_job(make_request("a_2", threads=8, deadline=time.time() + 0.01))
+    queue.add_job(make_request("a_3", threads=8, deadline=time.time() + 3600))
+    assert queued_ids(queue) == ["a_2", "a_3"]
+
+    time.sleep(0.02)
+    queue.process_queue()
+    assert queued_ids(queue) == ["a_3"]
+    assert queue.expired == {"a_2"}
+
+    # The expired job never starts, while the other one does
+    queue.end_job("a_1")
+    assert queue.is_job_active("a_2") == (False, None)
+    assert queue.is_job_active("a_3")[0]
+
+
+def test_suspend_and_resume_keeps_devices():
+    queue = make_queue(backfill=False)
+    queue.add_job(make_request("parent_1", gpu_mem=6, required_devices=[1]))
+    queue.suspend_job("parent_1")
+    assert queue.is_job_active("parent_1") == (False, None)
+
+    queue.add_job(make_request("other_1", gpu_mem=6, required_devices=[1]))
+    assert queue.is_job_active("other_1") == (True, [1])
+
+    # The resumed job goes ahead of everything, but waits for its own device
+    queue.add_job(make_request("other_2", gpu_mem=6, required_devices=[1]))
+    queue.resume_job("parent_1")
+    assert queued_ids(queue)[0] == "parent_1"
+    queue.end_job("other_1")
+    assert queue.is_job_active("parent_1") == (True, [1])
+    assert not queue.is_job_active("other_2")[0]
+
+
+def test_history_counts_active_time_only():
+    queue = make_queue()
+    queue.add_job(make_request("parent_1"))
+    time.sleep(0.1)
+    queue.suspend_job("parent_1")
+    time.sleep(0.3)
+    queue.resume_job("parent_1")
+    time.sleep(0.1)
+    queue.end_job("parent_1", JobUsage(completed=True))
+    assert 0.2 <= queue.history.expected_duration("parent") < 0.3
+
+
+def test_children_borrow_parent_resources():
+    queue = make_queue(backfill=False)
+    queue.add_job(make_request("parent_1", gpu_mem=6, threads=4, memory=16))
+    queue.add_job(make_request("other_1", gpu_mem=6, threads=4, memory=16))
+    assert queue.is_job_active("other_1")[0]
+
+    # The host is full, but the child fits in what its parent reserved
+    queue.add_job(
+        make_request("child_1", gpu_mem=4, threads=2, parent_id="parent_1", borrow=True)
+    )
+    assert queue.is_job_active("child_1") == (True, [0])
+    assert queue.borrowers == {"child_1": "parent_1"}
+    with pytest.raises(ValueError):
+        queue.suspend_job("child_1")
+
+    # A child that does not fit in what is left waits in the queue
+    queue.add_job(
+        make_request("child_2", gpu_mem=4, threads=4, parent_id="parent_1", borrow=True)
+    )
+    assert not queue.is_job_active("child_2")[0]
+
+    queue.end_job("child_1")
+    assert queue.is_job_active("child_2") == (True, [0])
+
+    # When the parent ends, its child counts against the host instead
+    queue.end_job("parent_1")
+    assert queue.borrowers == {}
+    assert queue.available.threads == 8 - 4 - 4
+
+
+def test_dispatch_to_host_with_cached_result(monkeypatch):
+    manager = RHManager()
+    manager.nodes["add"] = {}
+    manager.other_addrs = ["peer:9050"]
+    manager.cache_indexes["add"] = CacheKeyFilter.from_keys(["1" * 64])
+    manager.peer_cache_indexes["peer:9050"] = {
+        "add": CacheKeyFilter.from_keys(["2" * 64])
+    }
+
+    # The indexes of the other hosts are fetched in the background, not here
+    def fail(*args, **kwargs):
+        raise AssertionError("Requested another host while dispatching")
+
+    monkeypatch.setattr(requests, "get", fail)
+    assert list(manager.get_cache_indexes("add")) == ["localhost:8000", "peer:9050"]
+    assert manager._get_addr_with_cached_result("add", "1" * 64) == "localhost:8000"
+    assert manager._get_addr_with_cached_result("add", "2" * 64) == "peer:9050"
+    assert manager._get_addr_with_cached_result("add", "3" * 64) is None
@@ -0,0 +1,82 @@
+# Larger tests that requires multiple nodes running and interaction
+# These tests are done on a running docker compose session
+
+### HOW TO USE
+
+## 1 in terminal, cd to tests
+## 2 run "docker compose up --build"
+## 3 open another terminal
+## 4 run pytest
+## (5 check terminal with docker images that nothing breaks)
+
+
+## Make sure you have the file "tests/data/mr.nii.gz". This can be any nifti file.
+NII_FILE = "tests/data/mr.nii.gz"
+
+import pytest
+from rhnode import Pipeline
+from rhnode.pipeline import PipelineError
+import nibabel as nib
+import numpy as np
+import os
+
+ADDRESS = "localhost:9050"
+
+
+def test_pipeline(tmp_path):
+    pipeline = Pipeline(
+        output_directory=tmp_path, node_address=ADDRESS, check_cache=False
+    )
+    data = {"scalar": 1, "in_file": NII_FILE, "sleep_time": 1}
+    add_1 = pipeline.add_stage("add_1", "add", data)
+    add_2 = pipeline.add_stage("add_2", "add", data)
+    pipeline.add_stage(
+        "add_3",
+        "add",
+        {"scalar": 2, "in_file": add_1.output("out_file"), "sleep_time": 1},
+        depends_on=[add_2],
+    )
+    outputs = pipeline.run()
+
+    assert set(outputs) == {"add_1", "add_2", "add_3"}
+    assert os.path.exists(tmp_path / "add_3" / "added1.nii.gz")
+
+    arr_in = nib.load(NII_FILE).get_fdata()
+    arr_out = nib.load(outputs["add_3"]["out_file"]).get_fdata()
+    assert np.allclose(arr_out, arr_in + 3)
+
+    assert pipeline.report.critical_path[-1] == "add_3"
+    assert pipeline.report.timings["add_3"]["slack"] == pytest.approx(0)
+
+
+def test_pipeline_error(tmp_path):
+    pipeline = Pipeline(
+        output_directory=tmp_path, node_address=ADDRESS, check_cache=False
+    )
+    add_1 = pipeline.add_stage(
+        "add_1", "add", {"scalar": 1, "in_file": NII_FILE, "throw_error": True}
+    )
+    pipeline.add_stage(
+        "add_2", "add", {"scalar": 1, "in_file": add_1.output("out_file")}
+    )
+
+    with pytest.raises(PipelineError) as e:
+        pipeline.run()
+    assert e.value.stage_name == "add_1"
+    assert "add_2" not in pipeline.outputs
+
+
+def test_empty_pipeline(tmp_path):
+    pipeline = Pipeline(output_directory=tmp_path, node_address=ADDRESS)
+    assert pipeline.run() == {}
+    assert pipeline.report.critical_path == []
+    assert pipeline.report.total_time == 0
+
+
+def test_pipeline_cycle(tmp_path):
+    pipeline = Pipeline(output_directory=tmp_path, node_address=ADDRESS)
+    pipeline.add_stage("a", "add", {"scalar": 1, "in_file": NII_FILE}, depends_on=["b"])
+    pipeline.add_stage("b", "add", {"scalar": 1, "in_file": NII_FILE}, depends_on=["a"])
+
+    with pytest.raises(ValueError):
+        pipeline.run()